@@ -0,0 +1,60 @@
+"""
+Compares the byte-at-a-time relay used by older versions of run_single_script with
+sidefridge.streaming.relay_output.
+
+    python benchmarks/output_relay.py [megabytes]
+"""
+import os
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+from sidefridge.streaming import relay_output  # noqa: E402
+
+EMIT_SCRIPT = """
+import sys
+line = ("x" * 79 + "\\n").encode()
+block = line * 1024
+for _ in range(%d):
+    sys.stdout.buffer.write(block)
+"""
+
+
+def emitter(megabytes):
+    # 80 byte lines * 1024 = 80 KiB per block
+    blocks = megabytes * 1024 * 1024 // (80 * 1024)
+    return [sys.executable, '-c', EMIT_SCRIPT % blocks]
+
+
+def legacy_relay(cmd, sink):
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    for c in iter(lambda: process.stdout.read(1), b''):
+        sink.write(c.decode('utf-8'))
+    process.communicate()
+
+
+def streaming_relay(cmd, sink):
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    relay_output(process, stdout=sink, stderr=sink)
+    process.wait()
+
+
+def measure(name, relay, cmd, megabytes):
+    with open(os.devnull, 'w') as sink:
+        start = time.perf_counter()
+        relay(cmd, sink)
+        elapsed = time.perf_counter() - start
+    print("%-10s %8.3fs %10.1f MB/s" % (name, elapsed, megabytes / elapsed))
+
+
+def main():
+    megabytes = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    cmd = emitter(megabytes)
+    measure('legacy', legacy_relay, cmd, megabytes)
+    measure('streaming', streaming_relay, cmd, megabytes)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+"""
+Measures cold start of the console entry points: cumulative import time reported by `python -X importtime`
+and wall clock time of complete invocations, the way setuptools wrappers start them.
+Exits with status 1 if the median wall clock time of store_var or load_var exceeds the budget.
+
+    python benchmarks/startup.py [--runs N] [--budget-ms MS]
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
+
+MODULES = ['sidefridge.storage', 'sidefridge.kubectlexec', 'sidefridge.main', 'sidefridge.codegen']
+
+WRAPPER = 'import sys; from {module} import {function}; sys.exit({function}())'
+
+# store_var and load_var are the helpers scripts call in loops, they are held to the budget
+INVOCATIONS = [
+    ('store_var', 'sidefridge.storage', 'store_var', ['key', 'value'], True),
+    ('load_var', 'sidefridge.storage', 'load_var', ['key'], True),
+    ('kubectlexec', 'sidefridge.kubectlexec', 'main', [], False),
+    ('fridge --help', 'sidefridge.main', 'main', ['--help'], False),
+]
+
+
+def get_environment(work_dir):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = ROOT
+    # keeps the storage server out of the measurements, the log file is used instead
+    env.pop('SIDEFRIDGE_STORE_SOCKET', None)
+    env['HOME'] = work_dir
+    return env
+
+
+def import_time(module, env):
+    """ Cumulative import time in milliseconds as reported by -X importtime """
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import %s' % module],
+        env=env, stderr=subprocess.PIPE, stdout=subprocess.DEVNULL, universal_newlines=True
+    )
+    for line in result.stderr.splitlines():
+        fields = [field.strip() for field in line.split('|')]
+        if len(fields) == 3 and fields[2] == module:
+            return int(fields[1]) / 1000.0
+    raise RuntimeError("Could not measure import time of '%s':\n%s" % (module, result.stderr))
+
+
+def wall_clock(module, function, arguments, env, runs):
+    """ Median wall clock time in milliseconds of a complete invocation """
+    command = [sys.executable, '-c', WRAPPER.format(module=module, function=function)] + arguments
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Cold start benchmark of the sidefridge entry points')
+    parser.add_argument('--runs', type=int, default=20, help='invocations per entry point, default 20')
+    parser.add_argument('--budget-ms', type=float, default=100.0, help='budget for store_var/load_var, default 100')
+    arguments = parser.parse_args()
+
+    env = get_environment(tempfile.mkdtemp())
+    # bytecode must be cached, otherwise compilation is measured instead of startup
+    subprocess.run([sys.executable, '-m', 'compileall', '-q', os.path.join(ROOT, 'sidefridge')], check=True)
+
+    baseline = wall_clock('os', 'getpid', [], env, arguments.runs)
+    print("%-16s %8.1f ms" % ('python baseline', baseline))
+
+    for module in MODULES:
+        print("%-16s %8.1f ms  import %s" % ('import', import_time(module, env), module))
+
+    over_budget = []
+    for name, module, function, call_arguments, budgeted in INVOCATIONS:
+        elapsed = wall_clock(module, function, call_arguments, env, arguments.runs)
+        print("%-16s %8.1f ms" % (name, elapsed))
+        if budgeted and elapsed > arguments.budget_ms:
+            over_budget.append(name)
+
+    if over_budget:
+        print("Over the %.0f ms budget: %s" % (arguments.budget_ms, ', '.join(over_budget)))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
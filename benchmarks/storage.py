@@ -0,0 +1,81 @@
+"""
+Compares the append-only log file of sidefridge.storage with the storage server used during runs.
+
+    python benchmarks/storage.py [operations]
+"""
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+from sidefridge import storage  # noqa: E402
+from sidefridge.store_server import StoreServer  # noqa: E402
+
+WRITERS = 8
+
+
+def set_and_get(store, operations):
+    for index in range(operations):
+        store.request('set', key='key_%d' % (index % 50), value='value_%d' % index)
+        store.request('get', key='key_%d' % (index % 50))
+
+
+def concurrent_incr(make_store, operations):
+    """ Returns the final counter, lower than the number of increments if updates were lost """
+    failures = []
+
+    def writer():
+        store = make_store()
+        for _ in range(operations // WRITERS):
+            try:
+                store.request('incr', key='counter')
+            except (ValueError, storage.StorageError) as e:
+                failures.append(e)
+        store.close()
+
+    threads = [threading.Thread(target=writer) for _ in range(WRITERS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    store = make_store()
+    counter = store.request('get', key='counter')
+    store.close()
+    return counter, len(failures)
+
+
+def measure(name, make_store, operations):
+    store = make_store()
+    start = time.perf_counter()
+    set_and_get(store, operations)
+    elapsed = time.perf_counter() - start
+    store.close()
+
+    counter, failures = concurrent_incr(make_store, operations)
+    print("%-8s %8.3fs %10.0f ops/s  concurrent increments kept: %s/%d, failed: %d" % (
+        name, elapsed, 2 * operations / elapsed, counter, operations // WRITERS * WRITERS, failures
+    ))
+
+
+def main():
+    operations = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    work_dir = tempfile.mkdtemp()
+    storage.TMP_STORE = os.path.join(work_dir, 'storage_path')
+
+    measure('file', lambda: storage.LogStore(storage.get_storage_path()), operations)
+    storage.clear_storage()
+
+    server = StoreServer(os.path.join(work_dir, 'store.sock'))
+    server.start()
+    try:
+        measure('server', lambda: storage.StoreClient(server.socket_path), operations)
+    finally:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
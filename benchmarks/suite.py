@@ -0,0 +1,388 @@
+"""
+Benchmark suite of the hot paths of sidefridge, runs offline and prints the results as JSON so they can be
+compared across commits:
+
+    python benchmarks/suite.py -o results.json               # all benchmarks
+    python benchmarks/suite.py --quick output_throughput     # smaller workloads, selected benchmarks
+    python benchmarks/suite.py --compare before.json after.json
+
+kubectl is replaced by benchmarks/bin/kubectl, which runs the command locally, so no cluster is needed.
+"""
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from types import SimpleNamespace
+
+HERE = os.path.dirname(os.path.realpath(__file__))
+ROOT = os.path.realpath(os.path.join(HERE, '..'))
+sys.path.insert(0, ROOT)
+
+from sidefridge import main as runner  # noqa: E402
+from sidefridge.scripts import BACKUPS, SUPPORTED_DIRECTORIES  # noqa: E402
+from sidefridge.storage import STORE_SOCKET, clear_storage  # noqa: E402
+from sidefridge.store_server import StoreServer  # noqa: E402
+from sidefridge.warm import WARM_PYTHON_HOOKS, start_warm_worker, stop_warm_worker  # noqa: E402
+
+WRAPPER = 'import sys; from {module} import {function}; sys.exit({function}())'
+
+EMIT_SCRIPT = """#!{python}
+import sys
+block = (("x" * 79 + "\\n") * 1024).encode()
+for _ in range({blocks}):
+    sys.stdout.buffer.write(block)
+"""
+
+NOOP_SCRIPT = "#!/bin/sh\nexit 0\n"
+
+# a small Python hook, `# fridge: cold` makes it start a new interpreter even when the warm worker runs
+PYTHON_HOOK_SCRIPT = """#!{python}
+# fridge: {mode}
+import json
+from sidefridge.storage import store_value
+store_value("RESULT_{mode}_{index}", json.dumps(dict(index={index})))
+"""
+
+# a typical hook script, rendered in the config maps by codegen
+CODEGEN_SCRIPT = """#!/bin/sh
+set -e
+kubectlexec mongodump --archive --db "$DATABASE" > /backup/{index}.archive
+store_var ARTIFACT_SIZE_{index} "$(stat -c %s /backup/{index}.archive)"
+"""
+
+
+def get_environment(work_dir, **extra):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = ROOT
+    env['PATH'] = os.path.join(HERE, 'bin') + os.pathsep + env.get('PATH', '')
+    env['HOME'] = work_dir
+    env.pop(STORE_SOCKET, None)
+    env.update(extra)
+    return env
+
+
+def python_command(module, function, arguments):
+    """ Invokes an entry point the way the setuptools wrappers do """
+    return [sys.executable, '-c', WRAPPER.format(module=module, function=function)] + arguments
+
+
+def write_script(path, content):
+    with open(path, 'w') as f:
+        f.write(content)
+    os.chmod(path, 0o755)
+
+
+def latency_summary(timings):
+    """ Milliseconds statistics of a list of durations in seconds """
+    timings = sorted(timings)
+    return dict(
+        calls=len(timings),
+        p50_ms=round(timings[len(timings) // 2] * 1000, 3),
+        p95_ms=round(timings[min(int(len(timings) * 0.95), len(timings) - 1)] * 1000, 3),
+        mean_ms=round(statistics.mean(timings) * 1000, 3),
+    )
+
+
+def timed_call(command, env):
+    start = time.perf_counter()
+    subprocess.run(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+    return time.perf_counter() - start
+
+
+def output_throughput(work_dir, quick):
+    """ run_single_script relaying the output of a script writing hundreds of megabytes to stdout """
+    megabytes = 64 if quick else 1024
+    script = os.path.join(work_dir, 'emit.py')
+    write_script(script, EMIT_SCRIPT.format(python=sys.executable, blocks=megabytes * 1024 * 1024 // (80 * 1024)))
+
+    with open(os.devnull, 'w') as sink, contextlib.redirect_stdout(sink):
+        start = time.perf_counter()
+        runner.run_single_script(script)
+        elapsed = time.perf_counter() - start
+    return dict(megabytes=megabytes, seconds=round(elapsed, 3), mb_per_second=round(megabytes / elapsed, 1))
+
+
+def hook_scheduling(work_dir, quick):
+    """ run_scripts over a hook with many short scripts, sequentially and with concurrent backups """
+    count = 50 if quick else 500
+    scripts = []
+    for index in range(count):
+        # ten ordering groups
+        path = os.path.join(work_dir, '%02d_script_%04d.sh' % (index % 10, index))
+        write_script(path, NOOP_SCRIPT)
+        scripts.append(path)
+    scripts.sort()
+    # no throttling.json in work_dir, scripts run without a policy
+    detector = SimpleNamespace(on_error=[], path=work_dir)
+
+    results = dict(scripts=count)
+    for workers in (1, 8):
+        os.environ['BACKUPS_MAX_WORKERS'] = str(workers)
+        try:
+            with open(os.devnull, 'w') as sink, contextlib.redirect_stdout(sink):
+                start = time.perf_counter()
+                runner.run_scripts(detector, scripts, BACKUPS)
+                elapsed = time.perf_counter() - start
+        finally:
+            del os.environ['BACKUPS_MAX_WORKERS']
+        results['workers_%d_seconds' % workers] = round(elapsed, 3)
+        results['workers_%d_scripts_per_second' % workers] = round(count / elapsed, 1)
+    return results
+
+
+def python_hooks(work_dir, quick):
+    """ run_single_script over short Python scripts using the storage, with new interpreters and warm ones """
+    count = 20 if quick else 200
+    scripts = dict(cold=[], warm=[])
+    for mode, paths in scripts.items():
+        for index in range(count):
+            path = os.path.join(work_dir, '%s_%04d.py' % (mode, index))
+            write_script(path, PYTHON_HOOK_SCRIPT.format(python=sys.executable, mode=mode, index=index))
+            paths.append(path)
+
+    environment = dict(os.environ)
+    os.environ.update({'PYTHONPATH': ROOT, WARM_PYTHON_HOOKS: '1'})
+    results = dict(scripts=count)
+    with open(os.devnull, 'w') as sink, contextlib.redirect_stdout(sink):
+        # forked before the storage server starts its thread
+        start_warm_worker()
+        server = StoreServer(os.path.join(work_dir, 'store.sock'))
+        server.start()
+        os.environ[STORE_SOCKET] = server.socket_path
+        try:
+            for mode, paths in sorted(scripts.items()):
+                timings = []
+                for script in paths:
+                    start = time.perf_counter()
+                    runner.run_single_script(script)
+                    timings.append(time.perf_counter() - start)
+                results[mode] = latency_summary(timings)
+            results['stored_values'] = len(server.store.items('RESULT_'))
+        finally:
+            server.stop()
+            stop_warm_worker()
+            os.environ.clear()
+            os.environ.update(environment)
+    return results
+
+
+def _concurrent_store_calls(env, writers, calls):
+    """ Each writer increments a shared counter and reads it back, returns latencies and the final counter """
+    timings = []
+    lock = threading.Lock()
+    errors = []
+
+    def writer():
+        for _ in range(calls):
+            try:
+                store = timed_call(python_command('sidefridge.storage', 'store_var', ['-i', 'counter']), env)
+                load = timed_call(python_command('sidefridge.storage', 'load_var', ['counter']), env)
+            except subprocess.CalledProcessError as e:
+                errors.append(e)
+                continue
+            with lock:
+                timings.append(('store_var', store))
+                timings.append(('load_var', load))
+
+    threads = [threading.Thread(target=writer) for _ in range(writers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    counter = subprocess.run(
+        python_command('sidefridge.storage', 'load_var', ['counter', '0']), env=env,
+        stdout=subprocess.PIPE, universal_newlines=True
+    ).stdout.strip()
+    return timings, int(counter or 0), len(errors)
+
+
+def storage_latency(work_dir, quick):
+    """
+    store_var/load_var invocations from concurrent writers, with the log file and with the run's server.
+    The log file lives in /tmp like outside of runs, it is cleared before and after.
+    """
+    writers, calls = (4, 5) if quick else (8, 25)
+    results = dict(writers=writers, calls_per_writer=calls)
+
+    file_env = get_environment(work_dir)
+    clear_storage()
+    server = StoreServer(os.path.join(work_dir, 'store.sock'))
+    with open(os.devnull, 'w') as sink, contextlib.redirect_stdout(sink):
+        server.start()
+    try:
+        server_env = get_environment(work_dir, **{STORE_SOCKET: server.socket_path})
+        for mode, env in (('file', file_env), ('server', server_env)):
+            timings, counter, errors = _concurrent_store_calls(env, writers, calls)
+            for command in ('store_var', 'load_var'):
+                summary = latency_summary([elapsed for name, elapsed in timings if name == command])
+                results.update(('%s_%s_%s' % (mode, command, key), value) for key, value in summary.items())
+            results['%s_lost_increments' % mode] = writers * calls - counter
+            results['%s_errors' % mode] = errors
+    finally:
+        server.stop()
+        clear_storage()
+    return results
+
+
+def kubectlexec_overhead(work_dir, quick):
+    """
+    Latency of `kubectlexec true` against the fake kubectl, compared to running `true` directly. The fake kubectl
+    starts instantly, session_* only measures the hop through the session server, not the startup it saves.
+    """
+    calls = 10 if quick else 50
+    env = get_environment(work_dir, POD_NAME='benchmark-pod', TARGET_CONTAINER='benchmark-container')
+    command = python_command('sidefridge.kubectlexec', 'main', ['true'])
+    stream_command = python_command('sidefridge.kubectlexec', 'main', ['--stream', 'true'])
+
+    results = dict(calls=calls)
+    measurements = [
+        ('direct', ['/bin/sh', '-c', 'true'], env),
+        ('exec', command, env),
+        ('stream', stream_command, env),
+    ]
+    for mode, call, call_env in measurements:
+        summary = latency_summary([timed_call(call, call_env) for _ in range(calls)])
+        results.update(('%s_%s' % (mode, key), value) for key, value in summary.items())
+
+    from sidefridge.exec_session import SessionServer
+    session_server = SessionServer(os.path.join(work_dir, 'exec.sock'), 'benchmark-pod', 'benchmark-container')
+    with open(os.devnull, 'w') as sink, contextlib.redirect_stdout(sink):
+        session_server.start()
+    # the fake kubectl found first on PATH is also used by the session server
+    previous_path = os.environ['PATH']
+    os.environ['PATH'] = env['PATH']
+    try:
+        session_env = dict(env, SIDEFRIDGE_EXEC_SOCKET=session_server.socket_path)
+        summary = latency_summary([timed_call(command, session_env) for _ in range(calls)])
+        results.update(('session_%s' % key, value) for key, value in summary.items())
+    finally:
+        os.environ['PATH'] = previous_path
+        session_server.stop()
+    return results
+
+
+def codegen(work_dir, quick):
+    """ make-k8s-cfg-files over a scripts directory with thousands of scripts """
+    per_hook = 100 if quick else 1000
+    in_dir = os.path.join(work_dir, 'scripts')
+    out_dir = os.path.join(work_dir, 'k8s')
+    os.makedirs(out_dir)
+    for hook_name in sorted(SUPPORTED_DIRECTORIES):
+        os.makedirs(os.path.join(in_dir, hook_name))
+        for index in range(per_hook):
+            write_script(os.path.join(in_dir, hook_name, 'script_%04d.sh' % index), CODEGEN_SCRIPT.format(index=index))
+
+    command = python_command(
+        'sidefridge.codegen', 'main', ['benchmark', 'project', 'container', in_dir, out_dir]
+    )
+    env = get_environment(work_dir)
+    cold = timed_call(command, env)
+    # outputs are only rendered again when their inputs change
+    unchanged = [timed_call(command, env) for _ in range(3)]
+    output_bytes = sum(
+        os.path.getsize(os.path.join(out_dir, name)) for name in os.listdir(out_dir) if name.endswith('.yaml')
+    )
+    return dict(
+        scripts=per_hook * len(SUPPORTED_DIRECTORIES),
+        seconds=round(cold, 3),
+        unchanged_seconds=round(statistics.median(unchanged), 3),
+        output_bytes=output_bytes,
+    )
+
+
+BENCHMARKS = [
+    ('output_throughput', output_throughput),
+    ('hook_scheduling', hook_scheduling),
+    ('python_hooks', python_hooks),
+    ('storage_latency', storage_latency),
+    ('kubectlexec_overhead', kubectlexec_overhead),
+    ('codegen', codegen),
+]
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+            universal_newlines=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(names, quick):
+    results = dict(
+        commit=git_commit(),
+        created=datetime.datetime.now().isoformat(),
+        python=platform.python_version(),
+        platform=platform.platform(),
+        cpus=os.cpu_count(),
+        quick=quick,
+        benchmarks={},
+    )
+    for name, benchmark in BENCHMARKS:
+        if names and name not in names:
+            continue
+        work_dir = tempfile.mkdtemp(prefix='sidefridge_benchmark_')
+        try:
+            sys.stderr.write("running %s...\n" % name)
+            results['benchmarks'][name] = benchmark(work_dir, quick)
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    return results
+
+
+def compare(before_path, after_path):
+    """ Prints the ratio after/before of every numeric result present in both files """
+    with open(before_path) as f:
+        before = json.load(f)
+    with open(after_path) as f:
+        after = json.load(f)
+    print("%-50s %14s %14s %8s" % ('%s -> %s' % (before['commit'], after['commit']), 'before', 'after', 'ratio'))
+    for name, values in sorted(after['benchmarks'].items()):
+        for key, value in sorted(values.items()):
+            previous = before['benchmarks'].get(name, {}).get(key)
+            if not isinstance(value, (int, float)) or not isinstance(previous, (int, float)):
+                continue
+            ratio = '%.2fx' % (value / previous) if previous else '-'
+            print("%-50s %14s %14s %8s" % ('%s.%s' % (name, key), previous, value, ratio))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks of the sidefridge hot paths, results are JSON')
+    parser.add_argument('names', nargs='*', help='benchmarks to run, all by default: %s' % ', '.join(
+        name for name, _ in BENCHMARKS
+    ))
+    parser.add_argument('-o', '--output', default='-', help="file receiving the JSON results, default '-' (stdout)")
+    parser.add_argument('--quick', action='store_true', help='smaller workloads, for a fast sanity check')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'), help='compares two result files')
+    arguments = parser.parse_args()
+
+    if arguments.compare:
+        compare(*arguments.compare)
+        return
+
+    unknown = set(arguments.names) - set(name for name, _ in BENCHMARKS)
+    if unknown:
+        parser.error("unknown benchmarks: %s" % ', '.join(sorted(unknown)))
+
+    content = json.dumps(run(arguments.names, arguments.quick), indent=2, sort_keys=True) + '\n'
+    if arguments.output == '-':
+        sys.stdout.write(content)
+    else:
+        with open(arguments.output, 'w') as f:
+            f.write(content)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+import datetime
+import json
+import os
+import threading
+import time
+
+from sidefridge.coordination import get_int_setting, get_state_dir
+from sidefridge.utils import print_logger
+
+RUN_CHECKPOINTS = "RUN_CHECKPOINTS"
+CHECKPOINT_TTL_SECONDS = "CHECKPOINT_TTL_SECONDS"
+
+DEFAULT_TTL_SECONDS = 24 * 60 * 60
+
+CHECKPOINT_FILE = 'sidefridge_checkpoint.json'
+
+
+class Checkpoint(object):
+    """
+    Progress of a run which did not complete: the scripts which succeeded, with their SHA-256, and the content of
+    the storage. The next run resumes it, completed scripts whose content did not change are skipped and the
+    storage starts with the saved values, including progress markers stored by a script which failed half way.
+    A checkpoint older than ttl seconds is discarded, a run which completes removes it.
+    """
+
+    def __init__(self, path, ttl, store):
+        self.path = path
+        self.ttl = ttl
+        self.store = store
+        self.state = None
+        self._lock = threading.Lock()
+
+    def _new_state(self):
+        return dict(created=time.time(), scripts={}, store={})
+
+    def load(self):
+        """ Resumes the checkpoint left by an interrupted run, returns True when there was one """
+        self.state = self._new_state()
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return False
+        except ValueError as e:
+            print_logger("Discarding unreadable checkpoint '%s': %s" % (self.path, e))
+            self.discard()
+            return False
+
+        created = datetime.datetime.fromtimestamp(state['created'])
+        if time.time() - state['created'] > self.ttl:
+            print_logger("Discarding the checkpoint of the run started at %s, it expired" % created)
+            self.discard()
+            return False
+
+        self.state = state
+        self.store.update(state['store'])
+        print_logger("Resuming the run started at %s, %d script(s) were completed" % (
+            created, sum(len(scripts) for scripts in state['scripts'].values())
+        ))
+        return True
+
+    def pending(self, hook_name, scripts, scripts_detector):
+        """ Scripts of a hook which still have to run, completed ones are skipped unless they changed since """
+        completed = self.state['scripts'].get(hook_name, {})
+        pending = [
+            script for script in scripts
+            if completed.get(os.path.basename(script)) != scripts_detector.digest(script)
+        ]
+        if len(pending) < len(scripts):
+            print_logger("Skipping %d script(s) of '%s' completed by a previous run" % (
+                len(scripts) - len(pending), hook_name
+            ))
+        return pending
+
+    def complete(self, hook_name, script, digest):
+        with self._lock:
+            self.state['scripts'].setdefault(hook_name, {})[os.path.basename(script)] = digest
+            self._save()
+
+    def save(self):
+        with self._lock:
+            self._save()
+
+    def _save(self):
+        self.state['store'] = self.store.items()
+        self.state['updated'] = time.time()
+        tmp_path = '%s.%d.tmp' % (self.path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(self.state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def discard(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def is_checkpointing_enabled():
+    return os.environ.get(RUN_CHECKPOINTS, '').lower() in ('1', 'true', 'yes')
+
+
+def get_checkpoint_ttl():
+    return get_int_setting(CHECKPOINT_TTL_SECONDS, DEFAULT_TTL_SECONDS)
+
+
+def get_checkpoint(store):
+    """ The checkpoint of the run using store, None when checkpoints are disabled """
+    if not is_checkpointing_enabled():
+        return None
+    return Checkpoint(os.path.join(get_state_dir(), CHECKPOINT_FILE), get_checkpoint_ttl(), store)
@@ -1,16 +1,20 @@
 import argparse
+import base64
+import hashlib
+import json
 import os
-from collections import deque
-from jinja2 import Template
+import time
+from jinja2 import DictLoader, Environment, __version__ as jinja2_version
 
-from sidefridge.scripts import ScriptsDetector, SUPPORTED_DIRECTORIES
+from sidefridge.pipeline import gzip_compressor, parse_size
+from sidefridge.scripts import COMPRESSED_SUFFIX, ScriptsDetector, SUPPORTED_DIRECTORIES
 from sidefridge.utils import print_logger
 
 TEMPLATE_DIRECTORY_CONFIG_MAP = """
 apiVersion: v1
 kind: ConfigMap
 metadata:
-  name: {{project_name}}-{{container_name}}-config-{{hook_name}}
+  name: {{config_map_name}}
   namespace: {{namespace}}
 data:
 {% for file_name in content_data['file_names'] -%}
@@ -18,22 +22,38 @@ data:
 {% for line in content_data['file_content'][file_name] -%}
 {{ line | indent(4, True) }}
 {%- endfor %}
-{%endfor %}
+{%endfor %}{% if content_data['binary_names'] %}binaryData:
+{% for file_name in content_data['binary_names'] -%}
+{{ file_name | indent(2, True) }}: {{ content_data['binary_content'][file_name] }}
+{% endfor %}{% endif %}
 """[1:-1]  # strip first and last '\n'
 
 TEMPLATE_SERVICE_ACCOUNT_NAMES_VOLUMES_PARTIAL = """
 serviceAccountName: {{project_name}}-full-access-service-account
 volumes:
 {% for hook_name in hooks_data -%}
-  {{ ("- name: {project_name}-{container_name}-config-{hook_name}-volume".format(project_name=project_name, container_name=container_name, hook_name=hook_name)) | indent(2, True) }}
+  {{ ("- name: {project_name}-{container_name}-config-{hook_name}-volume".format(project_name=project_name, container_name=container_name, hook_name=hook_name)) | indent(2, True) }}{% if hooks_data[hook_name] | length == 1 %}{% for config_map_name, scripts in hooks_data[hook_name] %}
     configMap:
-      name: {{project_name}}-{{container_name}}-config-{{hook_name}}
+      name: {{config_map_name}}
       defaultMode: 0744
       items:
-{% for script in hooks_data[hook_name] -%}
+{% for script in scripts -%}
 {{ ("- key: %s" % script) | indent(8, True) }}
 {{ ("  path: %s" % script) | indent(8, True) }}
 {% endfor %}
+{%- endfor %}{% else %}
+    projected:
+      defaultMode: 0744
+      sources:
+{% for config_map_name, scripts in hooks_data[hook_name] -%}
+{{ "- configMap:" | indent(8, True) }}
+{{ ("    name: %s" % config_map_name) | indent(8, True) }}
+{{ "    items:" | indent(8, True) }}
+{% for script in scripts -%}
+{{ ("- key: %s" % script) | indent(14, True) }}
+{{ ("  path: %s" % script) | indent(14, True) }}
+{% endfor %}
+{%- endfor %}{% endif %}
 {%- endfor %}
 """[1:-1]  # strip first and last '\n'
 
@@ -83,35 +103,150 @@ roleRef:
 """[1:-1]  # strip first and last '\n'
 
 
-def render_template(template, values):
-    template = Template(template)
-    return template.render(**values)
+# rendered outputs and a hash of their inputs, unchanged outputs are neither rendered nor written
+MANIFEST_FILE = '.sidefridge-codegen.json'
+
+# the API server rejects objects larger than 1MiB, the margin leaves room for labels and annotations added later
+DEFAULT_MAX_CONFIG_MAP_SIZE = 900 * 1024
+
+TEMPLATES = {
+    'config_map': TEMPLATE_DIRECTORY_CONFIG_MAP,
+    'service_account_name_volumes_partial': TEMPLATE_SERVICE_ACCOUNT_NAMES_VOLUMES_PARTIAL,
+    'volume_mounts_partial': TEMPLATE_VOLUME_MOUNTS_PARTIAL,
+    'service_account_role_role_binding': TEMPLATE_SERVICE_ACCOUNT_ROLE_ROLE_BINDING,
+}
+
+_environment = None
+
+
+def get_environment():
+    """ Templates are compiled once per process and reused by every render """
+    global _environment
+    if _environment is None:
+        _environment = Environment(loader=DictLoader(TEMPLATES))
+    return _environment
+
+
+def render_template(template_name, values):
+    return get_environment().get_template(template_name).render(**values)
+
+
+def get_hooks():
+    # sets have no stable order, outputs must be identical between runs
+    return sorted(SUPPORTED_DIRECTORIES)
+
 
+class CodegenError(Exception):
+    pass
+
+
+def get_config_map_name(project_name, container_name, hook_name, shard):
+    """ The first ConfigMap of a hook keeps the unsharded name, the following ones are numbered from 2 """
+    name = '%s-%s-config-%s' % (project_name, container_name, hook_name)
+    return name if shard == 0 else '%s-%d' % (name, shard + 1)
+
+
+def render_config_map(namespace, config_map_name, entries):
+    content_data = dict(file_names=[], file_content={}, binary_names=[], binary_content={})
+    for key, content, binary_content in entries:
+        if binary_content is None:
+            content_data['file_names'].append(key)
+            content_data['file_content'][key] = content
+        else:
+            content_data['binary_names'].append(key)
+            content_data['binary_content'][key] = binary_content
 
-def render_config_map(namespace, project_name, container_name, hook_name, content_data):
     return render_template(
-        template=TEMPLATE_DIRECTORY_CONFIG_MAP,
+        template_name='config_map',
         values=dict(
+            namespace=namespace,
+            config_map_name=config_map_name,
+            content_data=content_data
+        )
+    )
+
+
+def read_script_entry(file_path, hook_name, compress_threshold):
+    """
+    ConfigMap key, text content and binary content of a script. Scripts larger than compress_threshold are
+    gzip compressed and base64 encoded, their key gets the compressed suffix.
+    """
+    key = get_script_name_from_path(file_path, hook_name)
+    if compress_threshold is None or os.path.getsize(file_path) <= compress_threshold:
+        return key, get_file_content(file_path), None
+
+    with open(file_path, 'rb') as f:
+        compressed = gzip_compressor(9)(f.read())
+    return key + COMPRESSED_SUFFIX, None, base64.b64encode(compressed).decode('ascii')
+
+
+def _rendered_size(namespace, config_map_name, entries):
+    return len(render_config_map(namespace, config_map_name, entries).encode('utf-8'))
+
+
+def split_config_maps(namespace, project_name, container_name, hook_name, entries, max_size):
+    """
+    Packs the entries of a hook in as few ConfigMaps as possible, each rendered ConfigMap fits in max_size.
+    Returns the name, the keys and the rendered yaml of each ConfigMap.
+    """
+    name = get_config_map_name(project_name, container_name, hook_name, 0)
+    rendered = render_config_map(namespace, name, entries)
+    if len(rendered.encode('utf-8')) <= max_size:
+        return [(name, [entry[0] for entry in entries], rendered)]
+
+    # sizes are measured with the longest name a shard can get, the added entries never overflow a shard
+    longest_name = get_config_map_name(project_name, container_name, hook_name, len(entries) - 1)
+    empty_size = _rendered_size(namespace, longest_name, [])
+    shards, size = [[]], empty_size
+    for entry in entries:
+        entry_size = _rendered_size(namespace, longest_name, [entry]) - empty_size
+        if shards[-1] and size + entry_size > max_size:
+            shards.append([])
+            size = empty_size
+        shards[-1].append(entry)
+        size += entry_size
+
+    result = []
+    for shard, shard_entries in enumerate(shards):
+        shard_name = get_config_map_name(project_name, container_name, hook_name, shard)
+        rendered = render_config_map(namespace, shard_name, shard_entries)
+        if len(rendered.encode('utf-8')) > max_size:
+            raise CodegenError(
+                "Script '%s' of '%s' does not fit in a ConfigMap of %d bytes, try a lower --compress-threshold" % (
+                    shard_entries[0][0], hook_name, max_size
+                )
+            )
+        result.append((shard_name, [entry[0] for entry in shard_entries], rendered))
+    return result
+
+
+def plan_config_maps(scripts_detector, namespace, project_name, container_name, max_config_map_size,
+                     compress_threshold):
+    """ ConfigMaps of every hook, see split_config_maps """
+    return {
+        hook_name: split_config_maps(
             namespace=namespace,
             project_name=project_name,
             container_name=container_name,
             hook_name=hook_name,
-            content_data=content_data
+            entries=[
+                read_script_entry(file_path, hook_name, compress_threshold)
+                for file_path in getattr(scripts_detector, hook_name, [])
+            ],
+            max_size=max_config_map_size
         )
-    )
+        for hook_name in get_hooks()
+    }
 
 
-def render_service_account_name_volumes_partial(scripts_detector, namespace, project_name, container_name):
+def render_service_account_name_volumes_partial(config_maps, namespace, project_name, container_name):
     hooks_data = dict()
 
-    for hook_name in SUPPORTED_DIRECTORIES:
-        hooks_data[hook_name] = []
-        for file_path in getattr(scripts_detector, hook_name, []):
-            key = get_script_name_from_path(file_path, hook_name)
-            hooks_data[hook_name].append(key)
+    for hook_name in get_hooks():
+        hooks_data[hook_name] = [(config_map_name, keys) for config_map_name, keys, _ in config_maps[hook_name]]
 
     return render_template(
-        template=TEMPLATE_SERVICE_ACCOUNT_NAMES_VOLUMES_PARTIAL,
+        template_name='service_account_name_volumes_partial',
         values=dict(
             namespace=namespace,
             project_name=project_name,
@@ -124,12 +259,12 @@ def render_service_account_name_volumes_partial(scripts_detector, namespace, pro
 def render_volume_mounts_partial(namespace, project_name, container_name, container_scripts_path):
     content_data = []
 
-    for hook_name in SUPPORTED_DIRECTORIES:
+    for hook_name in get_hooks():
         script_path = os.path.join(container_scripts_path, hook_name)
         content_data.append((script_path, hook_name))
 
     return render_template(
-        template=TEMPLATE_VOLUME_MOUNTS_PARTIAL,
+        template_name='volume_mounts_partial',
         values=dict(
             namespace=namespace,
             project_name=project_name,
@@ -140,88 +275,350 @@ def render_volume_mounts_partial(namespace, project_name, container_name, contai
 
 
 def get_file_content(file_path):
-    file_content = deque()
     with open(file_path, 'r') as f:
-        for line in f:
-            file_content.append(line)
-
-    return file_content
+        return f.read().splitlines(True)
 
 
 def get_script_name_from_path(file_path, hook_name):
     return file_path.split(hook_name)[-1][1:]
 
 
-def generate_config_map_for_hook(scripts_detector, namespace, project_name, container_name, hook_name):
-    content_data = dict(file_names=[], file_content={})
-    for file_path in getattr(scripts_detector, hook_name, []):
-        key = get_script_name_from_path(file_path, hook_name)
-        content_data['file_names'].append(key)
-        content_data['file_content'][key] = get_file_content(file_path)
+def get_scripts_inputs(scripts_detector):
+    """ Script names and digests of every hook, what the outputs depend on besides the arguments """
+    return {
+        hook_name: [
+            (get_script_name_from_path(file_path, hook_name), scripts_detector.digest(file_path))
+            for file_path in getattr(scripts_detector, hook_name, [])
+        ]
+        for hook_name in get_hooks()
+    }
+
+
+class OutputWriter(object):
+    """
+    Writes outputs to a directory keeping a manifest of the hash of their inputs. An output whose inputs and
+    content on disk did not change since the previous run is not rendered, a rendered output identical to the
+    file on disk is not written. Files are replaced atomically.
+    """
+
+    def __init__(self, output_path):
+        self.output_path = output_path
+        self.manifest_path = os.path.join(output_path, MANIFEST_FILE)
+        try:
+            with open(self.manifest_path) as f:
+                self.manifest = json.load(f)
+        except (FileNotFoundError, ValueError):
+            self.manifest = {}
+        self._manifest_changed = False
+        self.written = []
+
+    @staticmethod
+    def _hash(data):
+        return hashlib.sha256(data).hexdigest()
+
+    def _file_hash(self, path):
+        try:
+            with open(path, 'rb') as f:
+                return self._hash(f.read())
+        except FileNotFoundError:
+            return None
+
+    def write(self, file_name, inputs, render):
+        """ Renders and writes file_name unless inputs are the same as last time, render returns the content """
+        path = os.path.join(self.output_path, file_name)
+        inputs_hash = self._hash(json.dumps([jinja2_version, inputs], sort_keys=True).encode('utf-8'))
+        entry = self.manifest.get(file_name, {})
+        current_hash = self._file_hash(path)
+        if entry.get('inputs') == inputs_hash and current_hash is not None and entry.get('output') == current_hash:
+            return False
+
+        content = render().encode('utf-8')
+        output_hash = self._hash(content)
+        written = output_hash != current_hash
+        if written:
+            self._write_atomically(path, content)
+            self.written.append(file_name)
+        self.manifest[file_name] = dict(inputs=inputs_hash, output=output_hash)
+        self._manifest_changed = True
+        return written
+
+    @staticmethod
+    def _write_atomically(path, content):
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+
+    def close(self):
+        if self._manifest_changed:
+            self._write_atomically(self.manifest_path, json.dumps(self.manifest, indent=2, sort_keys=True).encode())
+
+
+def assemble_config_yaml(get_config_maps, scripts_inputs, namespace, project_name, container_name, writer):
+    def render():
+        config_maps = get_config_maps()
+        return "---\n".join(
+            rendered for hook_name in get_hooks() for _, _, rendered in config_maps[hook_name]
+        )
 
-    rendered_template = render_config_map(
-        namespace=namespace,
-        project_name=project_name,
-        container_name=container_name,
-        hook_name=hook_name,
-        content_data=content_data
+    inputs = dict(
+        template=TEMPLATE_DIRECTORY_CONFIG_MAP, namespace=namespace, project_name=project_name,
+        container_name=container_name, scripts=scripts_inputs
     )
-    return rendered_template
-
+    writer.write('%s-config-maps.yaml' % project_name, inputs, render)
 
-def assemble_config_yaml(scripts_detector, namespace, project_name, container_name, output_path):
-    results = []
 
-    for hook_name in SUPPORTED_DIRECTORIES:
-        hook_config_yaml = generate_config_map_for_hook(
-            scripts_detector=scripts_detector,
+def assemble_service_account_name_volumes_partial(get_config_maps, scripts_inputs, namespace, project_name,
+                                                  container_name, writer):
+    # the sizes of the scripts decide how they are split, the partial depends on their content too
+    inputs = dict(
+        template=TEMPLATE_SERVICE_ACCOUNT_NAMES_VOLUMES_PARTIAL, namespace=namespace, project_name=project_name,
+        container_name=container_name, scripts=scripts_inputs
+    )
+    writer.write(
+        '%s-partial_service_account_name_volumes.yaml' % project_name, inputs,
+        lambda: render_service_account_name_volumes_partial(
+            config_maps=get_config_maps(),
             namespace=namespace,
             project_name=project_name,
-            container_name=container_name,
-            hook_name=hook_name
+            container_name=container_name
         )
-        results.append(hook_config_yaml)
+    )
 
-    file_content = "---\n".join(results)
 
-    with open(os.path.join(output_path, '%s-config-maps.yaml' % project_name), 'w') as f:
-        f.write(file_content)
+def assemble_volume_mounts_partial(namespace, project_name, container_name, writer, container_scripts_path):
+    inputs = dict(
+        template=TEMPLATE_VOLUME_MOUNTS_PARTIAL, namespace=namespace, project_name=project_name,
+        container_name=container_name, container_scripts_path=container_scripts_path, hooks=get_hooks()
+    )
+    writer.write(
+        '%s-partial_volume_mounts.yaml' % project_name, inputs,
+        lambda: render_volume_mounts_partial(
+            namespace=namespace,
+            project_name=project_name,
+            container_name=container_name,
+            container_scripts_path=container_scripts_path
+        )
+    )
 
 
-def assemble_service_account_name_volumes_partial(scripts_detector, namespace, project_name, container_name, output_path):
-    rendered_yaml = render_service_account_name_volumes_partial(
-        scripts_detector=scripts_detector,
+def assemble_service_account_role_role_binding(namespace, project_name, writer):
+    values = dict(
         namespace=namespace,
         project_name=project_name,
-        container_name=container_name
+    )
+    inputs = dict(template=TEMPLATE_SERVICE_ACCOUNT_ROLE_ROLE_BINDING, **values)
+    writer.write(
+        '%s-accounts.yaml' % project_name, inputs,
+        lambda: render_template(template_name='service_account_role_role_binding', values=values)
     )
 
-    with open(os.path.join(output_path, '%s-partial_service_account_name_volumes.yaml' % project_name), 'w') as f:
-        f.write(rendered_yaml)
 
+def generate_project(namespace, project_name, container_name, in_dir, out_dir, container_scripts_path,
+                     max_config_map_size=DEFAULT_MAX_CONFIG_MAP_SIZE, compress_threshold=None):
+    """ Generates the configurations of a project, returns the names of the files which were written """
+    scripts_detector = ScriptsDetector(in_dir)
+    writer = OutputWriter(out_dir)
+    scripts_inputs = dict(
+        scripts=get_scripts_inputs(scripts_detector),
+        max_config_map_size=max_config_map_size,
+        compress_threshold=compress_threshold,
+    )
 
-def assemble_volume_mounts_partial(namespace, project_name, container_name, output_path, container_scripts_path):
-    rendered_yaml = render_volume_mounts_partial(
+    # both the ConfigMaps and the volumes depend on how scripts are split, it is computed once when needed
+    config_maps = []
+
+    def get_config_maps():
+        if not config_maps:
+            config_maps.append(plan_config_maps(
+                scripts_detector, namespace, project_name, container_name, max_config_map_size, compress_threshold
+            ))
+        return config_maps[0]
+
+    assemble_config_yaml(
+        get_config_maps=get_config_maps,
+        scripts_inputs=scripts_inputs,
         namespace=namespace,
         project_name=project_name,
         container_name=container_name,
-        container_scripts_path=container_scripts_path
+        writer=writer
     )
 
-    with open(os.path.join(output_path, '%s-partial_volume_mounts.yaml' % project_name), 'w') as f:
-        f.write(rendered_yaml)
+    assemble_service_account_name_volumes_partial(
+        get_config_maps=get_config_maps,
+        scripts_inputs=scripts_inputs,
+        namespace=namespace,
+        project_name=project_name,
+        container_name=container_name,
+        writer=writer
+    )
 
+    assemble_volume_mounts_partial(
+        namespace=namespace,
+        project_name=project_name,
+        container_name=container_name,
+        writer=writer,
+        container_scripts_path=container_scripts_path
+    )
 
-def assemble_service_account_role_role_binding(namespace, project_name, output_path):
-    rendered_yaml = render_template(
-        template=TEMPLATE_SERVICE_ACCOUNT_ROLE_ROLE_BINDING,
-        values=dict(
-            namespace=namespace,
-            project_name=project_name,
-        )
+    assemble_service_account_role_role_binding(
+        namespace=namespace,
+        project_name=project_name,
+        writer=writer
     )
-    with open(os.path.join(output_path, '%s-accounts.yaml' % project_name), 'w') as f:
-        f.write(rendered_yaml)
+
+    writer.close()
+    return writer.written
+
+
+class BatchManifestError(Exception):
+    pass
+
+
+PROJECT_FIELDS = ('namespace', 'project_name', 'container_name', 'in_dir', 'out_dir')
+SIZE_FIELDS = ('max_config_map_size', 'compress_threshold')
+
+
+def parse_manifest_size(value):
+    """ Sizes of a manifest are a positive number of bytes or a size like `512K` """
+    if isinstance(value, str):
+        return parse_size(value)
+    # bool is a subclass of int, `true` is not a size
+    if not isinstance(value, int) or isinstance(value, bool):
+        raise argparse.ArgumentTypeError("expected a number of bytes or a size like '512K', got %r" % (value,))
+    if value <= 0:
+        raise argparse.ArgumentTypeError("size must be positive")
+    return value
+
+
+def load_batch_manifest(manifest_path):
+    """
+    Projects listed in a JSON or YAML manifest, either a list or a mapping with a `projects` list. Each project
+    has namespace, project_name, container_name, in_dir, out_dir and optionally container_scripts_path,
+    max_config_map_size and compress_threshold. Relative directories are relative to the manifest.
+    """
+    with open(manifest_path) as f:
+        content = f.read()
+    if manifest_path.endswith(('.yaml', '.yml')):
+        try:
+            import yaml
+        except ImportError:
+            raise BatchManifestError("YAML manifests require the 'PyYAML' package, install it with pip")
+        data = yaml.safe_load(content)
+    else:
+        try:
+            data = json.loads(content)
+        except ValueError as e:
+            raise BatchManifestError("Could not parse '%s': %s" % (manifest_path, e))
+
+    projects = data.get('projects') if isinstance(data, dict) else data
+    if not isinstance(projects, list):
+        raise BatchManifestError("'%s' must contain a list of projects" % manifest_path)
+
+    base_dir = os.path.dirname(os.path.abspath(manifest_path))
+    result = []
+    outputs = {}
+    for index, project in enumerate(projects):
+        missing = [field for field in PROJECT_FIELDS if not isinstance(project, dict) or field not in project]
+        if missing:
+            raise BatchManifestError("Project %d of '%s' is missing %s" % (index, manifest_path, ', '.join(missing)))
+        project = dict(project)
+        project.setdefault('container_scripts_path', '/scripts')
+        for field in SIZE_FIELDS:
+            if field in project:
+                try:
+                    project[field] = parse_manifest_size(project[field])
+                except argparse.ArgumentTypeError as e:
+                    raise BatchManifestError("Project %d of '%s' has an invalid %s: %s" % (
+                        index, manifest_path, field, e
+                    ))
+        for field in ('in_dir', 'out_dir'):
+            project[field] = os.path.join(base_dir, project[field])
+        # output files are named after the project, the same name twice in a directory overwrites the first
+        output = (os.path.realpath(project['out_dir']), project['project_name'])
+        if output in outputs:
+            raise BatchManifestError("Projects %d and %d of '%s' both write '%s' in '%s'" % (
+                outputs[output], index, manifest_path, project['project_name'], project['out_dir']
+            ))
+        outputs[output] = index
+        result.append(project)
+    return result
+
+
+def compile_templates():
+    """ Compiles every template, processes forked afterwards share them """
+    for template_name in TEMPLATES:
+        get_environment().get_template(template_name)
+
+
+def generate_projects(projects):
+    """ Generates projects one after the other, returns project name, written files, seconds and error of each """
+    results = []
+    for project in projects:
+        start = time.monotonic()
+        try:
+            for field in ('in_dir', 'out_dir'):
+                if not os.path.isdir(project[field]):
+                    raise BatchManifestError("The following path '%s' is not a valid directory" % project[field])
+            written, error = generate_project(**{key: project[key] for key in PROJECT_FIELDS + SIZE_FIELDS + (
+                'container_scripts_path',
+            ) if key in project}), None
+        except (BatchManifestError, CodegenError, OSError) as e:
+            written, error = [], str(e)
+        results.append((project['project_name'], written, time.monotonic() - start, error))
+    return results
+
+
+def generate_batch(projects, jobs):
+    """
+    Generates many projects in a pool of processes. Projects sharing an output directory share its manifest,
+    they are generated by the same task one after the other. Returns the results in manifest order.
+    """
+    tasks = {}
+    for index, project in enumerate(projects):
+        tasks.setdefault(os.path.realpath(project['out_dir']), []).append((index, project))
+    # results come back in task order, the manifest index of each is kept aside as project names may repeat
+    indexes = [index for task in tasks.values() for index, _ in task]
+    tasks = [[project for _, project in task] for task in tasks.values()]
+
+    compile_templates()
+    if jobs <= 1 or len(tasks) <= 1:
+        results = [result for task in tasks for result in generate_projects(task)]
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            chunk_size = max(len(tasks) // (jobs * 4), 1)
+            task_results = executor.map(generate_projects, tasks, chunksize=chunk_size)
+            results = [result for results_of_task in task_results for result in results_of_task]
+
+    return [result for _, result in sorted(zip(indexes, results), key=lambda item: item[0])]
+
+
+def batch_main(manifest_path, jobs, sizes):
+    start = time.monotonic()
+    try:
+        projects = load_batch_manifest(manifest_path)
+    except (BatchManifestError, OSError) as e:
+        print_logger(e)
+        exit(1)
+    for project in projects:
+        for field, size in sizes.items():
+            project.setdefault(field, size)
+
+    failed = 0
+    for project_name, written, seconds, error in generate_batch(projects, jobs):
+        if error is not None:
+            failed += 1
+            print_logger("Project '%s' failed after %.3fs: %s" % (project_name, seconds, error))
+        else:
+            print_logger("Project '%s' generated in %.3fs, updated %d file(s)" % (project_name, seconds, len(written)))
+
+    print_logger("Generated %d project(s) in %.3fs with %d job(s), %d failed" % (
+        len(projects), time.monotonic() - start, jobs, failed
+    ))
+    if failed:
+        exit(1)
 
 
 def main():
@@ -231,32 +628,60 @@ def main():
         description='Tool for running and initializing backup container'
     )
     parser.add_argument(
-        'namespace', type=str,
+        'namespace', type=str, nargs='?',
         help='the k8s namespace'
     )
     parser.add_argument(
-        'project_name', type=str,
+        'project_name', type=str, nargs='?',
         help='the current project name'
     )
     parser.add_argument(
-        'container_name', type=str,
+        'container_name', type=str, nargs='?',
         help='container name where volumeMounts and volumes are to be used'
     )
     parser.add_argument(
-        'in_dir', type=str,
+        'in_dir', type=str, nargs='?',
         help='path to your directory containing the hooks'
     )
     parser.add_argument(
-        'out_dir', type=str,
+        'out_dir', type=str, nargs='?',
         help='directory for k8s configuration file output'
     )
     parser.add_argument(
         '-csp', '--container-scripts-path', default='/scripts',
         help='path to scripts folder inside the container, default /scripts'
     )
+    parser.add_argument(
+        '--max-config-map-size', type=parse_size, default=DEFAULT_MAX_CONFIG_MAP_SIZE, metavar='SIZE',
+        help='hooks whose ConfigMap would be larger are split across several ConfigMaps, default 900K'
+    )
+    parser.add_argument(
+        '--compress-threshold', type=parse_size, metavar='SIZE',
+        help='scripts larger than SIZE are stored gzip compressed in binaryData, by default nothing is compressed'
+    )
+    parser.add_argument(
+        '-b', '--batch', metavar='MANIFEST',
+        help='generates all projects listed in a JSON or YAML manifest instead of a single one'
+    )
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=os.cpu_count() or 1,
+        help='with --batch, number of processes generating projects, defaults to the number of CPUs'
+    )
 
     arguments = parser.parse_args()
 
+    if arguments.batch:
+        if arguments.namespace is not None:
+            parser.error("no positional arguments can be provided with --batch")
+        batch_main(arguments.batch, max(arguments.jobs, 1), dict(
+            max_config_map_size=arguments.max_config_map_size,
+            compress_threshold=arguments.compress_threshold,
+        ))
+        return
+
+    if arguments.out_dir is None:
+        parser.error("the following arguments are required: namespace, project_name, container_name, in_dir, out_dir")
+
     # check if provided directory exists
     if not os.path.isdir(arguments.in_dir):
         print_logger("The following path '%s' is not a valid directory" % arguments.in_dir)
@@ -267,39 +692,22 @@ def main():
         print_logger("The following path '%s' is not a valid directory" % arguments.out_dir)
         exit(1)
 
-    scripts_detector = ScriptsDetector(arguments.in_dir)
-
-    # store yaml files in output directory
-
-    assemble_config_yaml(
-        scripts_detector=scripts_detector,
-        namespace=arguments.namespace,
-        project_name=arguments.project_name,
-        container_name=arguments.container_name,
-        output_path=arguments.out_dir
-    )
-
-    assemble_service_account_name_volumes_partial(
-        scripts_detector=scripts_detector,
-        namespace=arguments.namespace,
-        project_name=arguments.project_name,
-        container_name=arguments.container_name,
-        output_path=arguments.out_dir
-    )
-
-    assemble_volume_mounts_partial(
-        namespace=arguments.namespace,
-        project_name=arguments.project_name,
-        container_name=arguments.container_name,
-        output_path=arguments.out_dir,
-        container_scripts_path=arguments.container_scripts_path
-    )
-
-    assemble_service_account_role_role_binding(
-        namespace=arguments.namespace,
-        project_name=arguments.project_name,
-        output_path=arguments.out_dir
-    )
+    # store yaml files in output directory, unchanged files are left untouched
+    try:
+        written = generate_project(
+            namespace=arguments.namespace,
+            project_name=arguments.project_name,
+            container_name=arguments.container_name,
+            in_dir=arguments.in_dir,
+            out_dir=arguments.out_dir,
+            container_scripts_path=arguments.container_scripts_path,
+            max_config_map_size=arguments.max_config_map_size,
+            compress_threshold=arguments.compress_threshold
+        )
+    except CodegenError as e:
+        print_logger(e)
+        exit(1)
+    print_logger("Updated %d file(s) in '%s' %s" % (len(written), arguments.out_dir, written))
 
 
 if __name__ == '__main__':
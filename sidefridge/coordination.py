@@ -0,0 +1,217 @@
+import datetime
+import fcntl
+import hashlib
+import json
+import os
+import socket
+from contextlib import contextmanager
+
+from sidefridge.kubectlexec import POD_NAME
+from sidefridge.utils import print_logger
+
+RUN_OVERLAP_POLICY = "RUN_OVERLAP_POLICY"
+MISSED_RUN_POLICY = "MISSED_RUN_POLICY"
+RUN_STATE_DIR = "RUN_STATE_DIR"
+SCHEDULE_SPREAD_SECONDS = "SCHEDULE_SPREAD_SECONDS"
+
+OVERLAP_SKIP = 'skip'
+OVERLAP_QUEUE = 'queue'
+OVERLAP_COALESCE = 'coalesce'
+OVERLAP_POLICIES = {OVERLAP_SKIP, OVERLAP_QUEUE, OVERLAP_COALESCE}
+
+MISSED_IGNORE = 'ignore'
+MISSED_COALESCE = 'coalesce'
+MISSED_CATCH_UP = 'catch_up'
+MISSED_POLICIES = {MISSED_IGNORE, MISSED_COALESCE, MISSED_CATCH_UP}
+
+# upper bound of runs replayed by the catch_up policy, avoids replaying days of minute schedules
+MAX_CATCH_UP_RUNS = 24
+
+# fire times looked at to find the shortest interval of a schedule, `0 1,2 * * *` has both 1h and 23h intervals
+SPREAD_INTERVAL_SAMPLES = 8
+
+LOCK_FILE = 'sidefridge_run.lock'
+QUEUE_LOCK_FILE = 'sidefridge_run_queue.lock'
+STATE_FILE = 'sidefridge_run_state.json'
+
+
+class InvalidCoordinationSettings(Exception):
+    pass
+
+
+def _get_policy(env_name, default, policies):
+    policy = os.environ.get(env_name, default).lower()
+    if policy not in policies:
+        raise InvalidCoordinationSettings("'%s' must be one of %s, got '%s'" % (env_name, sorted(policies), policy))
+    return policy
+
+
+def get_overlap_policy():
+    return _get_policy(RUN_OVERLAP_POLICY, OVERLAP_SKIP, OVERLAP_POLICIES)
+
+
+def get_missed_run_policy():
+    return _get_policy(MISSED_RUN_POLICY, MISSED_IGNORE, MISSED_POLICIES)
+
+
+def get_state_dir():
+    return os.environ.get(RUN_STATE_DIR, '/tmp')
+
+
+def warn_if_state_not_persistent(settings):
+    """ The default /tmp of RUN_STATE_DIR is lost when the pod restarts, with it the state the settings rely on """
+    if settings and RUN_STATE_DIR not in os.environ:
+        print_logger(
+            "WARNING: %s keep their state in '%s' which is lost when the pod restarts, mount a persistent volume "
+            "and set %s to its path" % (', '.join(settings), get_state_dir(), RUN_STATE_DIR)
+        )
+
+
+def get_int_setting(env_name, default):
+    value = os.environ.get(env_name, str(default))
+    try:
+        seconds = int(value)
+    except ValueError:
+        seconds = -1
+    if seconds < 0:
+        raise InvalidCoordinationSettings("'%s' must be a non negative integer, got '%s'" % (env_name, value))
+    return seconds
+
+
+def get_schedule_spread():
+    return get_int_setting(SCHEDULE_SPREAD_SECONDS, 0)
+
+
+def get_pod_identity():
+    """ Name of the pod, the hostname of a pod is its name when POD_NAME is not exposed """
+    return os.environ.get(POD_NAME) or socket.gethostname()
+
+
+def schedule_offset(cron_schedule, identity, spread_seconds, now=None):
+    """
+    Seconds a pod delays every scheduled run. Derived from a hash of its identity, the offset is the same across
+    restarts and pods are spread evenly over the window. The window is capped to the shortest interval of the
+    schedule, a delayed run always starts before the following fire time.
+    """
+    if spread_seconds <= 0:
+        return 0
+
+    from croniter import croniter
+
+    schedule = croniter(cron_schedule, now or datetime.datetime.now())
+    fire_times = [schedule.get_next(datetime.datetime) for _ in range(SPREAD_INTERVAL_SAMPLES)]
+    interval = min((after - before).total_seconds() for before, after in zip(fire_times, fire_times[1:]))
+    window = int(min(spread_seconds, interval))
+    if window <= 0:
+        return 0
+    digest = hashlib.sha256(identity.encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') % window
+
+
+def current_fire_time(cron_schedule, now=None):
+    """ The most recent time the schedule fired, a run started by crond belongs to it """
+    from croniter import croniter
+
+    now = now or datetime.datetime.now()
+    # croniter excludes the start time, a run started exactly on time must still match it
+    return croniter(cron_schedule, now + datetime.timedelta(seconds=1)).get_prev(datetime.datetime)
+
+
+def missed_fire_times(cron_schedule, last_fire_time, now=None):
+    """
+    Fire times after last_fire_time which are already due, at most the latest MAX_CATCH_UP_RUNS.
+    The schedule is walked backwards from now, a last_fire_time months old costs no more than a recent one.
+    """
+    from croniter import croniter
+
+    now = now or datetime.datetime.now()
+    # croniter excludes the start time, a fire time equal to now is due
+    schedule = croniter(cron_schedule, now + datetime.timedelta(seconds=1))
+    missed = []
+    while len(missed) < MAX_CATCH_UP_RUNS:
+        fire_time = schedule.get_prev(datetime.datetime)
+        if fire_time > now:
+            continue
+        if fire_time <= last_fire_time:
+            break
+        missed.append(fire_time)
+    missed.reverse()
+    return missed
+
+
+def select_due_fire_times(missed, policy):
+    if not missed or policy == MISSED_IGNORE:
+        return []
+    if policy == MISSED_COALESCE:
+        return missed[-1:]
+    return missed
+
+
+def _try_lock(lock_file):
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        return False
+    return True
+
+
+class RunCoordinator(object):
+    """
+    Makes sure only one run uses the shared storage at a time, across processes.
+    Depending on the overlap policy a run started while another one is in progress is skipped,
+    queued or coalesced with other waiting runs so that at most one run is waiting.
+    Also records the last fire time a run was completed for.
+    """
+
+    def __init__(self, state_dir, overlap_policy=OVERLAP_SKIP):
+        self.overlap_policy = overlap_policy
+        self.lock_path = os.path.join(state_dir, LOCK_FILE)
+        self.queue_lock_path = os.path.join(state_dir, QUEUE_LOCK_FILE)
+        self.state_path = os.path.join(state_dir, STATE_FILE)
+
+    def _acquire(self, lock_file):
+        if _try_lock(lock_file):
+            return True
+
+        if self.overlap_policy == OVERLAP_SKIP:
+            return False
+
+        if self.overlap_policy == OVERLAP_QUEUE:
+            print_logger("Another run is in progress, waiting for it to finish")
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            return True
+
+        # coalesce: only the first waiting run gets the queue slot, the slot is freed once it starts
+        with open(self.queue_lock_path, 'a') as queue_file:
+            if not _try_lock(queue_file):
+                return False
+            print_logger("Another run is in progress, waiting for it to finish")
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            return True
+
+    @contextmanager
+    def acquire(self):
+        """ Yields True if the caller may run, False if the run must be skipped """
+        with open(self.lock_path, 'a') as lock_file:
+            acquired = self._acquire(lock_file)
+            try:
+                yield acquired
+            finally:
+                if acquired:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def load_last_fire_time(self):
+        try:
+            with open(self.state_path) as f:
+                state = json.load(f)
+        except (IOError, ValueError):
+            return None
+
+        last_fire_time = state.get('last_fire_time')
+        return datetime.datetime.fromisoformat(last_fire_time) if last_fire_time else None
+
+    def record_fire_time(self, fire_time):
+        tmp_path = self.state_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(dict(last_fire_time=fire_time.isoformat()), f)
+        os.replace(tmp_path, self.state_path)
@@ -0,0 +1,101 @@
+import datetime
+import signal
+import threading
+
+from sidefridge.coordination import MISSED_IGNORE, missed_fire_times, select_due_fire_times
+from sidefridge.utils import print_logger
+
+
+class Scheduler(object):
+    """
+    Runs a callable each time the cron schedule fires, sleeping in between. The callable receives the fire time.
+    Fire times missed since last_fire_time (restarts, runs longer than the interval) are handled
+    as the missed run policy requires.
+    Each run starts offset seconds after its fire time, the fire time passed to the callable is unchanged.
+    SIGTERM and SIGINT stop the scheduler: immediately if idle, after the current run otherwise. During a run
+    on_stop is called, it stops the running scripts so the run fails and handles its error before the pod is killed.
+    """
+
+    def __init__(self, cron_schedule, run, last_fire_time=None, missed_run_policy=MISSED_IGNORE, offset=0,
+                 on_stop=None):
+        self.cron_schedule = cron_schedule
+        self.run = run
+        self.last_fire_time = last_fire_time
+        self.missed_run_policy = missed_run_policy
+        self.offset = datetime.timedelta(seconds=offset)
+        self.on_stop = on_stop
+        self.stop_event = threading.Event()
+        self.running = False
+
+    def next_fire_time(self, now=None):
+        from croniter import croniter
+
+        # a fire time whose delayed start is still ahead is the next one
+        now = (now or datetime.datetime.now()) - self.offset
+        return croniter(self.cron_schedule, now).get_next(datetime.datetime)
+
+    def due_fire_times(self):
+        if self.last_fire_time is None:
+            return []
+        missed = missed_fire_times(self.cron_schedule, self.last_fire_time, datetime.datetime.now() - self.offset)
+        due = select_due_fire_times(missed, self.missed_run_policy)
+        if missed:
+            print_logger("Missed %d scheduled run(s), %d will be run now" % (len(missed), len(due)))
+        return due
+
+    def _handle_signal(self, signum, frame):
+        if self.stop_event.is_set():
+            # second signal, do not wait for the current run to complete
+            raise SystemExit(128 + signum)
+
+        self.stop_event.set()
+        if self.running:
+            print_logger("Received signal %s, stopping the running scripts and exiting after the run" % signum)
+            if self.on_stop is not None:
+                self.on_stop()
+        else:
+            print_logger("Received signal %s, stopping" % signum)
+
+    def install_signal_handlers(self):
+        signal.signal(signal.SIGTERM, self._handle_signal)
+        signal.signal(signal.SIGINT, self._handle_signal)
+
+    def sleep_until(self, fire_time):
+        """ Returns True if fire_time was reached, False if the scheduler was stopped """
+        while not self.stop_event.is_set():
+            remaining = (fire_time - datetime.datetime.now()).total_seconds()
+            if remaining <= 0:
+                return True
+            self.stop_event.wait(remaining)
+        return False
+
+    def run_once(self, fire_time):
+        self.running = True
+        try:
+            self.run(fire_time)
+        except Exception as e:
+            # a broken run must not take down the scheduler, the next tick gets a fresh start
+            print_logger("Run failed: %s" % e)
+        finally:
+            self.running = False
+            self.last_fire_time = fire_time
+
+    def serve_forever(self):
+        while not self.stop_event.is_set():
+            due = self.due_fire_times()
+            for fire_time in due:
+                if self.stop_event.is_set():
+                    break
+                print_logger("Catching up run scheduled at %s" % fire_time)
+                self.run_once(fire_time)
+            if due:
+                continue
+
+            fire_time = self.next_fire_time()
+            if self.offset:
+                print_logger("Next run scheduled at %s, starting at %s" % (fire_time, fire_time + self.offset))
+            else:
+                print_logger("Next run scheduled at %s" % fire_time)
+            if not self.sleep_until(fire_time + self.offset):
+                break
+            self.run_once(fire_time)
@@ -0,0 +1,303 @@
+import argparse
+import datetime
+import fcntl
+import hashlib
+import json
+import os
+import sys
+import zlib
+from contextlib import contextmanager
+
+from sidefridge.pipeline import parse_size
+
+CHUNKS_DIRECTORY = 'chunks'
+MANIFESTS_DIRECTORY = 'manifests'
+LOCK_FILE = '.lock'
+
+
+def _pseudo_random_bytes(count, salt):
+    """ Stable pseudo random bytes, chunk boundaries must not change between versions """
+    return bytes(hashlib.sha256(b'%s-%d' % (salt, index)).digest()[0] for index in range(count))
+
+
+# offsets of the preceding bytes mixed into each position, a cut depends on the last MIX_SPAN bytes
+MIX_TAPS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55)
+MIX_SPAN = MIX_TAPS[-1]
+MIX_TABLES = [_pseudo_random_bytes(256, b'tap-%d' % tap) for tap in MIX_TAPS]
+
+# bytes mixed at a time while looking for a cut, most cuts are found well before max_size
+SEGMENT = 256 * 1024
+
+# translation table turning a mixed byte into a b'0' or b'1' character
+BIT_TABLE = bytes(ord('1') if value & 1 else ord('0') for value in range(256))
+
+
+def mix(data):
+    """
+    Returns bytes where each position is the XOR of pseudo random values of the bytes at MIX_TAPS before it.
+    Big integer shifts and XOR work on the whole buffer at once, no Python code runs per byte.
+    """
+    mixed = 0
+    for tap, table in zip(MIX_TAPS, MIX_TABLES):
+        mixed ^= int.from_bytes(data.translate(table), 'little') << (8 * tap)
+    return mixed.to_bytes(len(data) + MIX_SPAN + 1, 'little')[:len(data)]
+
+
+class DedupError(Exception):
+    pass
+
+
+class Chunker(object):
+    """
+    Content defined chunking: positions are mixed with the bytes before them and turned into pseudo random
+    bits, a cut is placed after the first run of bits matching a fixed pattern. A cut only depends on the
+    bytes right before it, so an insertion only changes the chunks around it.
+    """
+
+    def __init__(self, min_size, avg_size, max_size):
+        if not min_size < avg_size < max_size:
+            raise DedupError("chunk sizes must satisfy min < avg < max")
+        # a pattern of n bits matches on average every 2 ** n bytes
+        pattern_length = (avg_size - min_size).bit_length() - 1
+        self.pattern = _pseudo_random_bytes(pattern_length, b'pattern').translate(BIT_TABLE)
+        self.min_size = max(min_size, pattern_length + MIX_SPAN)
+        self.max_size = max_size
+
+    def find_cut(self, buffer):
+        """ Length of the next chunk at the beginning of buffer """
+        end = min(len(buffer), self.max_size)
+        if end <= self.min_size:
+            return end
+
+        # the first MIX_SPAN bytes of each segment only provide history for the mixing
+        overlap = len(self.pattern) + MIX_SPAN
+        start = self.min_size - overlap
+        while True:
+            segment_end = min(start + SEGMENT, end)
+            bits = mix(bytes(buffer[start:segment_end])).translate(BIT_TABLE)
+            index = bits.find(self.pattern, MIX_SPAN)
+            if index >= 0:
+                return start + index + len(self.pattern)
+            if segment_end == end:
+                return end
+            start = segment_end - overlap
+
+    def split(self, stream):
+        """ Yields the chunks of a binary stream, holds at most max_size bytes in memory """
+        buffer = bytearray()
+        eof = False
+        while True:
+            while not eof and len(buffer) < self.max_size:
+                data = stream.read(self.max_size - len(buffer))
+                if data:
+                    buffer += data
+                else:
+                    eof = True
+            if not buffer:
+                return
+            cut = self.find_cut(buffer)
+            chunk = bytes(buffer[:cut])
+            del buffer[:cut]
+            yield chunk
+
+
+class ChunkStore(object):
+    """
+    Directory holding compressed chunks addressed by their SHA-256 and one manifest per stored stream.
+    Storing holds a shared lock and garbage collection an exclusive one, so chunks are never removed
+    while a stream which might reference them is being stored.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.chunks_path = os.path.join(path, CHUNKS_DIRECTORY)
+        self.manifests_path = os.path.join(path, MANIFESTS_DIRECTORY)
+        os.makedirs(self.chunks_path, exist_ok=True)
+        os.makedirs(self.manifests_path, exist_ok=True)
+
+    @contextmanager
+    def locked(self, exclusive):
+        with open(os.path.join(self.path, LOCK_FILE), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def chunk_path(self, digest):
+        return os.path.join(self.chunks_path, digest[:2], digest)
+
+    def manifest_path(self, name):
+        if os.sep in name or name.startswith('.'):
+            raise DedupError("Invalid backup name '%s'" % name)
+        return os.path.join(self.manifests_path, name + '.json')
+
+    @staticmethod
+    def _write_atomically(path, data):
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def put_chunk(self, chunk):
+        """ Returns the digest of chunk and whether it was new """
+        digest = hashlib.sha256(chunk).hexdigest()
+        path = self.chunk_path(digest)
+        if os.path.exists(path):
+            return digest, False
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._write_atomically(path, zlib.compress(chunk))
+        return digest, True
+
+    def get_chunk(self, digest):
+        try:
+            with open(self.chunk_path(digest), 'rb') as f:
+                chunk = zlib.decompress(f.read())
+        except FileNotFoundError:
+            raise DedupError("Chunk '%s' is missing from the store" % digest)
+        except zlib.error:
+            raise DedupError("Chunk '%s' is corrupted" % digest)
+        if hashlib.sha256(chunk).hexdigest() != digest:
+            raise DedupError("Chunk '%s' is corrupted" % digest)
+        return chunk
+
+    def store(self, name, stream, chunker):
+        """ Stores a stream, returns its manifest """
+        total_hash = hashlib.sha256()
+        chunks = []
+        new_bytes = 0
+        with self.locked(exclusive=False):
+            for chunk in chunker.split(stream):
+                total_hash.update(chunk)
+                digest, new = self.put_chunk(chunk)
+                chunks.append([digest, len(chunk)])
+                if new:
+                    new_bytes += len(chunk)
+
+            manifest = dict(
+                name=name,
+                created=datetime.datetime.now().isoformat(),
+                size=sum(size for _, size in chunks),
+                new_bytes=new_bytes,
+                sha256=total_hash.hexdigest(),
+                chunks=chunks,
+            )
+            self._write_atomically(self.manifest_path(name), json.dumps(manifest).encode('utf-8'))
+        return manifest
+
+    def load_manifest(self, name):
+        try:
+            with open(self.manifest_path(name)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            raise DedupError("No backup named '%s' in the store" % name)
+
+    def manifests(self):
+        """ All manifests, oldest first """
+        manifests = []
+        for file_name in os.listdir(self.manifests_path):
+            if file_name.endswith('.json'):
+                manifests.append(self.load_manifest(file_name[:-len('.json')]))
+        return sorted(manifests, key=lambda manifest: manifest['created'])
+
+    def restore(self, name, output):
+        manifest = self.load_manifest(name)
+        total_hash = hashlib.sha256()
+        for digest, _ in manifest['chunks']:
+            chunk = self.get_chunk(digest)
+            total_hash.update(chunk)
+            output.write(chunk)
+        output.flush()
+        if total_hash.hexdigest() != manifest['sha256']:
+            raise DedupError("Restored data of '%s' does not match its checksum" % name)
+        return manifest
+
+    def collect_garbage(self, keep=None):
+        """ Removes manifests beyond the newest `keep` ones and chunks no longer referenced, returns counts """
+        with self.locked(exclusive=True):
+            manifests = self.manifests()
+            removed_manifests = 0
+            if keep is not None and len(manifests) > keep:
+                for manifest in manifests[:len(manifests) - keep]:
+                    os.remove(self.manifest_path(manifest['name']))
+                    removed_manifests += 1
+                manifests = manifests[len(manifests) - keep:]
+
+            referenced = set(digest for manifest in manifests for digest, _ in manifest['chunks'])
+            removed_chunks = 0
+            for entry in os.scandir(self.chunks_path):
+                if not entry.is_dir():
+                    continue
+                for chunk_entry in os.scandir(entry.path):
+                    if chunk_entry.name not in referenced:
+                        os.remove(chunk_entry.path)
+                        removed_chunks += 1
+        return removed_manifests, removed_chunks
+
+
+def parse_keep(value):
+    """ Number of backups kept by gc, 0 removes them all """
+    try:
+        keep = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid number '%s'" % value)
+    if keep < 0:
+        raise argparse.ArgumentTypeError("must be 0 or more, got %d" % keep)
+    return keep
+
+
+def main(argv=None):
+    """ Deduplicated backups: `mongodump --archive | fridge dedup store -s /store -n nightly_2019_10_10` """
+    parser = argparse.ArgumentParser(
+        prog='fridge dedup',
+        description='Stores streams as deduplicated chunks, only data changed since previous backups takes space'
+    )
+    parser.add_argument(
+        '-s', '--store', required=True,
+        help='directory holding chunks and manifests, like a mounted volume'
+    )
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    store_parser = commands.add_parser('store', help='stores stdin as a new backup')
+    store_parser.add_argument('-n', '--name', required=True, help='name of the backup')
+    store_parser.add_argument('--min-size', type=parse_size, default=parse_size('256K'),
+                              help='minimum chunk size, default 256K')
+    store_parser.add_argument('--avg-size', type=parse_size, default=parse_size('1M'),
+                              help='average chunk size, default 1M')
+    store_parser.add_argument('--max-size', type=parse_size, default=parse_size('4M'),
+                              help='maximum chunk size, default 4M')
+
+    restore_parser = commands.add_parser('restore', help='writes a backup to stdout')
+    restore_parser.add_argument('-n', '--name', required=True, help='name of the backup')
+
+    commands.add_parser('list', help='lists stored backups')
+
+    gc_parser = commands.add_parser('gc', help='removes chunks not referenced by any backup')
+    gc_parser.add_argument('-k', '--keep', type=parse_keep, default=None,
+                           help='first removes all but the newest KEEP backups')
+
+    arguments = parser.parse_args(argv)
+
+    try:
+        store = ChunkStore(arguments.store)
+        if arguments.command == 'store':
+            chunker = Chunker(arguments.min_size, arguments.avg_size, arguments.max_size)
+            manifest = store.store(arguments.name, sys.stdin.buffer, chunker)
+            sys.stderr.write("stored %d bytes in %d chunks, %d bytes were new, sha256 %s\n" % (
+                manifest['size'], len(manifest['chunks']), manifest['new_bytes'], manifest['sha256']
+            ))
+        elif arguments.command == 'restore':
+            store.restore(arguments.name, sys.stdout.buffer)
+        elif arguments.command == 'list':
+            for manifest in store.manifests():
+                print("%s\t%s\t%d\t%d" % (
+                    manifest['name'], manifest['created'], manifest['size'], manifest['new_bytes']
+                ))
+        elif arguments.command == 'gc':
+            removed_manifests, removed_chunks = store.collect_garbage(arguments.keep)
+            print("removed %d backup(s) and %d chunk(s)" % (removed_manifests, removed_chunks))
+    except DedupError as e:
+        parser.exit(1, "%s\n" % e)
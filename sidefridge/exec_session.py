@@ -0,0 +1,206 @@
+import json
+import os
+import shlex
+import socket
+import socketserver
+import struct
+import subprocess
+import threading
+
+from sidefridge.utils import print_logger
+
+# frames sent to kubectlexec: output data, or the exit code of the command which ends the stream
+FRAME_HEADER = struct.Struct('!cI')
+FRAME_OUTPUT = b'O'
+FRAME_EXIT = b'X'
+
+CHUNK_SIZE = 64 * 1024
+
+# reported when the session dies before the command completes, same as ssh and kubectl do
+SESSION_LOST_EXIT_CODE = 255
+
+
+class SessionClosed(Exception):
+    pass
+
+
+class ExecSession(object):
+    """
+    A long lived `kubectl exec -i` shell in the target container. Each command runs in its own `/bin/sh -c`
+    with stderr merged into stdout, like the TTY used by kubectlexec did, and is followed by a marker
+    carrying its exit code so that many commands can be sent over the same stdin.
+    """
+
+    def __init__(self, pod, container):
+        self.process = subprocess.Popen(
+            ['kubectl', 'exec', '-i', pod, '-c', container, '--', '/bin/sh'],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE
+        )
+        self.alive = True
+
+    def run(self, command, write):
+        """ Runs command passing its output to write as it arrives, returns the exit code """
+        marker = ('__SIDEFRIDGE_%s__' % os.urandom(8).hex()).encode('ascii')
+        script = "/bin/sh -c %s </dev/null 2>&1; printf '\\n%s %%d\\n' $?\n" % (
+            shlex.quote(command), marker.decode('ascii')
+        )
+        try:
+            self.process.stdin.write(script.encode('utf-8'))
+            self.process.stdin.flush()
+        except (BrokenPipeError, ValueError):
+            self.alive = False
+            raise SessionClosed("kubectl exec session is no longer running")
+
+        frame = b'\n' + marker + b' '
+        buffer = b''
+        while True:
+            data = os.read(self.process.stdout.fileno(), CHUNK_SIZE)
+            if not data:
+                self.alive = False
+                write(buffer)
+                raise SessionClosed("kubectl exec session ended before the command completed")
+            buffer += data
+
+            index = buffer.find(frame)
+            if index >= 0:
+                write(buffer[:index])
+                trailer = buffer[index + len(frame):]
+                while b'\n' not in trailer:
+                    data = os.read(self.process.stdout.fileno(), CHUNK_SIZE)
+                    if not data:
+                        self.alive = False
+                        raise SessionClosed("kubectl exec session ended before the command completed")
+                    trailer += data
+                return int(trailer.split(b'\n', 1)[0])
+
+            # hold back what could be the beginning of the marker
+            keep = len(frame) - 1
+            if len(buffer) > keep:
+                write(buffer[:-keep])
+                buffer = buffer[-keep:]
+
+    def close(self):
+        self.alive = False
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass
+        try:
+            self.process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+
+
+class SessionPool(object):
+    """ Reuses idle sessions, a new one is opened only when all of them are busy """
+
+    def __init__(self, pod, container):
+        self.pod = pod
+        self.container = container
+        self._lock = threading.Lock()
+        self._idle = []
+        self._all = []
+
+    def acquire(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+            session = ExecSession(self.pod, self.container)
+            self._all.append(session)
+            return session
+
+    def release(self, session):
+        with self._lock:
+            if session.alive:
+                self._idle.append(session)
+            else:
+                self._all.remove(session)
+
+    def close(self):
+        with self._lock:
+            sessions, self._all, self._idle = self._all, [], []
+        for session in sessions:
+            session.close()
+
+
+class SessionRequestHandler(socketserver.StreamRequestHandler):
+    def send_frame(self, kind, value, data=b''):
+        self.wfile.write(FRAME_HEADER.pack(kind, value) + data)
+        self.wfile.flush()
+
+    def handle(self):
+        request = json.loads(self.rfile.readline())
+        client = dict(connected=True)
+
+        def write(data):
+            # the session must be drained up to the marker even if kubectlexec went away
+            if data and client['connected']:
+                try:
+                    self.send_frame(FRAME_OUTPUT, len(data), data)
+                except (BrokenPipeError, ConnectionResetError):
+                    client['connected'] = False
+
+        pool = self.server.pool
+        session = pool.acquire()
+        try:
+            exit_code = session.run(request['command'], write)
+        except SessionClosed as e:
+            write(("%s\n" % e).encode('utf-8'))
+            exit_code = SESSION_LOST_EXIT_CODE
+        finally:
+            pool.release(session)
+
+        if client['connected']:
+            self.send_frame(FRAME_EXIT, exit_code)
+
+
+class SessionServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """ Lets kubectlexec invocations of a run share kubectl exec sessions, opened on first use """
+    daemon_threads = True
+
+    def __init__(self, socket_path, pod, container):
+        self.pool = SessionPool(pod, container)
+        self.socket_path = socket_path
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        socketserver.UnixStreamServer.__init__(self, socket_path, SessionRequestHandler)
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, name='exec-session-server')
+        thread.daemon = True
+        thread.start()
+        print_logger("kubectl exec session server listening on '%s'" % self.socket_path)
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self.pool.close()
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+
+def _read_exactly(connection, size):
+    data = b''
+    while len(data) < size:
+        chunk = connection.recv(size - len(data))
+        if not chunk:
+            raise SessionClosed("Connection to the kubectl exec session server was lost")
+        data += chunk
+    return data
+
+
+def run_in_session(socket_path, command, output):
+    """ Runs command through the session server writing its output to the binary stream output """
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    connection.connect(socket_path)
+    try:
+        connection.sendall(json.dumps(dict(command=command)).encode('utf-8') + b'\n')
+        while True:
+            kind, value = FRAME_HEADER.unpack(_read_exactly(connection, FRAME_HEADER.size))
+            if kind == FRAME_EXIT:
+                return value
+            output.write(_read_exactly(connection, value))
+            output.flush()
+    finally:
+        connection.close()
@@ -0,0 +1,293 @@
+import argparse
+import datetime
+import math
+import os
+import sqlite3
+import time
+
+from sidefridge.coordination import get_state_dir
+from sidefridge.utils import print_logger
+
+RUN_HISTORY_PATH = "RUN_HISTORY_PATH"
+RUN_HISTORY_RETENTION_DAYS = "RUN_HISTORY_RETENTION_DAYS"
+
+HISTORY_FILE = 'sidefridge_history.db'
+DEFAULT_RETENTION_DAYS = 90
+
+# scripts report the size of what they produced with `store_var ARTIFACT_SIZE_<name> <bytes>`
+ARTIFACT_SIZE_PREFIX = 'ARTIFACT_SIZE_'
+
+SECONDS_PER_DAY = 24 * 60 * 60
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    started REAL NOT NULL,
+    finished REAL NOT NULL,
+    success INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS runs_started ON runs (started);
+CREATE TABLE IF NOT EXISTS hooks (
+    run_id INTEGER NOT NULL REFERENCES runs (id) ON DELETE CASCADE,
+    hook TEXT NOT NULL,
+    wall_seconds REAL NOT NULL,
+    failed_scripts INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS hooks_run ON hooks (run_id);
+CREATE TABLE IF NOT EXISTS scripts (
+    run_id INTEGER NOT NULL REFERENCES runs (id) ON DELETE CASCADE,
+    hook TEXT NOT NULL,
+    script TEXT NOT NULL,
+    exit_code INTEGER NOT NULL,
+    wall_seconds REAL NOT NULL,
+    user_cpu_seconds REAL NOT NULL,
+    system_cpu_seconds REAL NOT NULL,
+    max_rss_bytes INTEGER NOT NULL,
+    stdout_bytes INTEGER NOT NULL,
+    stderr_bytes INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS scripts_run ON scripts (run_id);
+CREATE INDEX IF NOT EXISTS scripts_name ON scripts (hook, script, run_id);
+CREATE TABLE IF NOT EXISTS artifacts (
+    run_id INTEGER NOT NULL REFERENCES runs (id) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    size_bytes INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS artifacts_run ON artifacts (run_id);
+CREATE INDEX IF NOT EXISTS artifacts_name ON artifacts (name, run_id);
+"""
+
+
+class HistoryError(Exception):
+    pass
+
+
+def get_history_path():
+    return os.environ.get(RUN_HISTORY_PATH, os.path.join(get_state_dir(), HISTORY_FILE))
+
+
+def get_retention_days():
+    value = os.environ.get(RUN_HISTORY_RETENTION_DAYS, str(DEFAULT_RETENTION_DAYS))
+    try:
+        return int(value)
+    except ValueError:
+        raise HistoryError("'%s' must be an integer, got '%s'" % (RUN_HISTORY_RETENTION_DAYS, value))
+
+
+def parse_artifact_sizes(items):
+    """ Artifact sizes out of the values scripts stored during the run, values which are not sizes are ignored """
+    sizes = {}
+    for key, value in items.items():
+        if key.startswith(ARTIFACT_SIZE_PREFIX):
+            try:
+                sizes[key[len(ARTIFACT_SIZE_PREFIX):]] = int(value)
+            except (TypeError, ValueError):
+                print_logger("Ignoring artifact size '%s', '%s' is not a number of bytes" % (key, value))
+    return sizes
+
+
+def percentile(sorted_values, fraction):
+    """ Nearest rank percentile of already sorted values """
+    index = max(int(math.ceil(fraction * len(sorted_values))) - 1, 0)
+    return sorted_values[min(index, len(sorted_values) - 1)]
+
+
+def slope_per_day(points):
+    """ Least squares slope of (timestamp, value) points, in value units per day """
+    if len(points) < 2:
+        return 0.0
+    mean_x = sum(x for x, _ in points) / len(points)
+    mean_y = sum(y for _, y in points) / len(points)
+    variance = sum((x - mean_x) ** 2 for x, _ in points)
+    if not variance:
+        return 0.0
+    covariance = sum((x - mean_x) * (y - mean_y) for x, y in points)
+    return covariance / variance * SECONDS_PER_DAY
+
+
+class RunHistory(object):
+    """
+    SQLite ledger of past runs. Recording a run is a single short transaction in WAL mode, runs older than the
+    retention are pruned at the same time and the freed pages are given back to the file system.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path, timeout=30)
+        self.connection.execute('PRAGMA foreign_keys = ON')
+        # auto_vacuum only takes effect on a new database, before the first table is created
+        self.connection.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        self.connection.execute('PRAGMA journal_mode = WAL')
+        self.connection.execute('PRAGMA synchronous = NORMAL')
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def record(self, metrics, artifact_sizes=None, retention_days=None):
+        """ Stores the RunMetrics of a completed run, returns the id of the run """
+        with self.connection:
+            cursor = self.connection.execute(
+                'INSERT INTO runs (started, finished, success) VALUES (?, ?, ?)',
+                (metrics.started, metrics.started + metrics.wall_seconds, int(metrics.success))
+            )
+            run_id = cursor.lastrowid
+            self.connection.executemany(
+                'INSERT INTO hooks (run_id, hook, wall_seconds, failed_scripts) VALUES (?, ?, ?, ?)',
+                [(run_id, hook.name, hook.summary()['wall_seconds'], hook.summary()['failed_scripts'])
+                 for hook in metrics.hooks]
+            )
+            self.connection.executemany(
+                'INSERT INTO scripts (run_id, hook, script, exit_code, wall_seconds, user_cpu_seconds, '
+                'system_cpu_seconds, max_rss_bytes, stdout_bytes, stderr_bytes) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                [(run_id, record['hook'], record['script'], record['exit_code'], record['wall_seconds'],
+                  record['user_cpu_seconds'], record['system_cpu_seconds'], record['max_rss_bytes'],
+                  record['stdout_bytes'], record['stderr_bytes'])
+                 for hook in metrics.hooks for record in hook.records]
+            )
+            self.connection.executemany(
+                'INSERT INTO artifacts (run_id, name, size_bytes) VALUES (?, ?, ?)',
+                [(run_id, name, size) for name, size in sorted((artifact_sizes or {}).items())]
+            )
+            if retention_days is not None:
+                self._prune(time.time() - retention_days * SECONDS_PER_DAY)
+        self.connection.execute('PRAGMA incremental_vacuum')
+        return run_id
+
+    def _prune(self, before):
+        return self.connection.execute('DELETE FROM runs WHERE started < ?', (before,)).rowcount
+
+    def prune(self, retention_days):
+        with self.connection:
+            removed = self._prune(time.time() - retention_days * SECONDS_PER_DAY)
+        self.connection.execute('PRAGMA incremental_vacuum')
+        return removed
+
+    def last_runs(self, count):
+        """ Most recent runs first: id, started, finished, success, scripts, failed scripts """
+        return self.connection.execute(
+            'SELECT runs.id, runs.started, runs.finished, runs.success, '
+            '(SELECT COUNT(*) FROM scripts WHERE scripts.run_id = runs.id), '
+            '(SELECT COUNT(*) FROM scripts WHERE scripts.run_id = runs.id AND scripts.exit_code != 0) '
+            'FROM runs ORDER BY runs.started DESC LIMIT ?',
+            (count,)
+        ).fetchall()
+
+    def _script_points(self, since):
+        """ (hook, script) mapped to the (run start, duration) of every execution since a timestamp """
+        points = {}
+        rows = self.connection.execute(
+            'SELECT scripts.hook, scripts.script, runs.started, scripts.wall_seconds '
+            'FROM runs JOIN scripts ON scripts.run_id = runs.id WHERE runs.started >= ? ORDER BY runs.started',
+            (since,)
+        )
+        for hook, script, started, wall_seconds in rows:
+            points.setdefault((hook, script), []).append((started, wall_seconds))
+        return points
+
+    def _artifact_points(self, since):
+        points = {}
+        rows = self.connection.execute(
+            'SELECT artifacts.name, runs.started, artifacts.size_bytes '
+            'FROM runs JOIN artifacts ON artifacts.run_id = runs.id WHERE runs.started >= ? ORDER BY runs.started',
+            (since,)
+        )
+        for name, started, size in rows:
+            points.setdefault(name, []).append((started, size))
+        return points
+
+    def script_percentiles(self, days):
+        """ Per script: hook, script, executions, p50 and p95 duration over the last days """
+        since = time.time() - days * SECONDS_PER_DAY
+        result = []
+        for (hook, script), points in sorted(self._script_points(since).items()):
+            durations = sorted(duration for _, duration in points)
+            result.append((hook, script, len(durations), percentile(durations, 0.5), percentile(durations, 0.95)))
+        return result
+
+    def growth(self, days):
+        """
+        Scripts whose duration and artifacts whose size grew the most per day over the last days, fastest
+        growth first: kind, name, samples, first value, growth per day.
+        """
+        since = time.time() - days * SECONDS_PER_DAY
+        result = []
+        for (hook, script), points in self._script_points(since).items():
+            result.append(('duration', '%s/%s' % (hook, script), len(points), points[0][1], slope_per_day(points)))
+        for name, points in self._artifact_points(since).items():
+            result.append(('size', name, len(points), points[0][1], slope_per_day(points)))
+        # compared relatively, seconds and bytes do not share a scale
+        return sorted(result, key=lambda row: row[4] / row[3] if row[3] else row[4], reverse=True)
+
+
+def record_run(metrics, artifact_sizes=None):
+    """ Adds a completed run to the history, errors are logged and never fail the run """
+    try:
+        history = RunHistory(get_history_path())
+        try:
+            history.record(metrics, artifact_sizes, get_retention_days())
+        finally:
+            history.close()
+    except (sqlite3.Error, HistoryError) as e:
+        print_logger("Could not record run history: %s" % e)
+
+
+def format_timestamp(timestamp):
+    return datetime.datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def main(argv=None):
+    """ Queries the run history: `fridge history runs -n 20` """
+    parser = argparse.ArgumentParser(prog='fridge history', description='Shows past runs recorded by the runner')
+    parser.add_argument(
+        '--db', default=None,
+        help='path of the history database, defaults to %s or %s in RUN_STATE_DIR' % (RUN_HISTORY_PATH, HISTORY_FILE)
+    )
+    commands = parser.add_subparsers(dest='command')
+
+    runs_parser = commands.add_parser('runs', help='lists the most recent runs (default)')
+    runs_parser.add_argument('-n', '--count', type=int, default=10, help='number of runs, default 10')
+
+    percentiles_parser = commands.add_parser('percentiles', help='p50 and p95 duration of each script')
+    percentiles_parser.add_argument('--days', type=int, default=30, help='considered days, default 30')
+
+    growth_parser = commands.add_parser('growth', help='scripts and artifacts growing the fastest')
+    growth_parser.add_argument('--days', type=int, default=30, help='considered days, default 30')
+    growth_parser.add_argument('-n', '--count', type=int, default=10, help='number of rows, default 10')
+
+    prune_parser = commands.add_parser('prune', help='removes runs older than the retention')
+    prune_parser.add_argument('--days', type=int, default=None,
+                              help="retention in days, defaults to '%s' or %d" % (
+                                  RUN_HISTORY_RETENTION_DAYS, DEFAULT_RETENTION_DAYS))
+
+    arguments = parser.parse_args(argv)
+
+    path = arguments.db or get_history_path()
+    if arguments.command != 'prune' and not os.path.exists(path):
+        parser.exit(1, "No run history found at '%s'\n" % path)
+
+    try:
+        history = RunHistory(path)
+        if arguments.command in (None, 'runs'):
+            count = getattr(arguments, 'count', 10)
+            print("%-6s %-19s %10s %-7s %8s %7s" % ('run', 'started', 'duration', 'result', 'scripts', 'failed'))
+            for run_id, started, finished, success, scripts, failed in history.last_runs(count):
+                print("%-6d %-19s %9.1fs %-7s %8d %7d" % (
+                    run_id, format_timestamp(started), finished - started, 'ok' if success else 'failed',
+                    scripts, failed
+                ))
+        elif arguments.command == 'percentiles':
+            print("%-40s %6s %9s %9s" % ('script', 'runs', 'p50', 'p95'))
+            for hook, script, count, p50, p95 in history.script_percentiles(arguments.days):
+                print("%-40s %6d %8.1fs %8.1fs" % ('%s/%s' % (hook, script), count, p50, p95))
+        elif arguments.command == 'growth':
+            print("%-9s %-40s %7s %14s %14s" % ('kind', 'name', 'samples', 'first', 'per day'))
+            for kind, name, samples, first, per_day in history.growth(arguments.days)[:arguments.count]:
+                print("%-9s %-40s %7d %14.1f %+14.1f" % (kind, name, samples, first, per_day))
+        elif arguments.command == 'prune':
+            days = get_retention_days() if arguments.days is None else arguments.days
+            print("removed %d run(s)" % history.prune(days))
+        history.close()
+    except (sqlite3.Error, HistoryError) as e:
+        parser.exit(1, "%s\n" % e)
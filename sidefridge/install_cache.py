@@ -0,0 +1,185 @@
+import datetime
+import hashlib
+import json
+import os
+import shutil
+import sys
+
+from sidefridge.utils import print_logger
+
+INSTALL_CACHE_DIR = "INSTALL_CACHE_DIR"
+INSTALL_CACHE_PATHS = "INSTALL_CACHE_PATHS"
+
+# where install scripts put what they install: packages, pip modules, binaries and their configuration
+DEFAULT_CACHE_PATHS = '/bin /etc /lib /opt /sbin /usr'
+
+# describe the base image, a new image (or new packages in it) invalidates the cache
+BASE_IMAGE_FILES = ('/etc/os-release', '/lib/apk/db/installed', '/var/lib/dpkg/status')
+
+ARCHIVE_SUFFIX = '.tar.gz'
+MARKER_SUFFIX = '.json'
+
+
+class InstallCacheError(Exception):
+    pass
+
+
+def _file_state(stat):
+    return stat.st_mode, stat.st_size, stat.st_mtime_ns, stat.st_ino
+
+
+def snapshot(paths):
+    """ Maps every file, link and directory under paths to its state, symlinks are not followed """
+    states = {}
+    pending = [path for path in paths if os.path.lexists(path)]
+    for path in pending:
+        states[path] = _file_state(os.lstat(path))
+    while pending:
+        directory = pending.pop()
+        try:
+            entries = list(os.scandir(directory))
+        except (NotADirectoryError, PermissionError, FileNotFoundError):
+            continue
+        for entry in entries:
+            try:
+                states[entry.path] = _file_state(entry.stat(follow_symlinks=False))
+                if entry.is_dir(follow_symlinks=False):
+                    pending.append(entry.path)
+            except FileNotFoundError:
+                continue
+    return states
+
+
+def changed_paths(before, after):
+    """ Paths created or modified between two snapshots, parents first """
+    return sorted(path for path, state in after.items() if before.get(path) != state)
+
+
+def deleted_paths(before, after):
+    """ Paths removed between two snapshots, the content of a removed directory is not listed """
+    deleted = sorted(path for path in before if path not in after)
+    return [path for path in deleted if os.path.dirname(path) not in before or os.path.dirname(path) in after]
+
+
+def _remove(path):
+    try:
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _check_members(archive):
+    """ save() only archives relative paths of files, links and directories, anything else was not written by it """
+    for member in archive.getmembers():
+        if member.name.startswith('/') or '..' in member.name.split('/') or member.isdev():
+            raise InstallCacheError("Unexpected entry '%s' in the cached dependencies" % member.name)
+
+
+class InstallCache(object):
+    """
+    Remembers what install_dependencies scripts installed, in a directory which should be a persistent volume.
+    The files changed by the scripts are archived together with a marker carrying the fingerprint of the scripts
+    and of the base image, and the paths they removed. A later container start with the same fingerprint removes
+    those paths and extracts the archive instead of running the scripts again.
+    """
+
+    def __init__(self, cache_dir, paths):
+        self.cache_dir = cache_dir
+        self.paths = paths
+
+    def fingerprint(self, scripts_detector, scripts):
+        digest = hashlib.sha256()
+        digest.update(sys.version.encode('utf-8'))
+        digest.update(' '.join(self.paths).encode('utf-8'))
+        for script in scripts:
+            digest.update(('%s %s\n' % (os.path.basename(script), scripts_detector.digest(script))).encode('utf-8'))
+        for path in BASE_IMAGE_FILES:
+            if os.path.isfile(path):
+                with open(path, 'rb') as f:
+                    digest.update(path.encode('utf-8') + hashlib.sha256(f.read()).digest())
+        return digest.hexdigest()
+
+    def _path(self, fingerprint, suffix):
+        return os.path.join(self.cache_dir, fingerprint + suffix)
+
+    def restore(self, fingerprint):
+        """ Extracts the archive matching the fingerprint, returns False when there is none """
+        marker_path = self._path(fingerprint, MARKER_SUFFIX)
+        if not os.path.isfile(marker_path):
+            return False
+
+        import tarfile
+
+        try:
+            with open(marker_path) as f:
+                marker = json.load(f)
+            paths, created, deleted = marker['paths'], marker['created'], marker['deleted']
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            # a marker cut short by a full disk or an older format is a miss, the scripts run and replace it
+            print_logger("Ignoring the unreadable install cache marker '%s': %s" % (marker_path, e))
+            return False
+        try:
+            with tarfile.open(self._path(fingerprint, ARCHIVE_SUFFIX)) as archive:
+                _check_members(archive)
+                # what the scripts removed from the image, like a package replaced by another one
+                for path in deleted:
+                    _remove(path)
+                # written by save() from the install of this image, it must come back as it was installed: the
+                # 'data' and 'tar' filters would drop setuid bits and absolute symlinks like /usr/bin/python3
+                if hasattr(tarfile, 'fully_trusted_filter'):
+                    archive.extractall('/', filter='fully_trusted')
+                else:
+                    archive.extractall('/')
+        except (OSError, tarfile.TarError) as e:
+            raise InstallCacheError("Could not restore cached dependencies: %s" % e)
+        print_logger("Restored %d cached path(s) installed on %s" % (paths, created))
+        return True
+
+    def save(self, fingerprint, before):
+        """ Archives what changed since the before snapshot, then replaces older entries of the cache """
+        import tarfile
+
+        after = snapshot(self.paths)
+        changed = changed_paths(before, after)
+        cache_prefix = self.cache_dir.rstrip('/') + '/'
+        deleted = [path for path in deleted_paths(before, after) if not path.startswith(cache_prefix)]
+        archive_path = self._path(fingerprint, ARCHIVE_SUFFIX)
+        tmp_path = '%s.%d.tmp' % (archive_path, os.getpid())
+        with tarfile.open(tmp_path, 'w:gz') as archive:
+            for path in changed:
+                if path.startswith(cache_prefix):
+                    continue
+                archive.add(path, arcname=path.lstrip('/'), recursive=False)
+        os.replace(tmp_path, archive_path)
+
+        # the marker is written last, an interrupted save leaves no marker and is never restored
+        marker = dict(
+            fingerprint=fingerprint,
+            created=datetime.datetime.now().isoformat(),
+            paths=len(changed),
+            deleted=deleted,
+            size=os.path.getsize(archive_path),
+        )
+        marker_path = self._path(fingerprint, MARKER_SUFFIX)
+        with open(marker_path + '.tmp', 'w') as f:
+            json.dump(marker, f)
+        os.replace(marker_path + '.tmp', marker_path)
+
+        for file_name in os.listdir(self.cache_dir):
+            if not file_name.startswith(fingerprint) and file_name.endswith((ARCHIVE_SUFFIX, MARKER_SUFFIX)):
+                os.remove(os.path.join(self.cache_dir, file_name))
+        print_logger("Cached %d installed path(s) in '%s' (%d bytes)" % (len(changed), archive_path, marker['size']))
+
+
+def get_install_cache():
+    """ The cache configured in the environment, None when caching is disabled """
+    cache_dir = os.environ.get(INSTALL_CACHE_DIR)
+    if not cache_dir:
+        return None
+    if not os.path.isdir(cache_dir):
+        raise InstallCacheError("'%s' points to '%s', which is not a directory" % (INSTALL_CACHE_DIR, cache_dir))
+    paths = os.environ.get(INSTALL_CACHE_PATHS, DEFAULT_CACHE_PATHS).split()
+    return InstallCache(os.path.realpath(cache_dir), paths)
@@ -1,10 +1,17 @@
 import os
+import shlex
 import sys
 
 from sidefridge.utils import print_logger
 
 TARGET_CONTAINER = "TARGET_CONTAINER"
 POD_NAME = "POD_NAME"
+# enables sharing kubectl exec sessions between the kubectlexec calls of a run
+KUBECTLEXEC_SESSION = "KUBECTLEXEC_SESSION"
+# set while a run is in progress, points to the socket of the session server
+SESSION_SOCKET = "SIDEFRIDGE_EXEC_SOCKET"
+
+STREAM_FLAG = "--stream"
 
 
 def run_in_container(command):
@@ -13,13 +20,37 @@ def run_in_container(command):
     """
 
     # subprocess was replaced, had issues with this; output is no longer steamed :\
-    kubectl_command = 'kubectl exec -it {pod} -c {container} -- /bin/sh -c "{command}"'.format(
-        pod=os.environ[POD_NAME],
-        container=os.environ[TARGET_CONTAINER],
-        command=command
-    )
+    # every argument is quoted, the command reaches the shell of the container unchanged as it does with sessions
+    kubectl_command = ' '.join(shlex.quote(argument) for argument in [
+        'kubectl', 'exec', '-it', os.environ[POD_NAME], '-c', os.environ[TARGET_CONTAINER], '--', '/bin/sh', '-c',
+        command
+    ])
+
+    return exit_code_from_status(os.system(kubectl_command))
+
 
-    os.system(kubectl_command)
+def exit_code_from_status(status):
+    """ Converts a wait status to the exit code a shell would report """
+    if os.WIFSIGNALED(status):
+        return 128 + os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def stream_from_container(command):
+    """
+    Replaces the current process with a `kubectl exec` without TTY. kubectl inherits stdin, stdout and stderr,
+    binary data flows directly between the target container and the pipes of the calling script, with no
+    copy made by this process. The exit code of the command becomes the exit code of kubectlexec.
+    """
+    try:
+        os.execvp('kubectl', [
+            'kubectl', 'exec', '-i', os.environ[POD_NAME], '-c', os.environ[TARGET_CONTAINER],
+            '--', '/bin/sh', '-c', command
+        ])
+    except OSError as e:
+        print_logger("Could not run kubectl: %s" % e)
+        # the exit codes a shell reports for a command it cannot find or cannot execute
+        exit(127 if isinstance(e, FileNotFoundError) else 126)
 
 
 def main():
@@ -33,12 +64,25 @@ def main():
 
     cli_arguments = sys.argv[1:]
 
+    stream = len(cli_arguments) > 0 and cli_arguments[0] == STREAM_FLAG
+    if stream:
+        cli_arguments = cli_arguments[1:]
+
     if len(cli_arguments) < 1:
         print_logger("You must provide a command to be executed in the target container")
         exit(1)
 
     command = " ".join(cli_arguments)
-    run_in_container(command)
+
+    if stream:
+        stream_from_container(command)
+
+    socket_path = os.environ.get(SESSION_SOCKET)
+    if socket_path and os.path.exists(socket_path):
+        from sidefridge.exec_session import run_in_session
+        exit(run_in_session(socket_path, command, sys.stdout.buffer))
+
+    exit(run_in_container(command))
 
 
 if __name__ == '__main__':
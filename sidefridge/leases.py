@@ -0,0 +1,181 @@
+import json
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from sidefridge.coordination import InvalidCoordinationSettings, get_int_setting, get_pod_identity
+from sidefridge.utils import print_logger
+
+RUN_LEASE_DIR = "RUN_LEASE_DIR"
+RUN_LEASE_SLOTS = "RUN_LEASE_SLOTS"
+RUN_LEASE_TTL_SECONDS = "RUN_LEASE_TTL_SECONDS"
+RUN_LEASE_WAIT_SECONDS = "RUN_LEASE_WAIT_SECONDS"
+
+DEFAULT_TTL_SECONDS = 300
+DEFAULT_WAIT_SECONDS = 3600
+
+LEASE_FILE = 'sidefridge_lease_%d.json'
+
+# waiting pods retry at random intervals around this, they do not all come back at the same time
+POLL_SECONDS = 5.0
+
+
+class LeasePool(object):
+    """
+    Caps how many pods run at the same time across the cluster. Each slot is a lease file in a directory shared by
+    every pod, the holder renews it while running and removes it when done. A lease which was not renewed within
+    its ttl belongs to a pod which died, another pod may take it over.
+    Files are created with link() and moved with rename(), both are atomic on local and NFS volumes.
+    """
+
+    def __init__(self, lease_dir, slots, holder, ttl, wait_seconds):
+        self.lease_dir = lease_dir
+        self.slots = slots
+        self.holder = holder
+        self.ttl = ttl
+        self.wait_seconds = wait_seconds
+        # unique to each acquisition, tells apart two runs of the same pod
+        self.token = '%s-%d-%08x' % (holder, os.getpid(), random.getrandbits(32))
+        self.slot = None
+        self._stop_renewing = threading.Event()
+        self._renewer = None
+
+    def _path(self, slot):
+        return os.path.join(self.lease_dir, LEASE_FILE % slot)
+
+    @staticmethod
+    def _read(path):
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _write(self, path, exclusive):
+        """ Writes a lease held until ttl from now, exclusive fails with FileExistsError if path exists """
+        tmp_path = '%s.%s.tmp' % (path, self.token)
+        with open(tmp_path, 'w') as f:
+            json.dump(dict(holder=self.holder, token=self.token, expires=time.time() + self.ttl), f)
+        try:
+            if exclusive:
+                os.link(tmp_path, path)
+            else:
+                os.replace(tmp_path, path)
+        finally:
+            if os.path.lexists(tmp_path):
+                os.remove(tmp_path)
+
+    @staticmethod
+    def _expired(lease):
+        return lease is None or lease.get('expires', 0) <= time.time()
+
+    def _try_slot(self, slot):
+        path = self._path(slot)
+        try:
+            self._write(path, exclusive=True)
+            return True
+        except FileExistsError:
+            pass
+
+        lease = self._read(path)
+        if not self._expired(lease):
+            return False
+
+        # only one pod succeeds moving the expired lease out of the way
+        stale_path = '%s.%s.stale' % (path, self.token)
+        try:
+            os.rename(path, stale_path)
+        except FileNotFoundError:
+            return False
+        if not self._expired(self._read(stale_path)):
+            # another pod took the lease over in between, it is given back
+            try:
+                os.link(stale_path, path)
+            except FileExistsError:
+                pass
+            os.remove(stale_path)
+            return False
+        os.remove(stale_path)
+        print_logger("Taking over run lease %d, %s did not renew it" % (slot, (lease or {}).get('holder')))
+
+        try:
+            self._write(path, exclusive=True)
+            return True
+        except FileExistsError:
+            return False
+
+    def _renew(self):
+        path = self._path(self.slot)
+        while not self._stop_renewing.wait(self.ttl / 3.0):
+            lease = self._read(path)
+            if lease is None or lease.get('token') != self.token:
+                print_logger("Run lease %d was taken over by %s" % (self.slot, (lease or {}).get('holder')))
+                return
+            try:
+                self._write(path, exclusive=False)
+            except OSError as e:
+                print_logger("Could not renew run lease %d: %s" % (self.slot, e))
+
+    def acquire(self):
+        """ Waits up to wait_seconds for a free slot, returns False if none was released in time """
+        deadline = time.monotonic() + self.wait_seconds
+        slots = list(range(self.slots))
+        waiting = False
+        while True:
+            random.shuffle(slots)
+            for slot in slots:
+                if self._try_slot(slot):
+                    self.slot = slot
+                    self._stop_renewing.clear()
+                    self._renewer = threading.Thread(target=self._renew, daemon=True)
+                    self._renewer.start()
+                    if waiting:
+                        print_logger("Acquired run lease %d" % slot)
+                    return True
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            if not waiting:
+                print_logger("All %d run lease(s) are held by other pods, waiting" % self.slots)
+                waiting = True
+            time.sleep(min(random.uniform(0.5, 1.5) * POLL_SECONDS, remaining))
+
+    def release(self):
+        self._stop_renewing.set()
+        self._renewer.join()
+        path = self._path(self.slot)
+        lease = self._read(path)
+        if lease is not None and lease.get('token') == self.token:
+            os.remove(path)
+        self.slot = None
+
+    @contextmanager
+    def hold(self):
+        """ Yields True while holding a lease, False if the run must be skipped """
+        acquired = self.acquire()
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                self.release()
+
+
+def get_lease_pool():
+    """ The lease pool configured in the environment, None when runs are not capped """
+    lease_dir = os.environ.get(RUN_LEASE_DIR)
+    if not lease_dir:
+        return None
+    if not os.path.isdir(lease_dir):
+        raise InvalidCoordinationSettings("'%s' points to '%s', which is not a directory" % (RUN_LEASE_DIR, lease_dir))
+    slots = get_int_setting(RUN_LEASE_SLOTS, 1)
+    if slots < 1:
+        raise InvalidCoordinationSettings("'%s' must be at least 1" % RUN_LEASE_SLOTS)
+    ttl = get_int_setting(RUN_LEASE_TTL_SECONDS, DEFAULT_TTL_SECONDS)
+    if ttl < 3:
+        raise InvalidCoordinationSettings("'%s' must be at least 3" % RUN_LEASE_TTL_SECONDS)
+    return LeasePool(
+        lease_dir, slots, get_pod_identity(), ttl, get_int_setting(RUN_LEASE_WAIT_SECONDS, DEFAULT_WAIT_SECONDS)
+    )
@@ -1,19 +1,32 @@
-import argparse
+import functools
+import importlib
 import os
-import subprocess
 import sys
+import time
 
-from croniter import croniter
-
-from sidefridge.scripts import ScriptsDetector
-from sidefridge.storage import clear_storage
 from sidefridge.utils import print_logger
 
+# `fridge SUBCOMMAND` and `fridge --help` are started by scripts, the modules of the runner are imported where used
+
 HERE = os.path.dirname(os.path.realpath(__file__))
 
 CRON_BACKUP_SCHEDULE = "CRON_BACKUP_SCHEDULE"
-
-CRON_TEMPLATE = """%s fridge -r
+PREFIX_SCRIPT_OUTPUT = "PREFIX_SCRIPT_OUTPUT"
+
+STORE_SOCKET_PATH = '/tmp/sidefridge_store_%d.sock'
+EXEC_SOCKET_PATH = '/tmp/sidefridge_exec_%d.sock'
+# compressed scripts are decompressed here once, then run from here
+SCRIPTS_CACHE_PATH = '/tmp/sidefridge_scripts'
+
+# subcommands like `fridge pipe` have their own arguments, their modules are imported only when used
+SUBCOMMANDS = {
+    'dedup': 'sidefridge.dedup',
+    'history': 'sidefridge.history',
+    'pipe': 'sidefridge.pipeline',
+    'throttle': 'sidefridge.throttling',
+}
+
+CRON_TEMPLATE = """%s fridge -r --delay %d
 # remember to end this file with an empty new line
 """
 
@@ -26,72 +39,335 @@ class ScriptErrorOccurred(Exception):
     pass
 
 
-def run_single_script(script, skip_error=False, **kwargs):
+def get_output_prefix(script):
+    """ When PREFIX_SCRIPT_OUTPUT is set, each line of output is prefixed with the script name """
+    if os.environ.get(PREFIX_SCRIPT_OUTPUT, '').lower() not in ('1', 'true', 'yes'):
+        return None
+    return "[%s] " % os.path.basename(script)
+
+
+def start_script(cmd, policy=None):
+    import subprocess
+
+    from sidefridge.warm import get_warm_worker, is_warm_script
+
+    # scripts lead their own process group, a timeout or a cancellation reaches everything they started
+    warm_worker = get_warm_worker()
+    if warm_worker is not None and is_warm_script(cmd[0]):
+        try:
+            return warm_worker.run(cmd, policy)
+        except OSError as e:
+            print_logger("Warm worker could not run '%s', starting a new interpreter: %s" % (cmd[0], e))
+    if policy is not None:
+        return subprocess.Popen(
+            policy.command(cmd), stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=policy.environment(),
+            start_new_session=True
+        )
+    return subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, start_new_session=True)
+
+
+def run_single_script(script, skip_error=False, tracker=None, metrics=None, policy=None, supervisor=None, **kwargs):
+    from sidefridge.metrics import wait_with_usage
+    from sidefridge.scripts import ON_ERROR
+    from sidefridge.streaming import relay_output
+    from sidefridge.supervision import running_scripts
+
+    # on_error scripts run even once the run is stopping, they report why it stopped
+    stoppable = supervisor is None or supervisor.hook_name != ON_ERROR
     print_logger("Starting '%s'" % script)
     cmd = [script] + list(kwargs.values())
     print_logger(cmd)
-    process = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-    for c in iter(lambda: process.stdout.read(1), b''):
-        sys.stdout.write(c.decode('utf-8'))
-
-    process.communicate()
-    exit_code = process.returncode
+    started = time.monotonic()
+    timeout, retries, backoff = supervisor.settings(script) if supervisor is not None else (None, 0, 0)
+    attempt = 0
+    while True:
+        attempt_timeout = supervisor.attempt_timeout(timeout) if supervisor is not None else None
+        if attempt_timeout is not None and attempt_timeout <= 0:
+            error_message = "Hook '%s' timed out before '%s' could run" % (supervisor.hook_name, script)
+            exit_code, watchdog = None, None
+            break
+        if stoppable and running_scripts.stopping:
+            error_message = "Run is stopping, '%s' was not started" % script
+            exit_code, watchdog = None, None
+            break
+
+        process = start_script(cmd, policy)
+        if stoppable:
+            running_scripts.started(process)
+        if tracker is not None:
+            tracker.started(process)
+        watchdog = supervisor.watch(process, script, attempt_timeout) if supervisor is not None else None
+        try:
+            stdout_bytes, stderr_bytes = relay_output(
+                process, prefix=get_output_prefix(script), bandwidth=policy.token_bucket() if policy else None,
+                abandon=watchdog.abandon if watchdog is not None else None
+            )
+            exit_code, usage = wait_with_usage(process)
+        finally:
+            if watchdog is not None:
+                watchdog.stop()
+            if stoppable:
+                running_scripts.finished(process)
+            if tracker is not None:
+                tracker.finished(process)
+
+        if watchdog is not None and watchdog.timed_out:
+            error_message = "Script '%s' timed out after %.0fs" % (script, attempt_timeout)
+        elif stoppable and running_scripts.stopping and exit_code != 0:
+            error_message = "Script '%s' was stopped with exit code '%s', the run is stopping" % (script, exit_code)
+        else:
+            error_message = "Script '%s' finished with exit code '%s'" % (script, exit_code)
+        if exit_code == 0 or attempt >= retries or (tracker is not None and tracker.cancelled):
+            break
+        if stoppable and running_scripts.stopping:
+            break
+
+        delay = supervisor.backoff_delay(backoff, attempt)
+        remaining = supervisor.remaining()
+        if remaining is not None and delay >= remaining:
+            print_logger("%s, not retried as hook '%s' has %.0fs left" % (
+                error_message, supervisor.hook_name, remaining
+            ))
+            break
+        attempt += 1
+        print_logger("%s, retry %d of %d in %.1fs" % (error_message, attempt, retries, delay))
+        time.sleep(delay)
+
+    if metrics is not None and exit_code is not None:
+        metrics.record(script, exit_code, time.monotonic() - started, usage, stdout_bytes, stderr_bytes)
 
     if exit_code != 0:
-        error_message = "Script '%s' finished with exit code '%s'" % (script, exit_code)
         if skip_error:
             print_logger(error_message)
         else:
             raise SubprocessErrorDuringExecutionException(error_message)
 
 
-def run_scripts(scripts_detector, path, hook_name):
+def run_scripts(scripts_detector, path, hook_name, metrics=None, checkpoint=None):
     """
     Will run scripts in a given directory, if an error occurs it will launch on_error scripts.
     If an error occurs during an on_error script, the entire chain of scripts will stop.
+    The backups hook runs up to BACKUPS_MAX_WORKERS scripts at the same time, on_error is still launched once.
+    When metrics of the run are provided, every script is measured and recorded under its hook.
+    Scripts are throttled by the policy of their hook, if one applies at this time of the day, and stopped once
+    their timeout or the timeout of the hook expires. Scripts asking for retries are retried with a backoff.
+    With a checkpoint, scripts completed by an interrupted run are skipped and each completed script is recorded.
     """
+    from sidefridge.parallel import get_failure_policy, get_max_workers, run_scripts_concurrently
+    from sidefridge.scripts import BACKUPS
+    from sidefridge.supervision import Supervisor
+    from sidefridge.throttling import get_policy
+
     print_logger("Hook: '%s'" % hook_name)
+    if checkpoint is not None:
+        path = checkpoint.pending(hook_name, path, scripts_detector)
+    hook_metrics = metrics.hook(hook_name) if metrics is not None else None
+    policy = get_policy(scripts_detector.path, hook_name) if path else None
+    run_single = functools.partial(
+        run_single_script, metrics=hook_metrics, policy=policy, supervisor=Supervisor(hook_name)
+    )
+
+    def run_script(script, **kwargs):
+        run_single(script, **kwargs)
+        if checkpoint is not None:
+            checkpoint.complete(hook_name, script, scripts_detector.digest(script))
+
     try:
-        for script in path:
-            run_single_script(script)
+        max_workers = get_max_workers() if hook_name == BACKUPS else 1
+        if max_workers > 1:
+            run_scripts_concurrently(path, run_script, max_workers, get_failure_policy())
+        else:
+            for script in path:
+                run_script(script)
     except SubprocessErrorDuringExecutionException as e:
         print_logger(e)
+        if hook_metrics is not None:
+            hook_metrics.finish()
+        error_metrics = metrics.hook('on_error') if metrics is not None else None
+        error_policy = get_policy(scripts_detector.path, 'on_error') if scripts_detector.on_error else None
+        error_supervisor = Supervisor('on_error')
         # run on_error callbacks and do not rejigger on_error
         for error_script in scripts_detector.on_error:
-            run_single_script(error_script, skip_error=True, error=str(e))
+            run_single_script(
+                error_script, skip_error=True, metrics=error_metrics, policy=error_policy,
+                supervisor=error_supervisor, error=str(e)
+            )
+        if error_metrics is not None:
+            error_metrics.finish()
         raise ScriptErrorOccurred("Script execution finished due to errors. Look at logs for details")
+    finally:
+        if hook_metrics is not None:
+            hook_metrics.finish()
+
+
+def get_schedule_offset():
+    """ Seconds this pod delays scheduled runs, spreads the pods sharing the same schedule """
+    from sidefridge.coordination import get_pod_identity, get_schedule_spread, schedule_offset
+
+    offset = schedule_offset(os.environ[CRON_BACKUP_SCHEDULE], get_pod_identity(), get_schedule_spread())
+    if offset:
+        print_logger("Scheduled runs of '%s' start %d second(s) after the schedule" % (get_pod_identity(), offset))
+    return offset
 
 
 def start_initialize(scripts_detector, cron_path):
-    cron_schedule_content = CRON_TEMPLATE % os.environ[CRON_BACKUP_SCHEDULE]
+    cron_schedule_content = CRON_TEMPLATE % (os.environ[CRON_BACKUP_SCHEDULE], get_schedule_offset())
 
     with open(cron_path, 'w') as cron_file:
         cron_file.write(cron_schedule_content)
 
+    from sidefridge.install_cache import InstallCacheError, get_install_cache, snapshot
+
+    # with a persistent cache, a restart with unchanged install scripts restores what they installed last time
+    install_scripts = scripts_detector.install_dependencies
+    try:
+        install_cache = get_install_cache()
+        if install_cache is not None:
+            fingerprint = install_cache.fingerprint(scripts_detector, install_scripts)
+            if install_cache.restore(fingerprint):
+                return
+            before = snapshot(install_cache.paths)
+    except InstallCacheError as e:
+        print_logger(e)
+        install_cache = None
+
     try:
-        run_scripts(scripts_detector, scripts_detector.install_dependencies, 'install_dependencies')
+        run_scripts(scripts_detector, install_scripts, 'install_dependencies')
     except ScriptErrorOccurred as e:
         # int the dependency install phase it is important to fail and do not boot the container
         print_logger(e)
         raise e
 
+    if install_cache is not None:
+        try:
+            install_cache.save(fingerprint, before)
+        except OSError as e:
+            print_logger("Could not cache installed dependencies: %s" % e)
 
-def start_run(scripts_detector):
-    # always clean storage before and after usage, we do not want to leave unattended data between calls
-    clear_storage()
-    try:
-        run_scripts(scripts_detector, scripts_detector.before_backups, 'before_backups')
-        run_scripts(scripts_detector, scripts_detector.backups, 'backups')
-        run_scripts(scripts_detector, scripts_detector.after_backups, 'after_backups')
-    except ScriptErrorOccurred as e:
-        print_logger(e)
-    finally:
+
+def is_exec_session_enabled():
+    from sidefridge.kubectlexec import KUBECTLEXEC_SESSION, POD_NAME, TARGET_CONTAINER
+
+    if os.environ.get(KUBECTLEXEC_SESSION, '').lower() not in ('1', 'true', 'yes'):
+        return False
+    return POD_NAME in os.environ and TARGET_CONTAINER in os.environ
+
+
+def get_run_coordinator():
+    from sidefridge.coordination import RunCoordinator, get_overlap_policy, get_state_dir
+
+    return RunCoordinator(get_state_dir(), get_overlap_policy())
+
+
+def start_run(scripts_detector, fire_time=None, delay=0):
+    from contextlib import ExitStack
+
+    from sidefridge.checkpoint import get_checkpoint
+    from sidefridge.coordination import current_fire_time
+    from sidefridge.kubectlexec import POD_NAME, SESSION_SOCKET, TARGET_CONTAINER
+    from sidefridge.leases import get_lease_pool
+    from sidefridge.metrics import RunMetrics
+    from sidefridge.storage import STORE_SOCKET, clear_storage
+    from sidefridge.store_server import StoreServer
+
+    coordinator = get_run_coordinator()
+    fire_time = fire_time or current_fire_time(os.environ[CRON_BACKUP_SCHEDULE])
+    if delay:
+        print_logger("Waiting %d second(s) before running" % delay)
+        time.sleep(delay)
+
+    with coordinator.acquire() as acquired, ExitStack() as stack:
+        if not acquired:
+            print_logger("Another run is in progress, skipping run scheduled at %s" % fire_time)
+            return
+
+        # at most RUN_LEASE_SLOTS pods sharing the lease directory run at the same time
+        lease_pool = get_lease_pool()
+        if lease_pool is not None and not stack.enter_context(lease_pool.hold()):
+            print_logger("No run lease was released in time, skipping run scheduled at %s" % fire_time)
+            return
+
+        # picks up scripts changed since the previous run, only when the detector is watching
+        scripts_detector.refresh()
+
+        # sqlite3 is only needed once a run starts
+        from sidefridge.history import ARTIFACT_SIZE_PREFIX, parse_artifact_sizes, record_run
+
+        # always clean storage before and after usage, we do not want to leave unattended data between calls
         clear_storage()
+        # scripts of this run share values through a storage server living as long as the run
+        store_server = StoreServer(STORE_SOCKET_PATH % os.getpid())
+        store_server.start()
+        os.environ[STORE_SOCKET] = store_server.socket_path
+        session_server = None
+        if is_exec_session_enabled():
+            from sidefridge.exec_session import SessionServer
+            session_server = SessionServer(
+                EXEC_SOCKET_PATH % os.getpid(), os.environ[POD_NAME], os.environ[TARGET_CONTAINER]
+            )
+            session_server.start()
+            os.environ[SESSION_SOCKET] = session_server.socket_path
+        metrics = RunMetrics()
+        # an interrupted run is resumed with the values its scripts stored
+        checkpoint = get_checkpoint(store_server.store)
+        if checkpoint is not None:
+            checkpoint.load()
+        try:
+            run_scripts(scripts_detector, scripts_detector.before_backups, 'before_backups', metrics, checkpoint)
+            run_scripts(scripts_detector, scripts_detector.backups, 'backups', metrics, checkpoint)
+            run_scripts(scripts_detector, scripts_detector.after_backups, 'after_backups', metrics, checkpoint)
+            metrics.finish(success=True)
+            if checkpoint is not None:
+                checkpoint.discard()
+        except ScriptErrorOccurred as e:
+            print_logger(e)
+            metrics.finish(success=False)
+            if checkpoint is not None:
+                # keeps the progress markers stored by the script which failed
+                checkpoint.save()
+        finally:
+            artifact_sizes = parse_artifact_sizes(store_server.store.items(ARTIFACT_SIZE_PREFIX))
+            del os.environ[STORE_SOCKET]
+            store_server.stop()
+            if session_server is not None:
+                del os.environ[SESSION_SOCKET]
+                session_server.stop()
+            clear_storage()
+
+        metrics.publish()
+        record_run(metrics, artifact_sizes)
+        coordinator.record_fire_time(fire_time)
+
+
+def start_daemon(scripts_detector):
+    from sidefridge.coordination import get_missed_run_policy
+    from sidefridge.daemon import Scheduler
+    from sidefridge.supervision import running_scripts
+
+    # scripts are detected once, then only hooks changed on disk are rescanned before a run
+    scripts_detector.watch()
+    scheduler = Scheduler(
+        cron_schedule=os.environ[CRON_BACKUP_SCHEDULE],
+        run=lambda fire_time: start_run(scripts_detector, fire_time),
+        last_fire_time=get_run_coordinator().load_last_fire_time(),
+        missed_run_policy=get_missed_run_policy(),
+        offset=get_schedule_offset(),
+        # Kubernetes sends SIGTERM once, scripts in their own sessions would only get the SIGKILL that follows
+        on_stop=running_scripts.stop
+    )
+    scheduler.install_signal_handlers()
+    scheduler.serve_forever()
 
 
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] in SUBCOMMANDS:
+        return importlib.import_module(SUBCOMMANDS[sys.argv[1]]).main(sys.argv[2:])
+
+    import argparse
+
     parser = argparse.ArgumentParser(
-        description='Tool for running and initializing backup container'
+        description='Tool for running and initializing backup container',
+        epilog='subcommands: %s, use `fridge SUBCOMMAND --help` for details' % ', '.join(sorted(SUBCOMMANDS))
     )
     parser.add_argument(
         '-i', '--initialize', action='store_true',
@@ -101,6 +377,14 @@ def main():
         '-r', '--run', action='store_true',
         help='runs scrips following the lifecycle'
     )
+    parser.add_argument(
+        '--delay', type=int, default=0, metavar='SECONDS',
+        help='with --run, waits before running, the crontab passes the offset of this pod'
+    )
+    parser.add_argument(
+        '-d', '--daemon', action='store_true',
+        help='stays in foreground and runs scripts on the cron schedule, replaces crond'
+    )
     parser.add_argument(
         '-csp', '--container-scripts-path', default='/scripts',
         help='path to scripts folder, default /scripts'
@@ -112,6 +396,21 @@ def main():
 
     arguments = parser.parse_args()
 
+    # croniter is slow to import, loaded once arguments are known to be valid, like the modules of the runner
+    from croniter import croniter
+
+    from sidefridge.checkpoint import RUN_CHECKPOINTS, get_checkpoint_ttl, is_checkpointing_enabled
+    from sidefridge.coordination import (
+        MISSED_IGNORE, MISSED_RUN_POLICY, InvalidCoordinationSettings, get_missed_run_policy, get_overlap_policy,
+        get_schedule_spread, warn_if_state_not_persistent
+    )
+    from sidefridge.leases import get_lease_pool
+    from sidefridge.parallel import InvalidConcurrencySettings, get_failure_policy, get_max_workers
+    from sidefridge.scripts import SUPPORTED_DIRECTORIES, ScriptsDetector
+    from sidefridge.supervision import InvalidSupervisionSettings, Supervisor
+    from sidefridge.throttling import InvalidThrottleSettings, get_cgroup_root, load_policy, prepare_cgroup
+    from sidefridge.warm import start_warm_worker, stop_warm_worker
+
     if CRON_BACKUP_SCHEDULE not in os.environ:
         print_logger("Could not find '%s' in the environment variables" % CRON_BACKUP_SCHEDULE)
         exit(1)
@@ -120,16 +419,47 @@ def main():
         print_logger("Provided cron schedule '%s' is not valid" % os.environ[CRON_BACKUP_SCHEDULE])
         exit(1)
 
+    try:
+        get_max_workers()
+        get_failure_policy()
+        get_overlap_policy()
+        get_missed_run_policy()
+        get_schedule_spread()
+        get_lease_pool()
+        get_checkpoint_ttl()
+        for hook_name in SUPPORTED_DIRECTORIES:
+            Supervisor(hook_name)
+    except (InvalidConcurrencySettings, InvalidCoordinationSettings, InvalidSupervisionSettings) as e:
+        print_logger(e)
+        exit(1)
+
     # check if provided directory exists
     if not os.path.isdir(arguments.container_scripts_path):
         print_logger("The following path '%s' is not a valid directory" % arguments.container_scripts_path)
         exit(1)
 
-    if not arguments.initialize and not arguments.run:
+    try:
+        for hook_name in SUPPORTED_DIRECTORIES:
+            policy = load_policy(arguments.container_scripts_path, hook_name)
+            # limits which cannot be applied stop the container now, not silently at every run
+            if policy.cpu_max is not None or policy.io_max is not None:
+                prepare_cgroup(get_cgroup_root(), hook_name, policy.cpu_max, policy.io_max)
+    except InvalidThrottleSettings as e:
+        print_logger(e)
+        exit(1)
+
+    if not arguments.initialize and not arguments.run and not arguments.daemon:
         print_logger("Nothing to do.\nPlease run: 'fridge --help' to see possible options")
         exit(1)
 
-    scripts_detector = ScriptsDetector(arguments.container_scripts_path)
+    stateful_settings = []
+    if arguments.daemon and get_missed_run_policy() != MISSED_IGNORE:
+        stateful_settings.append(MISSED_RUN_POLICY)
+    if is_checkpointing_enabled():
+        stateful_settings.append(RUN_CHECKPOINTS)
+    warn_if_state_not_persistent(stateful_settings)
+
+    scripts_detector = ScriptsDetector(arguments.container_scripts_path, decompress_dir=SCRIPTS_CACHE_PATH)
     scripts_detector.list_detected_scripts()
 
     if arguments.initialize:
@@ -137,10 +467,22 @@ def main():
         start_initialize(scripts_detector, arguments.cron_path)
         print_logger("Initialization complete.")
 
-    if arguments.run:
-        print_logger("Running...")
-        start_run(scripts_detector)
-        print_logger("Finished running.")
+    # forked before the run starts any thread, after dependencies are installed so it can preload them
+    if arguments.run or arguments.daemon:
+        start_warm_worker()
+
+    try:
+        if arguments.run:
+            print_logger("Running...")
+            start_run(scripts_detector, delay=max(arguments.delay, 0))
+            print_logger("Finished running.")
+
+        if arguments.daemon:
+            print_logger("Starting scheduler...")
+            start_daemon(scripts_detector)
+            print_logger("Scheduler stopped.")
+    finally:
+        stop_warm_worker()
 
 
 if __name__ == '__main__':
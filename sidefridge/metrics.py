@@ -0,0 +1,189 @@
+import datetime
+import json
+import os
+import threading
+import time
+
+from sidefridge.utils import print_logger
+
+METRICS_JSON_PATH = "METRICS_JSON_PATH"
+METRICS_TEXTFILE_PATH = "METRICS_TEXTFILE_PATH"
+
+# values summed over the scripts of a hook or of a run, peak memory is the maximum instead
+SUMMED_FIELDS = ('user_cpu_seconds', 'system_cpu_seconds', 'stdout_bytes', 'stderr_bytes')
+
+PROMETHEUS_METRICS = (
+    ('duration_seconds', 'wall_seconds', 'Wall clock duration in seconds'),
+    ('cpu_user_seconds', 'user_cpu_seconds', 'User CPU time in seconds'),
+    ('cpu_system_seconds', 'system_cpu_seconds', 'System CPU time in seconds'),
+    ('max_rss_bytes', 'max_rss_bytes', 'Peak resident set size in bytes'),
+    ('stdout_bytes', 'stdout_bytes', 'Bytes written to stdout'),
+    ('stderr_bytes', 'stderr_bytes', 'Bytes written to stderr'),
+)
+
+
+def returncode_from_status(status):
+    """ The returncode Popen would report for a wait() status, negative if the process was killed by a signal """
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def wait_with_usage(process):
+    """ Reaps process like Popen.wait() does, also returning the resource usage of the process """
+    # scripts forked by the warm worker are not children of this process, the worker reports how they ended
+    if hasattr(process, 'wait_with_usage'):
+        return process.wait_with_usage()
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = returncode_from_status(status)
+    return process.returncode, usage
+
+
+def summarize(records, wall_seconds):
+    """ Totals of script records, wall time is measured separately as scripts may run concurrently """
+    summary = dict(wall_seconds=round(wall_seconds, 6), scripts=len(records))
+    for field in SUMMED_FIELDS:
+        summary[field] = round(sum(record[field] for record in records), 6)
+    summary['max_rss_bytes'] = max([record['max_rss_bytes'] for record in records] or [0])
+    summary['failed_scripts'] = sum(1 for record in records if record['exit_code'] != 0)
+    return summary
+
+
+class HookMetrics(object):
+    """ Collects the measurements of the scripts of a hook, scripts may finish on different threads """
+
+    def __init__(self, name):
+        self.name = name
+        self.records = []
+        self._lock = threading.Lock()
+        self._started = time.monotonic()
+        self.wall_seconds = None
+
+    def record(self, script, exit_code, wall_seconds, usage, stdout_bytes, stderr_bytes):
+        record = dict(
+            hook=self.name,
+            script=os.path.basename(script),
+            exit_code=exit_code,
+            wall_seconds=round(wall_seconds, 6),
+            user_cpu_seconds=round(usage.ru_utime, 6),
+            system_cpu_seconds=round(usage.ru_stime, 6),
+            # ru_maxrss is reported in kilobytes on Linux
+            max_rss_bytes=usage.ru_maxrss * 1024,
+            stdout_bytes=stdout_bytes,
+            stderr_bytes=stderr_bytes,
+        )
+        with self._lock:
+            self.records.append(record)
+        print_logger("Script '%s' took %.2fs, cpu %.2fs user %.2fs system, peak rss %d MiB" % (
+            script, wall_seconds, usage.ru_utime, usage.ru_stime, record['max_rss_bytes'] // (1024 * 1024)
+        ))
+
+    def finish(self):
+        if self.wall_seconds is None:
+            self.wall_seconds = time.monotonic() - self._started
+
+    def summary(self):
+        return summarize(self.records, self.wall_seconds or 0.0)
+
+
+class RunMetrics(object):
+    """ Measurements of every script of a run, published as JSON lines and as a Prometheus textfile """
+
+    def __init__(self):
+        self.hooks = []
+        self.started = time.time()
+        self.wall_seconds = 0.0
+        self.success = False
+
+    def hook(self, name):
+        hook = HookMetrics(name)
+        self.hooks.append(hook)
+        return hook
+
+    def finish(self, success):
+        for hook in self.hooks:
+            hook.finish()
+        self.wall_seconds = time.time() - self.started
+        self.success = success
+
+    def summary(self):
+        records = [record for hook in self.hooks for record in hook.records]
+        summary = summarize(records, self.wall_seconds)
+        summary['success'] = self.success
+        return summary
+
+    def json_lines(self):
+        started = datetime.datetime.fromtimestamp(self.started).isoformat()
+        lines = []
+        for hook in self.hooks:
+            for record in hook.records:
+                lines.append(dict(type='script', run_started=started, **record))
+            lines.append(dict(type='hook', run_started=started, hook=hook.name, **hook.summary()))
+        lines.append(dict(type='run', run_started=started, **self.summary()))
+        return ''.join(json.dumps(line, sort_keys=True) + '\n' for line in lines)
+
+    def prometheus_text(self):
+        samples = []
+        for hook in self.hooks:
+            for record in hook.records:
+                samples.append(('script', dict(hook=hook.name, script=record['script']), record))
+            samples.append(('hook', dict(hook=hook.name), hook.summary()))
+        samples.append(('run', {}, self.summary()))
+
+        lines = []
+        for scope in ('script', 'hook', 'run'):
+            for suffix, field, description in PROMETHEUS_METRICS:
+                name = 'sidefridge_%s_%s' % (scope, suffix)
+                lines.append('# HELP %s %s of the last run, per %s' % (name, description, scope))
+                lines.append('# TYPE %s gauge' % name)
+                for sample_scope, labels, values in samples:
+                    if sample_scope == scope:
+                        lines.append('%s%s %s' % (name, format_labels(labels), values[field]))
+
+        lines.append('# HELP sidefridge_script_exit_code Exit code of the script in the last run')
+        lines.append('# TYPE sidefridge_script_exit_code gauge')
+        for sample_scope, labels, values in samples:
+            if sample_scope == 'script':
+                lines.append('sidefridge_script_exit_code%s %d' % (format_labels(labels), values['exit_code']))
+
+        lines.append('# HELP sidefridge_run_success Whether the last run completed without errors')
+        lines.append('# TYPE sidefridge_run_success gauge')
+        lines.append('sidefridge_run_success %d' % self.success)
+        lines.append('# HELP sidefridge_run_timestamp_seconds Time the last run started')
+        lines.append('# TYPE sidefridge_run_timestamp_seconds gauge')
+        lines.append('sidefridge_run_timestamp_seconds %.3f' % self.started)
+        return '\n'.join(lines) + '\n'
+
+    def publish(self):
+        """ Writes the metrics to the destinations configured in the environment, never fails the run """
+        json_path = os.environ.get(METRICS_JSON_PATH)
+        textfile_path = os.environ.get(METRICS_TEXTFILE_PATH)
+        try:
+            if json_path:
+                # a single append keeps the lines of concurrent writers from interleaving
+                with open(json_path, 'a') as json_file:
+                    json_file.write(self.json_lines())
+            if textfile_path:
+                # the textfile collector may read at any time, the file is replaced atomically
+                tmp_path = '%s.%d.tmp' % (textfile_path, os.getpid())
+                with open(tmp_path, 'w') as textfile:
+                    textfile.write(self.prometheus_text())
+                os.replace(tmp_path, textfile_path)
+        except OSError as e:
+            print_logger("Could not write metrics: %s" % e)
+
+        summary = self.summary()
+        print_logger("Run took %.2fs, cpu %.2fs user %.2fs system, peak rss %d MiB, %d script(s) failed" % (
+            summary['wall_seconds'], summary['user_cpu_seconds'], summary['system_cpu_seconds'],
+            summary['max_rss_bytes'] // (1024 * 1024), summary['failed_scripts']
+        ))
+
+
+def _escape_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (key, _escape_label(value)) for key, value in sorted(labels.items()))
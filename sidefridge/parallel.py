@@ -0,0 +1,120 @@
+import os
+import re
+import signal
+import threading
+
+from sidefridge.supervision import signal_group
+
+BACKUPS_MAX_WORKERS = "BACKUPS_MAX_WORKERS"
+BACKUPS_FAILURE_POLICY = "BACKUPS_FAILURE_POLICY"
+
+FAILURE_POLICY_CANCEL = 'cancel'
+FAILURE_POLICY_WAIT = 'wait'
+FAILURE_POLICIES = {FAILURE_POLICY_CANCEL, FAILURE_POLICY_WAIT}
+
+# scripts named like `10_db.sh` and `10-files.sh` belong to the same ordering group
+GROUP_PREFIX = re.compile(r'^(\d+)[-_.]')
+
+
+class InvalidConcurrencySettings(Exception):
+    pass
+
+
+def get_max_workers():
+    value = os.environ.get(BACKUPS_MAX_WORKERS, '1')
+    try:
+        max_workers = int(value)
+    except ValueError:
+        raise InvalidConcurrencySettings("'%s' must be an integer, got '%s'" % (BACKUPS_MAX_WORKERS, value))
+    return max(max_workers, 1)
+
+
+def get_failure_policy():
+    policy = os.environ.get(BACKUPS_FAILURE_POLICY, FAILURE_POLICY_CANCEL).lower()
+    if policy not in FAILURE_POLICIES:
+        raise InvalidConcurrencySettings(
+            "'%s' must be one of %s, got '%s'" % (BACKUPS_FAILURE_POLICY, sorted(FAILURE_POLICIES), policy)
+        )
+    return policy
+
+
+def group_scripts(scripts):
+    """
+    Splits scripts in ordering groups based on the value of their numeric file name prefix: `9_a.sh` runs before
+    `10_b.sh`, `1_a.sh` and `01_b.sh` share a group. Scripts without a prefix form a single group, run last.
+    Scripts keep their order inside a group.
+    """
+    groups = {}
+    for script in scripts:
+        match = GROUP_PREFIX.match(os.path.basename(script))
+        group_key = int(match.group(1)) if match else None
+        groups.setdefault(group_key, []).append(script)
+    return [groups[key] for key in sorted(groups, key=lambda key: (key is None, key or 0))]
+
+
+class ProcessTracker(object):
+    """ Keeps track of running scripts so they can be terminated when a sibling fails """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._processes = set()
+        self.cancelled = False
+        self.error = None
+
+    def started(self, process):
+        with self._lock:
+            self._processes.add(process)
+            if self.cancelled:
+                signal_group(process, signal.SIGTERM)
+
+    def finished(self, process):
+        with self._lock:
+            self._processes.discard(process)
+
+    def failed(self, error):
+        with self._lock:
+            if self.error is None:
+                self.error = error
+
+    def cancel(self):
+        with self._lock:
+            self.cancelled = True
+            for process in self._processes:
+                signal_group(process, signal.SIGTERM)
+
+
+def _run_tracked(run_script, script, tracker):
+    if tracker.cancelled:
+        return
+    try:
+        run_script(script, tracker=tracker)
+    except Exception as e:
+        tracker.failed(e)
+        raise
+
+
+def run_scripts_concurrently(scripts, run_script, max_workers, failure_policy):
+    """
+    Runs scripts with at most max_workers at a time, ordering groups run one after the other.
+    The first error is raised once the running scripts were cancelled or finished, as the policy requires.
+    """
+    # imported here, most runs do not use concurrency and the module is slow to import
+    from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
+
+    tracker = ProcessTracker()
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for group in group_scripts(scripts):
+            futures = [executor.submit(_run_tracked, run_script, script, tracker) for script in group]
+
+            if failure_policy == FAILURE_POLICY_CANCEL:
+                _, not_done = wait(futures, return_when=FIRST_EXCEPTION)
+                if tracker.error is not None:
+                    for future in not_done:
+                        future.cancel()
+                    tracker.cancel()
+
+            wait(futures)
+
+            if tracker.error is not None:
+                raise tracker.error
@@ -0,0 +1,255 @@
+import argparse
+import hashlib
+import os
+import sys
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from sidefridge.throttling import THROTTLE_BANDWIDTH, TokenBucket
+
+COMPRESSION_GZIP = 'gzip'
+COMPRESSION_ZSTD = 'zstd'
+COMPRESSION_NONE = 'none'
+EXTENSIONS = {COMPRESSION_GZIP: '.gz', COMPRESSION_ZSTD: '.zst', COMPRESSION_NONE: ''}
+# levels accepted by each compression, like the gzip and zstd command line tools
+LEVEL_RANGES = {COMPRESSION_GZIP: (1, 9), COMPRESSION_ZSTD: (1, 22)}
+
+SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
+
+class PipelineError(Exception):
+    pass
+
+
+def parse_size(value):
+    """ Parses sizes like `512K`, `4M` or `2G` into bytes """
+    value = value.strip().upper().rstrip('B')
+    unit = value[-1:] if value[-1:] in SIZE_UNITS else ''
+    try:
+        size = int(value[:len(value) - len(unit)]) * SIZE_UNITS[unit]
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid size '%s'" % value)
+    if size <= 0:
+        raise argparse.ArgumentTypeError("size must be positive")
+    return size
+
+
+def gzip_compressor(level):
+    def compress(block):
+        # every block is a complete gzip member, concatenated members are a valid gzip stream
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return compressor.compress(block) + compressor.flush()
+    return compress
+
+
+def zstd_compressor(level):
+    try:
+        import zstandard
+    except ImportError:
+        raise PipelineError("zstd compression requires the 'zstandard' package, install it with pip")
+
+    def compress(block):
+        # every block is a complete frame, concatenated frames are a valid zstd stream
+        return zstandard.ZstdCompressor(level=level).compress(block)
+    return compress
+
+
+def get_compressor(compression, level):
+    if compression == COMPRESSION_GZIP:
+        return gzip_compressor(6 if level is None else level)
+    if compression == COMPRESSION_ZSTD:
+        return zstd_compressor(3 if level is None else level)
+    return lambda block: block
+
+
+class PartWriter(object):
+    """
+    Writes a stream to fixed size parts named `<path>.partNNNN`, or to a single file when part_size is None,
+    computing the SHA-256 of each part and of the whole stream.
+    """
+
+    def __init__(self, path, part_size=None):
+        self.path = path
+        self.part_size = part_size
+        self.total_hash = hashlib.sha256()
+        self.parts = []
+        self._file = None
+        self._part_hash = None
+        self._part_written = 0
+
+    def _part_path(self):
+        if self.part_size is None:
+            return self.path
+        return '%s.part%04d' % (self.path, len(self.parts))
+
+    def _open_part(self):
+        self._file = open(self._part_path(), 'wb')
+        self._part_hash = hashlib.sha256()
+        self._part_written = 0
+
+    def _close_part(self):
+        self._file.close()
+        self.parts.append((self._file.name, self._part_hash.hexdigest()))
+        self._file = None
+
+    def write(self, data):
+        self.total_hash.update(data)
+        view = memoryview(data)
+        while len(view):
+            if self._file is None:
+                self._open_part()
+            room = len(view) if self.part_size is None else self.part_size - self._part_written
+            chunk = view[:room]
+            self._file.write(chunk)
+            self._part_hash.update(chunk)
+            self._part_written += len(chunk)
+            view = view[len(chunk):]
+            if self.part_size is not None and self._part_written >= self.part_size:
+                self._close_part()
+
+    def close(self):
+        if self._file is not None:
+            self._close_part()
+        if not self.parts:
+            # empty input still produces an (empty) output file
+            self._open_part()
+            self._close_part()
+
+
+class StreamWriter(object):
+    """ Writes the stream to a binary file object like stdout """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.total_hash = hashlib.sha256()
+        self.parts = []
+
+    def write(self, data):
+        self.total_hash.update(data)
+        self.stream.write(data)
+
+    def close(self):
+        self.stream.flush()
+
+
+def read_blocks(stream, block_size):
+    while True:
+        block = stream.read(block_size)
+        if not block:
+            return
+        yield block
+
+
+def run_pipeline(source, writer, compress, block_size, threads, bandwidth=None):
+    """
+    Compresses blocks read from source on a thread pool and writes them in order. At most two blocks per
+    thread are in flight, memory use depends on block size and threads but not on the size of the stream.
+    With a bandwidth token bucket, writes wait for tokens and reading slows down with them.
+    Returns the number of bytes read.
+    """
+    def write(data):
+        if bandwidth is not None:
+            bandwidth.consume(len(data))
+        writer.write(data)
+
+    bytes_read = 0
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        for block in read_blocks(source, block_size):
+            bytes_read += len(block)
+            pending.append(executor.submit(compress, block))
+            if len(pending) >= 2 * threads:
+                write(pending.popleft().result())
+        while pending:
+            write(pending.popleft().result())
+    writer.close()
+    return bytes_read
+
+
+def write_checksums(path, parts):
+    """ Checksums file in the format accepted by `sha256sum -c` """
+    with open(path, 'w') as f:
+        for part_path, digest in parts:
+            f.write("%s  %s\n" % (digest, os.path.basename(part_path)))
+
+
+def main(argv=None):
+    """ Compresses, checksums and splits data read from stdin: `mongodump --archive | fridge pipe -o /backups` """
+    parser = argparse.ArgumentParser(
+        prog='fridge pipe',
+        description='Compresses stdin with parallel blocks, computes SHA-256 and splits output in parts'
+    )
+    parser.add_argument(
+        '-o', '--output', default='-',
+        help="directory where the parts are written, '-' writes the stream to stdout (default)"
+    )
+    parser.add_argument(
+        '-n', '--name', default='backup',
+        help='base name of the written files, the compression extension is added, default backup'
+    )
+    parser.add_argument(
+        '-c', '--compression', choices=sorted(EXTENSIONS), default=COMPRESSION_GZIP,
+        help='compression format, default gzip'
+    )
+    parser.add_argument(
+        '-l', '--level', type=int, default=None,
+        help='compression level, 1-9 for gzip (default 6) and 1-22 for zstd (default 3)'
+    )
+    parser.add_argument(
+        '-t', '--threads', type=int, default=os.cpu_count() or 1,
+        help='compression threads, defaults to the number of CPUs'
+    )
+    parser.add_argument(
+        '-b', '--block-size', type=parse_size, default=parse_size('4M'),
+        help='size of the blocks compressed independently, default 4M'
+    )
+    parser.add_argument(
+        '-s', '--part-size', type=parse_size, default=None,
+        help='splits the output in parts of this size (like 1G), by default a single file is written'
+    )
+    parser.add_argument(
+        '--bandwidth', type=parse_size, default=os.environ.get(THROTTLE_BANDWIDTH) or None,
+        help='limits the output to this many bytes per second (like 20M), defaults to THROTTLE_BANDWIDTH'
+    )
+
+    arguments = parser.parse_args(argv)
+
+    if arguments.level is not None:
+        if arguments.compression not in LEVEL_RANGES:
+            parser.error("argument -l/--level: not allowed with --compression %s" % arguments.compression)
+        low, high = LEVEL_RANGES[arguments.compression]
+        if not low <= arguments.level <= high:
+            parser.error("argument -l/--level: %s levels go from %d to %d, got %d" % (
+                arguments.compression, low, high, arguments.level
+            ))
+
+    # stdout may carry the data, errors and statistics go to stderr
+    if arguments.output != '-' and not os.path.isdir(arguments.output):
+        parser.exit(1, "The following path '%s' is not a valid directory\n" % arguments.output)
+    if arguments.output == '-' and arguments.part_size is not None:
+        parser.error("--part-size requires an output directory")
+
+    try:
+        compress = get_compressor(arguments.compression, arguments.level)
+    except PipelineError as e:
+        parser.exit(1, "%s\n" % e)
+
+    file_name = arguments.name + EXTENSIONS[arguments.compression]
+    if arguments.output == '-':
+        writer = StreamWriter(sys.stdout.buffer)
+    else:
+        writer = PartWriter(os.path.join(arguments.output, file_name), arguments.part_size)
+
+    bandwidth = TokenBucket(arguments.bandwidth) if arguments.bandwidth is not None else None
+
+    bytes_read = run_pipeline(
+        sys.stdin.buffer, writer, compress, arguments.block_size, max(arguments.threads, 1), bandwidth
+    )
+
+    if writer.parts:
+        write_checksums(os.path.join(arguments.output, file_name + '.sha256'), writer.parts)
+
+    sys.stderr.write("read %d bytes, wrote %d part(s), sha256 %s\n" % (
+        bytes_read, max(len(writer.parts), 1), writer.total_hash.hexdigest()
+    ))
@@ -1,4 +1,7 @@
+import hashlib
 import os
+import shutil
+import struct
 
 from sidefridge.utils import print_logger
 
@@ -10,28 +13,228 @@ ON_ERROR = 'on_error'
 
 SUPPORTED_DIRECTORIES = {AFTER_BACKUPS, BACKUPS, BEFORE_BACKUPS, INSTALL_DEPENDENCIES, ON_ERROR}
 
+# mounted ConfigMaps keep their content in `..data` and `..<timestamp>` entries, each key is a symlink into them
+CONFIG_MAP_PREFIX = '..'
+
+# codegen stores large scripts gzip compressed in binaryData, under their name with this suffix
+COMPRESSED_SUFFIX = '.gz'
+
+# inotify(7) constants, the module has no dependencies so they are declared here
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+INOTIFY_EVENT = struct.Struct('iIII')
+WATCH_MASK = (
+    IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE |
+    IN_DELETE_SELF | IN_MOVE_SELF
+)
+
+
+def _stat_key(stat):
+    return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+
+def file_digest(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def decompress_script(source, destination):
+    """ Writes the decompressed content of a gzip compressed script to destination, atomically and executable """
+    import gzip
+
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    tmp_path = '%s.%d.tmp' % (destination, os.getpid())
+    with gzip.open(source, 'rb') as compressed, open(tmp_path, 'wb') as f:
+        shutil.copyfileobj(compressed, f)
+    os.chmod(tmp_path, 0o755)
+    os.replace(tmp_path, destination)
+
+
+def _script_entries(hook_path):
+    """
+    Yields the DirEntry and stat of each script of a hook directory, symlinks are followed. Returns nothing
+    when the directory does not exist.
+    """
+    try:
+        entries = sorted(os.scandir(hook_path), key=lambda entry: entry.name)
+    except (FileNotFoundError, NotADirectoryError):
+        return
+    for entry in entries:
+        if entry.name.startswith(CONFIG_MAP_PREFIX):
+            continue
+        try:
+            if entry.is_file():
+                yield entry, entry.stat()
+        except FileNotFoundError:
+            # dangling symlink, the ConfigMap is being swapped
+            continue
+
+
+def scan_hook(hook_path, previous=None, decompress_dir=None):
+    """
+    Scripts of a hook directory in execution order, mapped to their stat key and SHA-256. Files whose stat did
+    not change since the previous scan keep their digest without being read again.
+    With a decompress_dir, compressed scripts are decompressed in it and indexed under their decompressed path,
+    again only when they changed.
+    Returns None when the directory does not exist.
+    """
+    if not os.path.isdir(hook_path):
+        return None
+    previous = previous or {}
+    scripts = {}
+    for entry, stat in _script_entries(hook_path):
+        stat_key = _stat_key(stat)
+        path = entry.path
+        if decompress_dir is not None and entry.name.endswith(COMPRESSED_SUFFIX):
+            path = os.path.join(
+                decompress_dir, os.path.basename(hook_path), entry.name[:-len(COMPRESSED_SUFFIX)]
+            )
+        known = previous.get(path)
+        if known is not None and known[0] == stat_key and os.path.isfile(path):
+            scripts[path] = known
+            continue
+        try:
+            digest = file_digest(entry.path)
+            if path != entry.path:
+                decompress_script(entry.path, path)
+        except FileNotFoundError:
+            continue
+        scripts[path] = (stat_key, digest)
+    return scripts
+
+
+class InotifyWatcher(object):
+    """ Reports hooks whose directory changed, events are read without blocking when asked for """
+
+    def __init__(self, scripts_path, hooks):
+        import ctypes
+
+        self.scripts_path = scripts_path
+        self.hooks = hooks
+        # the symbols of the running process, the C library is found on glibc and on musl (Alpine) alike
+        self._libc = ctypes.CDLL(None, use_errno=True)
+        self._fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        self._watches = {}
+        self._add_watch(scripts_path, None)
+        for hook in hooks:
+            self._add_watch(os.path.join(scripts_path, hook), hook)
+
+    def _add_watch(self, path, hook):
+        if not os.path.isdir(path):
+            return
+        watch = self._libc.inotify_add_watch(self._fd, os.fsencode(path), WATCH_MASK)
+        if watch >= 0:
+            self._watches[watch] = hook
+
+    def _read_events(self):
+        while True:
+            try:
+                data = os.read(self._fd, 64 * 1024)
+            except BlockingIOError:
+                return
+            offset = 0
+            while offset < len(data):
+                watch, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+                name = data[offset + INOTIFY_EVENT.size:offset + INOTIFY_EVENT.size + length].rstrip(b'\0')
+                offset += INOTIFY_EVENT.size + length
+                yield watch, mask, os.fsdecode(name)
+
+    def changed_hooks(self):
+        changed = set()
+        for watch, mask, name in self._read_events():
+            if mask & IN_Q_OVERFLOW:
+                changed.update(self.hooks)
+                continue
+            hook = self._watches.get(watch)
+            if mask & IN_IGNORED:
+                # the directory was removed or unmounted
+                self._watches.pop(watch, None)
+                if hook is not None:
+                    changed.add(hook)
+                continue
+            if hook is not None:
+                changed.add(hook)
+            elif name in self.hooks and mask & (IN_CREATE | IN_MOVED_TO | IN_MOVED_FROM | IN_DELETE):
+                # a hook directory appeared or went away in the scripts directory
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    self._add_watch(os.path.join(self.scripts_path, name), name)
+                changed.add(name)
+        return changed
+
+    def close(self):
+        os.close(self._fd)
+
+
+class PollingWatcher(object):
+    """ Fallback when inotify is not available, compares the stat of every script with the previous call """
+
+    def __init__(self, scripts_path, hooks):
+        self.scripts_path = scripts_path
+        self.hooks = hooks
+        self._signatures = {hook: self._signature(hook) for hook in hooks}
+
+    def _signature(self, hook):
+        hook_path = os.path.join(self.scripts_path, hook)
+        if not os.path.isdir(hook_path):
+            return None
+        return [(entry.name, _stat_key(stat)) for entry, stat in _script_entries(hook_path)]
+
+    def changed_hooks(self):
+        changed = set()
+        for hook in self.hooks:
+            signature = self._signature(hook)
+            if signature != self._signatures[hook]:
+                self._signatures[hook] = signature
+                changed.add(hook)
+        return changed
+
+    def close(self):
+        pass
+
 
 class ScriptsDetector(object):
-    def __init__(self, scripts_path):
+    """
+    Index of the scripts of each hook with their SHA-256. Once watch() was called, refresh() rescans the hooks
+    changed since the previous call, ConfigMap updates apply without restarting and unchanged hooks cost nothing.
+    Compressed scripts are run from decompress_dir when one is given.
+    """
+
+    def __init__(self, scripts_path, decompress_dir=None):
         self.path = scripts_path
+        self.decompress_dir = decompress_dir
+        self.index = {}
         self.detected_scripts = []
+        self._watcher = None
+        self._scan(SUPPORTED_DIRECTORIES)
 
-        sub_dirs_in_path = [
-            x for x in os.listdir(self.path)
-            if os.path.isdir(os.path.join(self.path, x)) and x in SUPPORTED_DIRECTORIES
+    def _scan(self, hooks):
+        for hook in hooks:
+            scripts = scan_hook(os.path.join(self.path, hook), self.index.get(hook), self.decompress_dir)
+            if scripts is None:
+                self.index.pop(hook, None)
+            else:
+                self.index[hook] = scripts
+        self.detected_scripts = [
+            (hook, sorted(scripts, key=os.path.basename)) for hook, scripts in sorted(self.index.items())
         ]
 
-        for sub_dir in sub_dirs_in_path:
-            files = sorted([
-                os.path.join(self.path, sub_dir, x) for x in os.listdir(os.path.join(self.path, sub_dir))
-                if os.path.isfile(os.path.join(self.path, sub_dir, x))
-            ])
-
-            self.detected_scripts.append((sub_dir, files))
-            setattr(self, "_" + sub_dir, files)
-
     def _get_attribute(self, attribute_name):
-        return getattr(self, "_" + attribute_name, [])
+        # decompressed scripts live in another directory, the execution order only depends on the file name
+        return sorted(self.index.get(attribute_name, ()), key=os.path.basename)
 
     @property
     def after_backups(self):
@@ -53,6 +256,49 @@ class ScriptsDetector(object):
     def on_error(self):
         return self._get_attribute(ON_ERROR)
 
+    def digest(self, script):
+        """ SHA-256 of a detected script """
+        for scripts in self.index.values():
+            if script in scripts:
+                return scripts[script][1]
+        raise KeyError(script)
+
+    def watch(self):
+        """ Starts watching the hook directories with inotify, polling is used when inotify is not available """
+        try:
+            self._watcher = InotifyWatcher(self.path, SUPPORTED_DIRECTORIES)
+        except (OSError, AttributeError) as e:
+            print_logger("WARNING: inotify is not available (%s), scripts are polled for changes before each run" % e)
+            self._watcher = PollingWatcher(self.path, SUPPORTED_DIRECTORIES)
+
+    def refresh(self):
+        """ Rescans the hooks changed since the last call, returns the hooks whose scripts were changed """
+        if self._watcher is None:
+            return set()
+        hooks = self._watcher.changed_hooks()
+        if not hooks:
+            return set()
+
+        previous = {hook: dict(self.index.get(hook, {})) for hook in hooks}
+        self._scan(hooks)
+        changed = set()
+        for hook in sorted(hooks):
+            before, after = previous[hook], self.index.get(hook, {})
+            added = sorted(set(after) - set(before))
+            removed = sorted(set(before) - set(after))
+            modified = sorted(path for path in set(before) & set(after) if before[path][1] != after[path][1])
+            if added or removed or modified:
+                changed.add(hook)
+                print_logger("Scripts of '%s' changed, added: %s, removed: %s, modified: %s" % (
+                    hook, added, removed, modified
+                ))
+        return changed
+
+    def close(self):
+        if self._watcher is not None:
+            self._watcher.close()
+            self._watcher = None
+
     def list_detected_scripts(self):
         message = "\n** Detected scripts **\n"
         for category, scripts in self.detected_scripts:
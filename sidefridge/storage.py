@@ -1,29 +1,51 @@
-import argparse
+import fcntl
 import json
-import uuid
+import sys
+import threading
 import os
+from contextlib import contextmanager
 from os import path
+from types import SimpleNamespace
+
+# store_var and load_var are started many times by each script, heavier modules are imported where used
 
 TMP_STORE = '/tmp/sidefridge_storage_path'
 
+# set while a run is in progress, points to the socket of the storage server
+STORE_SOCKET = 'SIDEFRIDGE_STORE_SOCKET'
+
+READ_OPERATIONS = {'get', 'items'}
+
+LOCK_SUFFIX = '.lock'
+# records appended before the log is flushed to disk
+FSYNC_EVERY = 32
+# log size in bytes after which stale records are compacted away
+COMPACT_THRESHOLD = 1024 * 1024
+
+
+class StorageError(Exception):
+    pass
+
 
 def get_storage_path():
     """ If no storage is setup it will get initialized """
     if not path.isfile(TMP_STORE):
-        with open(TMP_STORE, 'w') as f:
+        # link is atomic, when scripts race to initialize the storage all of them end up using the same one
+        tmp_path = '%s.%d' % (TMP_STORE, os.getpid())
+        with open(tmp_path, 'w') as f:
+            import uuid
             f.write(str(uuid.uuid4()))
+        try:
+            os.link(tmp_path, TMP_STORE)
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(tmp_path)
 
     with open(TMP_STORE) as f:
         store_name = f.read()
 
-    store_path = path.join('/tmp', store_name)
-
-    # recreate empty file if missing
-    if not path.isfile(store_path):
-        with open(store_path, 'w') as f:
-            f.write('{}')
-
-    return store_path
+    return path.join('/tmp', store_name)
 
 
 def clear_storage():
@@ -37,58 +59,500 @@ def clear_storage():
     store_path = path.join('/tmp', store_name)
 
     # removing files
-    os.remove(store_path)
-    os.remove(TMP_STORE)
+    for file_path in (store_path, store_path + LOCK_SUFFIX, TMP_STORE):
+        if path.exists(file_path):
+            os.remove(file_path)
 
 
 def load_dict():
     """ Returns dictionary stored on disk """
-    with open(get_storage_path(), 'r') as f:
-        return json.load(f)
+    store = LogStore(get_storage_path())
+    try:
+        return store.request('items')
+    finally:
+        store.close()
 
 
 def store_dict(dict_data):
-    """ Writes dictionary to disk """
-    with open(get_storage_path(), 'w') as f:
-        json.dump(dict_data, f)
+    """ Replaces the dictionary stored on disk """
+    store = LogStore(get_storage_path())
+    try:
+        with store.locked(exclusive=True):
+            store.rewrite(dict_data)
+    finally:
+        store.close()
 
 
-def store_var():
-    """ Stores the first argument as key and the second argument as value """
+class KeyValueStore(object):
+    """ In memory store, every operation is atomic """
+
+    def __init__(self, data=None):
+        self._lock = threading.Lock()
+        self._data = {} if data is None else data
+
+    def get(self, key, default=None):
+        with self._lock:
+            return self._data.get(key, default)
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            return value
+
+    def delete(self, key):
+        with self._lock:
+            return self._data.pop(key, None)
+
+    def incr(self, key, amount=1):
+        with self._lock:
+            try:
+                value = str(int(self._data.get(key) or 0) + int(amount))
+            except ValueError:
+                raise StorageError("Value of '%s' is not an integer" % key)
+            self._data[key] = value
+            return value
+
+    def append(self, key, value):
+        with self._lock:
+            value = self._data.get(key, '') + value
+            self._data[key] = value
+            return value
+
+    def update(self, values):
+        with self._lock:
+            self._data.update(values)
+            return len(values)
+
+    def items(self, prefix=''):
+        with self._lock:
+            return {key: value for key, value in self._data.items() if key.startswith(prefix)}
+
+    def execute(self, request):
+        operation = request.get('op')
+        if operation == 'get':
+            return self.get(request['key'], request.get('default'))
+        if operation == 'set':
+            return self.set(request['key'], request['value'])
+        if operation == 'delete':
+            return self.delete(request['key'])
+        if operation == 'incr':
+            return self.incr(request['key'], request.get('amount', 1))
+        if operation == 'append':
+            return self.append(request['key'], request['value'])
+        if operation == 'update':
+            return self.update(request['values'])
+        if operation == 'items':
+            return self.items(request.get('prefix', ''))
+        raise StorageError("Unknown operation '%s'" % operation)
+
+
+class StoreClient(object):
+    """ Talks to the storage server started for the current run, the connection is reused between requests """
+
+    def __init__(self, socket_path):
+        self.socket_path = socket_path
+        self._socket = None
+        self._file = None
+
+    def _connect(self):
+        import socket
+
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.connect(self.socket_path)
+        self._file = self._socket.makefile('rwb')
+
+    def request(self, operation, **fields):
+        if self._socket is None:
+            self._connect()
+        fields['op'] = operation
+        self._file.write(json.dumps(fields).encode('utf-8') + b'\n')
+        self._file.flush()
+        response = json.loads(self._file.readline())
+        if not response['ok']:
+            raise StorageError(response['error'])
+        return response['value']
+
+    def close(self):
+        if self._socket is not None:
+            self._file.close()
+            self._socket.close()
+            self._socket = None
+
+
+class LogStore(object):
+    """
+    Keeps data in an append-only log of JSON records, one per line, used when no storage server is running.
+    Each write appends a single record under an exclusive flock, readers replay only the records appended
+    since their last read. A torn record left by a crash is discarded. When the log grows past
+    COMPACT_THRESHOLD bytes and is mostly made of stale records it is rewritten and atomically renamed.
+    """
+
+    def __init__(self, store_path, fsync_every=FSYNC_EVERY, compact_threshold=COMPACT_THRESHOLD):
+        self.store_path = store_path
+        self.fsync_every = fsync_every
+        self.compact_threshold = compact_threshold
+        self._lock_file = open(store_path + LOCK_SUFFIX, 'a')
+        self._log = None
+        self._inode = None
+        self._offset = 0
+        self._records = 0
+        self._unsynced = 0
+        self._data = {}
+
+    @contextmanager
+    def locked(self, exclusive):
+        fcntl.flock(self._lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            self._refresh(exclusive)
+            yield
+        finally:
+            fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    def _open_log(self):
+        if self._log is not None:
+            self._sync()
+            self._log.close()
+        self._log = open(self.store_path, 'a+b')
+        self._inode = os.fstat(self._log.fileno()).st_ino
+        self._offset = 0
+        self._records = 0
+        self._data = {}
+
+    def _refresh(self, exclusive):
+        """ Replays records appended by other processes, reopens the log if it was compacted """
+        try:
+            inode = os.stat(self.store_path).st_ino
+        except FileNotFoundError:
+            inode = None
+        if self._log is None or inode != self._inode:
+            self._open_log()
+
+        self._log.seek(self._offset)
+        for line in self._log:
+            if not line.endswith(b'\n'):
+                break
+            self._apply(json.loads(line))
+            self._offset += len(line)
+            self._records += 1
+
+        if exclusive and os.fstat(self._log.fileno()).st_size > self._offset:
+            # a writer crashed in the middle of a record, drop it before appending
+            self._log.truncate(self._offset)
+
+    def _apply(self, record):
+        if 'k' not in record:
+            return
+        if record.get('d'):
+            self._data.pop(record['k'], None)
+        else:
+            self._data[record['k']] = record['v']
+
+    def _append(self, key):
+        if key in self._data:
+            record = dict(k=key, v=self._data[key])
+        else:
+            record = dict(k=key, d=True)
+        line = json.dumps(record).encode('utf-8') + b'\n'
+        self._log.write(line)
+        self._log.flush()
+        self._offset += len(line)
+        self._records += 1
+        self._unsynced += 1
+        if self._unsynced >= self.fsync_every:
+            self._sync()
+
+    def _sync(self):
+        if self._unsynced:
+            os.fsync(self._log.fileno())
+            self._unsynced = 0
+
+    def rewrite(self, data):
+        """ Atomically replaces the log with one record per key, must hold the exclusive lock """
+        tmp_path = '%s.%d.compact' % (self.store_path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            for key, value in data.items():
+                f.write(json.dumps(dict(k=key, v=value)).encode('utf-8') + b'\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.store_path)
+        self._refresh(exclusive=True)
+
+    def _maybe_compact(self):
+        if self._offset >= self.compact_threshold and self._records > 2 * len(self._data):
+            self.rewrite(dict(self._data))
+
+    def request(self, operation, **fields):
+        fields['op'] = operation
+        if operation in READ_OPERATIONS:
+            with self.locked(exclusive=False):
+                return KeyValueStore(self._data).execute(fields)
+
+        with self.locked(exclusive=True):
+            value = KeyValueStore(self._data).execute(fields)
+            for key in (fields['values'] if operation == 'update' else [fields['key']]):
+                self._append(key)
+            self._maybe_compact()
+            return value
+
+    def close(self):
+        if self._log is not None:
+            self._sync()
+            self._log.close()
+            self._log = None
+        self._lock_file.close()
+
+
+def get_store():
+    socket_path = os.environ.get(STORE_SOCKET)
+    if socket_path and path.exists(socket_path):
+        return StoreClient(socket_path)
+    return LogStore(get_storage_path())
+
+
+def _request(operation, **fields):
+    store = get_store()
+    try:
+        return store.request(operation, **fields)
+    finally:
+        store.close()
+
+
+# Python scripts use these instead of starting store_var and load_var: `from sidefridge.storage import store_value`
+
+def store_value(key, value):
+    """ Like `store_var key value` """
+    _request('set', key=key, value=str(value))
+
+
+def load_value(key, default=''):
+    """ Like `load_var key default` """
+    return _request('get', key=key, default=default)
+
+
+def load_values(prefix=''):
+    """ Stored keys and values as a dictionary, only the keys starting with prefix if provided """
+    return _request('items', prefix=prefix)
+
+
+def parse_pairs(content, null_separated):
+    """ Parses `key=value` lines or, when null_separated, `key\\0value\\0` pairs """
+    if null_separated:
+        fields = content.split('\0')
+        if fields and fields[-1] == '':
+            fields.pop()
+        if len(fields) % 2 != 0:
+            raise StorageError("Expected an even number of NUL separated fields, got %d" % len(fields))
+        return dict(zip(fields[::2], fields[1::2]))
+
+    pairs = {}
+    for line in content.splitlines():
+        if not line:
+            continue
+        if '=' not in line:
+            raise StorageError("Expected a 'key=value' line, got '%s'" % line)
+        key, value = line.split('=', 1)
+        pairs[key] = value
+    return pairs
+
+
+def format_exports(items):
+    """ Returns a block of `export key='value'` lines to be evaluated by a shell """
+    import shlex
+
+    lines = []
+    for key in sorted(items):
+        # only ascii letters, digits and underscores are valid in shell variable names
+        if not (key.isidentifier() and key.isascii()):
+            sys.stderr.write("Skipping '%s', it is not a valid shell variable name\n" % key)
+            continue
+        lines.append("export %s=%s" % (key, shlex.quote(items[key])))
+    return '\n'.join(lines)
+
+
+def format_null_separated(items):
+    return ''.join('%s\0%s\0' % (key, items[key]) for key in sorted(items))
+
+
+def parse_arguments(argv, options, positionals, exclusive, build_parser):
+    """
+    Parses argv without importing argparse, these helpers are invoked many times per run.
+    options contains (flags, dest, takes_value) tuples and positionals (dest, default) tuples.
+    Help requests, unknown options and invalid combinations are handed over to the full parser
+    returned by build_parser, which prints usage and errors like any other command.
+    """
+    values = {}
+    flags = {}
+    for option_flags, dest, takes_value in options:
+        values[dest] = '' if takes_value else False
+        for flag in option_flags:
+            flags[flag] = (dest, takes_value)
+
+    positional_values = []
+    only_positionals = False
+    remaining = iter(argv)
+    for arg in remaining:
+        # known flags come first, `-0` is the short form of --null and not a negative number
+        if not only_positionals and arg in flags and not flags[arg][1]:
+            values[flags[arg][0]] = True
+        elif not only_positionals and arg in flags:
+            values[flags[arg][0]] = next(remaining, None)
+            if values[flags[arg][0]] is None:
+                return build_parser().parse_args(argv)
+        elif only_positionals or arg == '-' or not arg.startswith('-') or arg[1:2].isdigit():
+            positional_values.append(arg)
+        elif arg == '--':
+            only_positionals = True
+        else:
+            return build_parser().parse_args(argv)
+
+    if len(positional_values) > len(positionals) or sum(values[dest] is True for dest in exclusive) > 1:
+        return build_parser().parse_args(argv)
+
+    for index, (dest, default) in enumerate(positionals):
+        values[dest] = positional_values[index] if index < len(positional_values) else default
+
+    return SimpleNamespace(**values)
+
+
+STORE_VAR_OPTIONS = (
+    (('-a', '--append'), 'append', False),
+    (('-i', '--incr'), 'incr', False),
+    (('-d', '--delete'), 'delete', False),
+    (('-s', '--stdin'), 'stdin', False),
+    (('-0', '--null'), 'null', False),
+)
+
+LOAD_VAR_OPTIONS = (
+    (('-e', '--export'), 'export', False),
+    (('-0', '--null'), 'null', False),
+    (('-p', '--prefix'), 'prefix', True),
+)
+
+
+def build_store_var_parser():
+    import argparse
+
     parser = argparse.ArgumentParser(
+        prog='store_var',
         description='Utility to store values for usage between scripts'
     )
     parser.add_argument(
-        'key', type=str,
+        'key', nargs='?', type=str,
         help='the key where to store the value'
     )
     parser.add_argument(
-        'value', type=str,
-        help='the value to be stored'
+        'value', nargs='?', type=str,
+        help='the value to be stored, the amount to add with --incr (default 1)'
     )
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument(
+        '-a', '--append', action='store_true',
+        help='appends the value to the one already stored'
+    )
+    group.add_argument(
+        '-i', '--incr', action='store_true',
+        help='adds the value to the integer already stored and prints the result'
+    )
+    group.add_argument(
+        '-d', '--delete', action='store_true',
+        help='removes the key'
+    )
+    group.add_argument(
+        '-s', '--stdin', action='store_true',
+        help='stores all key=value lines read from stdin at once'
+    )
+    parser.add_argument(
+        '-0', '--null', action='store_true',
+        help='with --stdin, reads NUL separated key and value pairs as printed by load_var --null'
+    )
+    return parser
 
-    arguments = parser.parse_args()
-
-    data_dict = load_dict()
-    data_dict[arguments.key] = arguments.value
-    store_dict(data_dict)
 
+def build_load_var_parser():
+    import argparse
 
-def load_var():
-    """ Searches for the first argument to load """
     parser = argparse.ArgumentParser(
+        prog='load_var',
         description='Utility to load values for usage between scripts'
     )
     parser.add_argument(
-        'key', type=str,
+        'key', nargs='?', type=str,
         help='the key where to store the value'
     )
     parser.add_argument(
         'default', nargs='?', type=str, default='',
         help='optional value if key is not found'
     )
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument(
+        '-e', '--export', action='store_true',
+        help='prints all keys as shell exports, use it like: eval "$(load_var --export)"'
+    )
+    group.add_argument(
+        '-0', '--null', action='store_true',
+        help='prints all keys and values separated by NUL characters'
+    )
+    parser.add_argument(
+        '-p', '--prefix', type=str, default='',
+        help='with --export or --null, only keys starting with this prefix are printed'
+    )
+    return parser
+
+
+def store_var():
+    """ Stores the first argument as key and the second argument as value """
+    arguments = parse_arguments(
+        sys.argv[1:], STORE_VAR_OPTIONS, (('key', None), ('value', None)),
+        ('append', 'incr', 'delete', 'stdin'), build_store_var_parser
+    )
+
+    if arguments.stdin:
+        if arguments.key is not None:
+            build_store_var_parser().error("no key or value can be provided with --stdin")
+    elif arguments.key is None:
+        build_store_var_parser().error("the following arguments are required: key")
+    elif arguments.value is None and not (arguments.incr or arguments.delete):
+        build_store_var_parser().error("the following arguments are required: value")
+
+    store = get_store()
+    try:
+        if arguments.stdin:
+            store.request('update', values=parse_pairs(sys.stdin.read(), arguments.null))
+        elif arguments.delete:
+            store.request('delete', key=arguments.key)
+        elif arguments.incr:
+            print(store.request('incr', key=arguments.key, amount=arguments.value or '1'))
+        elif arguments.append:
+            store.request('append', key=arguments.key, value=arguments.value)
+        else:
+            store.request('set', key=arguments.key, value=arguments.value)
+    except StorageError as e:
+        sys.stderr.write("%s\n" % e)
+        sys.exit(1)
+    finally:
+        store.close()
+
+
+def load_var():
+    """ Searches for the first argument to load """
+    arguments = parse_arguments(
+        sys.argv[1:], LOAD_VAR_OPTIONS, (('key', None), ('default', '')),
+        ('export', 'null'), build_load_var_parser
+    )
 
-    arguments = parser.parse_args()
+    bulk = arguments.export or arguments.null
+    if bulk and arguments.key is not None:
+        build_load_var_parser().error("no key can be provided with --export or --null")
+    if not bulk and arguments.key is None:
+        build_load_var_parser().error("the following arguments are required: key")
 
-    data_dict = load_dict()
-    print(data_dict.get(arguments.key, arguments.default))
+    store = get_store()
+    try:
+        if arguments.export:
+            print(format_exports(store.request('items', prefix=arguments.prefix)))
+        elif arguments.null:
+            sys.stdout.write(format_null_separated(store.request('items', prefix=arguments.prefix)))
+        else:
+            print(store.request('get', key=arguments.key, default=arguments.default))
+    finally:
+        store.close()
@@ -0,0 +1,46 @@
+import json
+import os
+import socketserver
+import threading
+
+from sidefridge.storage import KeyValueStore, StorageError
+from sidefridge.utils import print_logger
+
+
+class StoreRequestHandler(socketserver.StreamRequestHandler):
+    """ Each line is a JSON request, each request is answered with a JSON line """
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                if not isinstance(request, dict):
+                    raise StorageError("A request must be a JSON object, got %s" % type(request).__name__)
+                response = dict(ok=True, value=self.server.store.execute(request))
+            except (StorageError, KeyError, TypeError, ValueError) as e:
+                response = dict(ok=False, error=str(e))
+            self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+            self.wfile.flush()
+
+
+class StoreServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path):
+        self.store = KeyValueStore()
+        self.socket_path = socket_path
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        socketserver.UnixStreamServer.__init__(self, socket_path, StoreRequestHandler)
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, name='store-server')
+        thread.daemon = True
+        thread.start()
+        print_logger("Storage server listening on '%s'" % self.socket_path)
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
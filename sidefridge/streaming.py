@@ -0,0 +1,98 @@
+import codecs
+import os
+import selectors
+import sys
+import threading
+
+# large reads keep the relay cheap even when scripts are very verbose
+CHUNK_SIZE = 64 * 1024
+
+# how often a relay which may be abandoned checks for it
+ABANDON_POLL_SECONDS = 0.5
+
+# scripts running concurrently share the same output streams
+_write_lock = threading.Lock()
+
+
+class StreamRelay(object):
+    """ Decodes chunks of a child stream and writes them to a target text stream """
+
+    def __init__(self, target, prefix=None):
+        self.target = target
+        self.prefix = prefix
+        self.decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self.at_line_start = True
+        self.bytes_read = 0
+
+    def _apply_prefix(self, text):
+        if not self.prefix or not text:
+            return text
+
+        lines = text.split('\n')
+        last_index = len(lines) - 1
+        for index, line in enumerate(lines):
+            starts_line = self.at_line_start or index > 0
+            # an empty tail means the next line has not started yet, it gets prefixed with the next chunk
+            if starts_line and (line or index < last_index):
+                lines[index] = self.prefix + line
+
+        self.at_line_start = text.endswith('\n')
+        return '\n'.join(lines)
+
+    def write(self, text):
+        text = self._apply_prefix(text)
+        if text:
+            with _write_lock:
+                self.target.write(text)
+                self.target.flush()
+
+    def feed(self, data):
+        self.bytes_read += len(data)
+        self.write(self.decoder.decode(data))
+
+    def close(self):
+        # flushes incomplete multi-byte sequences left in the decoder
+        self.write(self.decoder.decode(b'', final=True))
+
+
+def relay_output(process, prefix=None, stdout=None, stderr=None, chunk_size=CHUNK_SIZE, bandwidth=None,
+                 abandon=None):
+    """
+    Copies stdout and stderr of a running process to the current process' streams until both are closed.
+    Output is read in large chunks from whichever pipe is ready, if a prefix is provided it is added to each line.
+    With a bandwidth token bucket, reading waits for tokens and a process writing faster is held back by the pipe.
+    Once the abandon event is set the pipes are closed even if they were not closed by the other side.
+    Returns the number of bytes read from stdout and from stderr.
+    """
+    targets = (
+        (process.stdout, stdout or sys.stdout),
+        (process.stderr, stderr or sys.stderr),
+    )
+
+    relays = [StreamRelay(target, prefix) for _, target in targets]
+
+    with selectors.DefaultSelector() as selector:
+        for (pipe, _), relay in zip(targets, relays):
+            if pipe is not None:
+                selector.register(pipe, selectors.EVENT_READ, relay)
+
+        while selector.get_map():
+            if abandon is not None and abandon.is_set():
+                for key in list(selector.get_map().values()):
+                    selector.unregister(key.fileobj)
+                    key.fileobj.close()
+                    key.data.close()
+                break
+            for key, _ in selector.select(None if abandon is None else ABANDON_POLL_SECONDS):
+                data = os.read(key.fd, chunk_size)
+                if data:
+                    key.data.feed(data)
+                    if bandwidth is not None:
+                        bandwidth.consume(len(data))
+                    continue
+
+                selector.unregister(key.fileobj)
+                key.fileobj.close()
+                key.data.close()
+
+    return relays[0].bytes_read, relays[1].bytes_read
@@ -0,0 +1,201 @@
+import os
+import random
+import re
+import signal
+import threading
+import time
+
+from sidefridge.utils import print_logger
+
+SCRIPT_TIMEOUT_SECONDS = "SCRIPT_TIMEOUT_SECONDS"
+HOOK_TIMEOUT_SECONDS = "HOOK_TIMEOUT_SECONDS"
+# a hook's own timeout, like BACKUPS_TIMEOUT_SECONDS, overrides HOOK_TIMEOUT_SECONDS
+HOOK_TIMEOUT_SUFFIX = "_TIMEOUT_SECONDS"
+TIMEOUT_GRACE_SECONDS = "TIMEOUT_GRACE_SECONDS"
+SCRIPT_RETRIES = "SCRIPT_RETRIES"
+RETRY_BACKOFF_SECONDS = "RETRY_BACKOFF_SECONDS"
+RETRY_BACKOFF_MAX_SECONDS = "RETRY_BACKOFF_MAX_SECONDS"
+
+DEFAULT_GRACE_SECONDS = 10
+DEFAULT_BACKOFF_SECONDS = 5
+DEFAULT_BACKOFF_MAX_SECONDS = 300
+
+# scripts override the defaults in a comment of their first lines: `# fridge: timeout=600 retries=3 backoff=10`
+DIRECTIVE = re.compile(r'^#\s*fridge:(.*)$', re.MULTILINE)
+DIRECTIVE_KEYS = {'timeout', 'retries', 'backoff'}
+# flags without a value, `# fridge: warm` runs a Python script in the warm worker, `cold` never does
+DIRECTIVE_FLAGS = {'warm', 'cold'}
+HEADER_SIZE = 4096
+
+# once killed, a script whose output is still held open by an escaped process is given up after this
+ABANDON_SECONDS = 5
+
+
+class InvalidSupervisionSettings(Exception):
+    pass
+
+
+def _get_seconds(env_name, default):
+    value = os.environ.get(env_name) or str(default)
+    try:
+        seconds = float(value)
+    except ValueError:
+        seconds = -1
+    if seconds < 0:
+        raise InvalidSupervisionSettings("'%s' must be a non negative number, got '%s'" % (env_name, value))
+    return seconds
+
+
+def get_hook_timeout(hook_name):
+    """ Seconds all the scripts of a hook may take, 0 means no limit """
+    return _get_seconds(hook_name.upper() + HOOK_TIMEOUT_SUFFIX, _get_seconds(HOOK_TIMEOUT_SECONDS, 0))
+
+
+def read_directives(script):
+    """ Settings of a `# fridge: key=value flag ...` comment in the first lines of a script, flags are True """
+    try:
+        with open(script, 'rb') as f:
+            header = f.read(HEADER_SIZE).decode('utf-8', errors='replace')
+    except OSError:
+        return {}
+
+    directives = {}
+    for match in DIRECTIVE.finditer(header):
+        for token in match.group(1).split():
+            key, separator, value = token.partition('=')
+            if not separator and key in DIRECTIVE_FLAGS:
+                directives[key] = True
+                continue
+            if key not in DIRECTIVE_KEYS:
+                continue
+            try:
+                directives[key] = float(value) if key != 'retries' else int(value)
+            except ValueError:
+                print_logger("Ignoring invalid '%s' in the fridge comment of '%s'" % (token, script))
+    return directives
+
+
+def signal_group(process, signum):
+    """ Scripts lead their own process group, everything they started receives the signal too """
+    try:
+        os.killpg(process.pid, signum)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+class RunningScripts(object):
+    """
+    Scripts running in this process. stop() sends SIGTERM to their process groups and marks the run as stopping,
+    the runner then starts no other script but on_error ones, which are never registered here.
+    There is no lock: stop() runs in a signal handler, which may interrupt the thread that would hold it.
+    """
+
+    def __init__(self):
+        self._processes = set()
+        self.stopping = False
+
+    def started(self, process):
+        self._processes.add(process)
+        # a script started while stop() was running may be missed by it
+        if self.stopping:
+            signal_group(process, signal.SIGTERM)
+
+    def finished(self, process):
+        self._processes.discard(process)
+
+    def stop(self):
+        self.stopping = True
+        for process in list(self._processes):
+            signal_group(process, signal.SIGTERM)
+
+
+running_scripts = RunningScripts()
+
+
+class Supervisor(object):
+    """
+    Timeouts and retries of the scripts of a hook. A script gets the smallest of its own timeout and the time left
+    to its hook. Scripts whose fridge comment asks for retries are started again after a failure, waiting an
+    exponential backoff with jitter.
+    """
+
+    def __init__(self, hook_name):
+        self.hook_name = hook_name
+        hook_timeout = get_hook_timeout(hook_name)
+        self.deadline = time.monotonic() + hook_timeout if hook_timeout else None
+        self.script_timeout = _get_seconds(SCRIPT_TIMEOUT_SECONDS, 0)
+        self.grace = _get_seconds(TIMEOUT_GRACE_SECONDS, DEFAULT_GRACE_SECONDS)
+        self.retries = int(_get_seconds(SCRIPT_RETRIES, 0))
+        self.backoff = _get_seconds(RETRY_BACKOFF_SECONDS, DEFAULT_BACKOFF_SECONDS)
+        self.backoff_max = _get_seconds(RETRY_BACKOFF_MAX_SECONDS, DEFAULT_BACKOFF_MAX_SECONDS)
+
+    def settings(self, script):
+        """ Timeout, retries and backoff of a script """
+        directives = read_directives(script)
+        return (
+            directives.get('timeout', self.script_timeout),
+            directives.get('retries', self.retries),
+            directives.get('backoff', self.backoff),
+        )
+
+    def remaining(self):
+        """ Seconds left to the hook, None without a hook timeout """
+        if self.deadline is None:
+            return None
+        return max(self.deadline - time.monotonic(), 0)
+
+    def attempt_timeout(self, script_timeout):
+        """ Seconds the next attempt may take, None without limit """
+        limits = [limit for limit in (script_timeout or None, self.remaining()) if limit is not None]
+        return min(limits) if limits else None
+
+    def backoff_delay(self, backoff, attempt):
+        """ Exponential backoff with jitter, between half and all of the doubled delay """
+        delay = min(backoff * 2 ** attempt, self.backoff_max)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def watch(self, process, script, timeout):
+        watchdog = Watchdog(process, script, timeout, self.grace)
+        watchdog.start()
+        return watchdog
+
+
+class Watchdog(object):
+    """
+    Ends a script running longer than its timeout: SIGTERM to its process group, SIGKILL once the grace period is
+    over. If its output is still open afterwards the relay is told to give up.
+    """
+
+    def __init__(self, process, script, timeout, grace):
+        self.process = process
+        self.script = script
+        self.timeout = timeout
+        self.grace = grace
+        self.timed_out = False
+        self.abandon = threading.Event()
+        self._done = threading.Event()
+        self._thread = None
+
+    def _watch(self):
+        if self._done.wait(self.timeout):
+            return
+        self.timed_out = True
+        print_logger("Script '%s' timed out after %.0fs, sending SIGTERM" % (self.script, self.timeout))
+        signal_group(self.process, signal.SIGTERM)
+        if self._done.wait(self.grace):
+            return
+        print_logger("Script '%s' did not stop within %.0fs, sending SIGKILL" % (self.script, self.grace))
+        signal_group(self.process, signal.SIGKILL)
+        if not self._done.wait(ABANDON_SECONDS):
+            self.abandon.set()
+
+    def start(self):
+        if self.timeout is None:
+            return
+        self._thread = threading.Thread(target=self._watch, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._done.set()
+        if self._thread is not None:
+            self._thread.join()
@@ -0,0 +1,392 @@
+import argparse
+import datetime
+import errno
+import json
+import os
+import platform
+import sys
+import time
+
+from sidefridge.utils import print_logger
+
+THROTTLE_CONFIG = "THROTTLE_CONFIG"
+THROTTLE_NICE = "THROTTLE_NICE"
+THROTTLE_IONICE = "THROTTLE_IONICE"
+THROTTLE_CPU_AFFINITY = "THROTTLE_CPU_AFFINITY"
+THROTTLE_BANDWIDTH = "THROTTLE_BANDWIDTH"
+THROTTLE_CPU_MAX = "THROTTLE_CPU_MAX"
+THROTTLE_IO_MAX = "THROTTLE_IO_MAX"
+THROTTLE_HOURS = "THROTTLE_HOURS"
+THROTTLE_CGROUP_ROOT = "THROTTLE_CGROUP_ROOT"
+
+# read from the scripts directory when THROTTLE_CONFIG is not set
+CONFIG_FILE = 'throttling.json'
+
+# each setting of a policy and the environment variable providing its default
+POLICY_SETTINGS = {
+    'nice': THROTTLE_NICE,
+    'ionice': THROTTLE_IONICE,
+    'cpu_affinity': THROTTLE_CPU_AFFINITY,
+    'bandwidth': THROTTLE_BANDWIDTH,
+    'cpu_max': THROTTLE_CPU_MAX,
+    'io_max': THROTTLE_IO_MAX,
+    'hours': THROTTLE_HOURS,
+}
+
+IOPRIO_CLASSES = {'realtime': 1, 'best-effort': 2, 'idle': 3}
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_WHO_PROCESS = 1
+# ioprio_set has no libc wrapper, its number depends on the architecture
+IOPRIO_SET_SYSCALLS = {'x86_64': 251, 'i686': 289, 'aarch64': 30, 'armv7l': 314, 'ppc64le': 273, 's390x': 282}
+
+# applied to the process of a script before it runs, in this order
+PROCESS_SETTINGS = ('cgroup', 'nice', 'ionice', 'cpu_affinity')
+
+CGROUP_ROOT = '/sys/fs/cgroup'
+CGROUP_NAME = 'sidefridge'
+# leaf of CGROUP_NAME the processes of the runner are moved to
+RUNNER_CGROUP = 'runner'
+CPU_MAX_PERIOD = 100000
+IO_MAX_KEYS = {'rbps', 'wbps', 'riops', 'wiops'}
+
+
+class InvalidThrottleSettings(Exception):
+    pass
+
+
+def parse_ionice(value):
+    """ `idle`, `best-effort` or `realtime` followed by an optional level from 0 to 7, like `best-effort:7` """
+    name, _, level = str(value).partition(':')
+    if name not in IOPRIO_CLASSES or (level and (not level.isdigit() or int(level) > 7)):
+        raise InvalidThrottleSettings("invalid ionice '%s', expected one of %s with an optional :LEVEL" % (
+            value, sorted(IOPRIO_CLASSES)
+        ))
+    return IOPRIO_CLASSES[name], int(level or 0)
+
+
+def parse_cpu_list(value):
+    """ CPUs like `0-3,6` """
+    cpus = set()
+    try:
+        for part in str(value).split(','):
+            first, _, last = part.strip().partition('-')
+            cpus.update(range(int(first), int(last or first) + 1))
+    except ValueError:
+        raise InvalidThrottleSettings("invalid CPU list '%s', expected something like '0-3,6'" % value)
+    if not cpus:
+        raise InvalidThrottleSettings("invalid CPU list '%s'" % value)
+    return cpus
+
+
+def parse_hours(value):
+    """ Hours like `8-20`, the policy applies from 08:00 to 19:59. `22-6` spans midnight """
+    try:
+        start, end = (int(hour) for hour in str(value).split('-'))
+    except ValueError:
+        raise InvalidThrottleSettings("invalid hours '%s', expected something like '8-20'" % value)
+    if not (0 <= start <= 23 and 0 <= end <= 24):
+        raise InvalidThrottleSettings("invalid hours '%s', hours go from 0 to 24" % value)
+    return start, end
+
+
+def parse_cpu_max(value):
+    """ A share of one CPU like `50%`, or the raw `QUOTA [PERIOD]` of cpu.max where QUOTA `max` means no limit """
+    value = str(value).strip()
+    if value.endswith('%'):
+        try:
+            return '%d %d' % (int(float(value[:-1]) * CPU_MAX_PERIOD / 100), CPU_MAX_PERIOD)
+        except ValueError:
+            raise InvalidThrottleSettings("invalid cpu_max '%s'" % value)
+    parts = value.split()
+    quota_valid = bool(parts) and (parts[0].isdigit() or parts[0] == 'max')
+    if len(parts) > 2 or not quota_valid or not all(period.isdigit() for period in parts[1:]):
+        raise InvalidThrottleSettings("invalid cpu_max '%s', expected '50%%' or 'QUOTA [PERIOD]'" % value)
+    return value
+
+
+def _is_io_max_line(fields):
+    major, _, minor = fields[0].partition(':')
+    limits = [field.partition('=') for field in fields[1:]]
+    return major.isdigit() and minor.isdigit() and bool(limits) and all(
+        key in IO_MAX_KEYS and (limit.isdigit() or limit == 'max') for key, _, limit in limits
+    )
+
+
+def parse_io_max(value):
+    """ Lines of io.max separated by `;`, like `8:0 rbps=20971520 wbps=max` """
+    lines = [line.split() for line in str(value).split(';') if line.strip()]
+    for fields in lines:
+        if not _is_io_max_line(fields):
+            raise InvalidThrottleSettings("invalid io_max '%s', expected lines like 'MAJOR:MINOR rbps=BYTES'" % (
+                ' '.join(fields)
+            ))
+    return [' '.join(fields) for fields in lines]
+
+
+def parse_bandwidth(value):
+    from sidefridge.pipeline import parse_size
+
+    try:
+        return parse_size(str(value))
+    except argparse.ArgumentTypeError as e:
+        raise InvalidThrottleSettings("invalid bandwidth: %s" % e)
+
+
+class ThrottlePolicy(object):
+    """
+    How the scripts of a hook are slowed down: CPU and IO priority, CPU affinity, a bandwidth limit on their
+    output and cgroup v2 limits. With hours, the policy only applies during those hours of the day.
+    """
+
+    def __init__(self, nice=None, ionice=None, cpu_affinity=None, bandwidth=None, cpu_max=None, io_max=None,
+                 hours=None):
+        self.nice = None if nice is None else int(nice)
+        self.ionice = ionice
+        self.cpu_affinity = cpu_affinity
+        self.bandwidth = None if bandwidth is None else parse_bandwidth(bandwidth)
+        self.cpu_max = None if cpu_max is None else parse_cpu_max(cpu_max)
+        self.io_max = None if io_max is None else parse_io_max(io_max)
+        self.hours = None if hours is None else parse_hours(hours)
+        # validated here, applied by the launcher
+        if ionice is not None:
+            parse_ionice(ionice)
+        if cpu_affinity is not None:
+            parse_cpu_list(cpu_affinity)
+        self.cgroup = None
+
+    def is_empty(self):
+        return all(getattr(self, name) is None for name in POLICY_SETTINGS if name != 'hours')
+
+    def applies_at(self, now):
+        if self.hours is None:
+            return True
+        start, end = self.hours
+        if start <= end:
+            return start <= now.hour < end
+        return now.hour >= start or now.hour < end
+
+    def launcher_arguments(self):
+        arguments = []
+        if self.nice is not None:
+            arguments += ['--nice', str(self.nice)]
+        if self.ionice is not None:
+            arguments += ['--ionice', self.ionice]
+        if self.cpu_affinity is not None:
+            arguments += ['--cpu-affinity', self.cpu_affinity]
+        if self.cgroup is not None:
+            arguments += ['--cgroup', self.cgroup]
+        return arguments
+
+    def process_settings(self):
+        """ Settings applied to the process of a script, as apply_process_settings takes them """
+        return {name: getattr(self, name) for name in PROCESS_SETTINGS if getattr(self, name) is not None}
+
+    def command(self, cmd):
+        """ The command starting cmd with this policy applied before it runs """
+        arguments = self.launcher_arguments()
+        if not arguments:
+            return cmd
+        return [sys.executable, '-m', 'sidefridge.throttling'] + arguments + ['--'] + cmd
+
+    def environment(self):
+        """ Scripts using `fridge pipe` inherit the bandwidth limit """
+        if self.bandwidth is None:
+            return None
+        return dict(os.environ, **{THROTTLE_BANDWIDTH: str(self.bandwidth)})
+
+    def token_bucket(self):
+        return None if self.bandwidth is None else TokenBucket(self.bandwidth)
+
+    def describe(self):
+        return ', '.join('%s %s' % (name, getattr(self, name)) for name in sorted(POLICY_SETTINGS)
+                         if getattr(self, name) is not None)
+
+
+class TokenBucket(object):
+    """ Limits a stream to rate bytes per second, allowing bursts of up to one second worth of data """
+
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.tokens = self.rate
+        self.updated = time.monotonic()
+
+    def consume(self, amount):
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        # the debt of a large chunk is paid by waiting, the next chunk starts from an empty bucket
+        self.tokens -= amount
+        if self.tokens < 0:
+            time.sleep(-self.tokens / self.rate)
+
+
+def load_settings(scripts_path, hook_name):
+    """
+    Settings of the policy of a hook: THROTTLE_* environment variables, overridden by the `default` section of the
+    configuration file, overridden by the section named after the hook.
+    """
+    settings = {name: os.environ[env_name] for name, env_name in POLICY_SETTINGS.items() if os.environ.get(env_name)}
+
+    config_path = os.environ.get(THROTTLE_CONFIG) or os.path.join(scripts_path, CONFIG_FILE)
+    try:
+        with open(config_path) as f:
+            config = json.load(f)
+    except FileNotFoundError:
+        if os.environ.get(THROTTLE_CONFIG):
+            raise InvalidThrottleSettings("'%s' points to '%s', which does not exist" % (THROTTLE_CONFIG, config_path))
+        return settings
+    except ValueError as e:
+        raise InvalidThrottleSettings("Could not parse '%s': %s" % (config_path, e))
+
+    if not isinstance(config, dict):
+        raise InvalidThrottleSettings("'%s' must contain an object with a section per hook" % config_path)
+    for section in ('default', hook_name):
+        values = config.get(section, {})
+        if not isinstance(values, dict):
+            raise InvalidThrottleSettings("Section '%s' of '%s' must be an object of settings" % (section, config_path))
+        unknown = sorted(set(values) - set(POLICY_SETTINGS))
+        if unknown:
+            raise InvalidThrottleSettings("Unknown settings %s in section '%s' of '%s'" % (
+                unknown, section, config_path
+            ))
+        settings.update(values)
+    return settings
+
+
+def load_policy(scripts_path, hook_name):
+    try:
+        return ThrottlePolicy(**load_settings(scripts_path, hook_name))
+    except (TypeError, ValueError) as e:
+        raise InvalidThrottleSettings("Invalid throttling of '%s': %s" % (hook_name, e))
+
+
+def get_policy(scripts_path, hook_name, now=None):
+    """ The policy applying to a hook right now, None when its scripts run at full speed """
+    policy = load_policy(scripts_path, hook_name)
+    if policy.is_empty() or not policy.applies_at(now or datetime.datetime.now()):
+        return None
+
+    if policy.cpu_max is not None or policy.io_max is not None:
+        policy.cgroup = prepare_cgroup(get_cgroup_root(), hook_name, policy.cpu_max, policy.io_max)
+    print_logger("Throttling '%s': %s" % (hook_name, policy.describe()))
+    return policy
+
+
+def _write(path, value):
+    with open(path, 'w') as f:
+        f.write(value)
+
+
+def _move_processes(source, destination):
+    with open(os.path.join(source, 'cgroup.procs')) as f:
+        pids = f.read().split()
+    for pid in pids:
+        try:
+            _write(os.path.join(destination, 'cgroup.procs'), pid)
+        except ProcessLookupError:
+            # exited in the meantime
+            pass
+
+
+def get_cgroup_root():
+    return os.environ.get(THROTTLE_CGROUP_ROOT, CGROUP_ROOT)
+
+
+def prepare_cgroup(root, hook_name, cpu_max, io_max):
+    """
+    Creates a cgroup v2 for the scripts of a hook with the cpu.max and io.max limits, returns its path.
+    Controllers can only be delegated by a cgroup without processes: in a pod the runner sits in the root of the
+    cgroup namespace, its processes are moved to the `sidefridge/runner` leaf first.
+    Raises InvalidThrottleSettings when the limits cannot be applied.
+    """
+    if not os.path.isfile(os.path.join(root, 'cgroup.controllers')):
+        raise InvalidThrottleSettings("cgroup v2 is not mounted in '%s', cpu_max and io_max cannot be applied" % root)
+
+    parent = os.path.join(root, CGROUP_NAME)
+    path = os.path.join(parent, hook_name)
+    controllers = ' '.join(
+        controller for controller, limit in (('+cpu', cpu_max), ('+io', io_max)) if limit is not None
+    )
+    try:
+        os.makedirs(path, exist_ok=True)
+        try:
+            _write(os.path.join(root, 'cgroup.subtree_control'), controllers)
+        except OSError as e:
+            if e.errno != errno.EBUSY:
+                raise
+            runner = os.path.join(parent, RUNNER_CGROUP)
+            os.makedirs(runner, exist_ok=True)
+            _move_processes(root, runner)
+            _write(os.path.join(root, 'cgroup.subtree_control'), controllers)
+        _write(os.path.join(parent, 'cgroup.subtree_control'), controllers)
+        if cpu_max is not None:
+            _write(os.path.join(path, 'cpu.max'), cpu_max)
+        for line in io_max or ():
+            _write(os.path.join(path, 'io.max'), line)
+    except OSError as e:
+        raise InvalidThrottleSettings("cpu_max and io_max cannot be applied in the cgroup v2 '%s': %s" % (root, e))
+    return path
+
+
+def set_io_priority(ioprio_class, level):
+    import ctypes
+
+    syscall = IOPRIO_SET_SYSCALLS.get(platform.machine())
+    if syscall is None:
+        raise OSError("ioprio_set is not known on %s" % platform.machine())
+    libc = ctypes.CDLL(None, use_errno=True)
+    if libc.syscall(syscall, IOPRIO_WHO_PROCESS, 0, (ioprio_class << IOPRIO_CLASS_SHIFT) | level) != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+
+
+def apply_process_settings(settings):
+    """ Applies settings to the current process, returns (name, error) of those which could not be applied """
+    steps = dict(
+        cgroup=lambda value: _write(os.path.join(value, 'cgroup.procs'), str(os.getpid())),
+        nice=lambda value: os.setpriority(os.PRIO_PROCESS, 0, value),
+        ionice=lambda value: set_io_priority(*parse_ionice(value)),
+        cpu_affinity=lambda value: os.sched_setaffinity(0, parse_cpu_list(value) & os.sched_getaffinity(0)),
+    )
+    errors = []
+    for name in PROCESS_SETTINGS:
+        value = settings.get(name)
+        if value is None:
+            continue
+        try:
+            steps[name](value)
+        except (OSError, InvalidThrottleSettings) as e:
+            errors.append((name, e))
+    return errors
+
+
+def main(argv=None):
+    """ Runs a command with a lower priority: `fridge throttle --nice 19 --ionice idle -- tar czf ...` """
+    parser = argparse.ArgumentParser(
+        prog='fridge throttle',
+        description='Runs a command with CPU and IO priority, CPU affinity and cgroup applied'
+    )
+    parser.add_argument('--nice', type=int, help='niceness of the command, from -20 to 19')
+    parser.add_argument('--ionice', help='IO class: idle, best-effort or realtime, with an optional :LEVEL')
+    parser.add_argument('--cpu-affinity', metavar='CPUS', help="CPUs the command may run on, like '0-1,3'")
+    parser.add_argument('--cgroup', help='cgroup v2 directory the command is moved to')
+    parser.add_argument('command', nargs=argparse.REMAINDER, help='the command and its arguments, after --')
+
+    arguments = parser.parse_args(argv)
+    command = arguments.command[1:] if arguments.command[:1] == ['--'] else arguments.command
+    if not command:
+        parser.error("a command is required")
+
+    # settings are applied to this process, the command inherits them once exec'd; none of them is fatal
+    for name, error in apply_process_settings({name: getattr(arguments, name) for name in PROCESS_SETTINGS}):
+        sys.stderr.write("fridge throttle: %s was not applied: %s\n" % (name, error))
+
+    try:
+        os.execvp(command[0], command)
+    except OSError as e:
+        sys.stderr.write("fridge throttle: could not run '%s': %s\n" % (command[0], e))
+        sys.exit(126)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,314 @@
+import array
+import atexit
+import importlib
+import json
+import os
+import selectors
+import signal
+import socket
+import sys
+
+from sidefridge.metrics import returncode_from_status
+from sidefridge.supervision import read_directives
+from sidefridge.throttling import apply_process_settings
+from sidefridge.utils import print_logger
+
+WARM_PYTHON_HOOKS = "WARM_PYTHON_HOOKS"
+# comma separated modules imported by the worker on top of the default ones, like `boto3,pymongo`
+WARM_PYTHON_PRELOAD = "WARM_PYTHON_PRELOAD"
+
+WORKER_SOCKET_PATH = '/tmp/sidefridge_warm_%d.sock'
+
+DEFAULT_PRELOAD = ('datetime', 'json', 'subprocess', 'urllib.request', 'sidefridge.storage')
+
+BUFFER_SIZE = 64 * 1024
+
+_worker = None
+
+
+def has_python_shebang(script):
+    """ Whether the interpreter of the shebang is Python, like `#!/usr/bin/env python3` """
+    try:
+        with open(script, 'rb') as f:
+            first_line = f.readline(BUFFER_SIZE).decode('utf-8', errors='replace')
+    except OSError:
+        return False
+    if not first_line.startswith('#!'):
+        return False
+    return any(os.path.basename(word).startswith('python') for word in first_line[2:].split())
+
+
+def is_warm_script(script):
+    """
+    `.py` scripts and Python scripts with a `# fridge: warm` comment, unless they have a `# fridge: cold` comment.
+    The worker runs scripts as Python, `warm` is ignored for any other interpreter.
+    """
+    directives = read_directives(script)
+    if directives.get('cold'):
+        return False
+    if script.endswith('.py'):
+        return True
+    if not directives.get('warm'):
+        return False
+    if not has_python_shebang(script):
+        print_logger("Ignoring '# fridge: warm' of '%s', only Python scripts can run in the warm worker" % script)
+        return False
+    return True
+
+
+def _send(connection, **message):
+    connection.sendall(json.dumps(message).encode('utf-8') + b'\n')
+
+
+def _receive(connection):
+    """ Reads a request and the file descriptors sent along with it """
+    fds = array.array('i')
+    data, ancdata, _, _ = connection.recvmsg(BUFFER_SIZE, socket.CMSG_LEN(2 * fds.itemsize))
+    for level, kind, payload in ancdata:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(payload[:len(payload) - len(payload) % fds.itemsize])
+    while not data.endswith(b'\n'):
+        chunk = connection.recv(BUFFER_SIZE)
+        if not chunk:
+            raise EOFError("the runner closed the connection")
+        data += chunk
+    return json.loads(data.decode('utf-8')), list(fds)
+
+
+def _exit_code(code):
+    """ Exit code of a script ending with sys.exit(code), as the interpreter computes it """
+    if code is None:
+        return 0
+    if isinstance(code, int):
+        return code
+    sys.stderr.write("%s\n" % code)
+    return 1
+
+
+def _run_script(request, stdout_fd, stderr_fd):
+    """ Runs in the forked process, like `python script args...` would, never returns """
+    os.setsid()
+    stdin_fd = os.open(os.devnull, os.O_RDONLY)
+    for fd, target in ((stdin_fd, 0), (stdout_fd, 1), (stderr_fd, 2)):
+        os.dup2(fd, target)
+        os.close(fd)
+    # buffers inherited from the worker are dropped, not flushed to the script's pipes
+    sys.stdin = open(0, 'r', closefd=False)
+    sys.stdout = open(1, 'w', closefd=False)
+    sys.stderr = open(2, 'w', buffering=1, closefd=False, errors='backslashreplace')
+
+    for name, error in apply_process_settings(request['settings']):
+        sys.stderr.write("fridge warm: %s was not applied: %s\n" % (name, error))
+
+    script = request['argv'][0]
+    os.environ.clear()
+    os.environ.update(request['env'])
+    os.chdir(request['cwd'])
+    sys.argv = list(request['argv'])
+    sys.path[0] = os.path.dirname(os.path.abspath(script))
+
+    import runpy
+    import threading
+    import traceback
+
+    try:
+        runpy.run_path(script, run_name='__main__')
+        code = 0
+    except SystemExit as e:
+        code = _exit_code(e.code)
+    except BaseException:
+        traceback.print_exc()
+        code = 1
+
+    # like the interpreter at exit: non daemon threads are joined and atexit callbacks run
+    try:
+        for thread in threading.enumerate():
+            if thread is not threading.current_thread() and not thread.daemon:
+                thread.join()
+        atexit._run_exitfuncs()
+        sys.stdout.flush()
+        sys.stderr.flush()
+    except BaseException:
+        code = code or 1
+    os._exit(code)
+
+
+def _monitor(connection):
+    """ Forks the requested script, reports its pid and, once it ends, its exit status and resource usage """
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    request, fds = _receive(connection)
+    stdout_fd, stderr_fd = fds
+    pid = os.fork()
+    if pid == 0:
+        connection.close()
+        _run_script(request, stdout_fd, stderr_fd)
+    os.close(stdout_fd)
+    os.close(stderr_fd)
+    _send(connection, pid=pid)
+    _, status, usage = os.wait4(pid, 0)
+    _send(connection, status=status, usage=list(usage))
+
+
+def _serve(listener, runner_fd, preload):
+    """ Main loop of the worker, it ends once the runner exits and its end of runner_fd is closed """
+    # callbacks registered by the runner must not run when scripts exit
+    atexit._clear()
+    # monitors are reaped by the kernel, the worker never waits for them
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    for module in preload:
+        try:
+            importlib.import_module(module)
+        except Exception as e:
+            print_logger("Warm worker could not preload '%s': %s" % (module, e))
+
+    selector = selectors.DefaultSelector()
+    selector.register(listener, selectors.EVENT_READ)
+    selector.register(runner_fd, selectors.EVENT_READ)
+    while True:
+        for key, _ in selector.select():
+            if key.fileobj == runner_fd:
+                return
+            connection, _ = listener.accept()
+            if os.fork() == 0:
+                selector.close()
+                listener.close()
+                os.close(runner_fd)
+                try:
+                    _monitor(connection)
+                finally:
+                    os._exit(0)
+            connection.close()
+
+
+class WarmProcess(object):
+    """ A script forked by the warm worker, used like the Popen of a script started with subprocess """
+
+    def __init__(self, connection, connection_file, pid, stdout, stderr):
+        self._connection = connection
+        self._file = connection_file
+        self.pid = pid
+        self.stdout = stdout
+        self.stderr = stderr
+        self.returncode = None
+
+    def wait_with_usage(self):
+        """ The script is a child of the worker, which reports how it ended """
+        import resource
+
+        line = self._file.readline()
+        self._file.close()
+        self._connection.close()
+        if not line:
+            raise OSError("the warm worker exited before '%s' ended" % self.pid)
+        message = json.loads(line.decode('utf-8'))
+        self.returncode = returncode_from_status(message['status'])
+        return self.returncode, resource.struct_rusage(message['usage'])
+
+
+class WarmWorker(object):
+    """
+    A Python interpreter forked when the runner starts, with common modules already imported. Python scripts are
+    forked from it instead of starting a new interpreter, each one in a process and session of its own with its
+    output sent to pipes of the runner, so they are streamed, timed out and measured like any other script.
+    """
+
+    def __init__(self, socket_path, preload):
+        self.socket_path = socket_path
+        self.preload = preload
+        self.pid = None
+        self._runner_fd = None
+
+    def start(self):
+        """ Must run before the runner starts threads, forking copies only the calling thread """
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # anyone connecting can run code as this user, only the user may connect
+        umask = os.umask(0o177)
+        try:
+            listener.bind(self.socket_path)
+        finally:
+            os.umask(umask)
+        listener.listen(64)
+
+        worker_fd, self._runner_fd = os.pipe()
+        self.pid = os.fork()
+        if self.pid == 0:
+            os.close(self._runner_fd)
+            try:
+                _serve(listener, worker_fd, self.preload)
+            finally:
+                os._exit(0)
+        os.close(worker_fd)
+        listener.close()
+        print_logger("Warm Python worker listening on '%s'" % self.socket_path)
+
+    def run(self, cmd, policy=None):
+        """ Starts cmd in a process forked by the worker, returns a Popen like WarmProcess """
+        env = (policy.environment() if policy is not None else None) or dict(os.environ)
+        settings = policy.process_settings() if policy is not None else {}
+        request = dict(argv=cmd, env=env, cwd=os.getcwd(), settings=settings)
+
+        stdout_read, stdout_write = os.pipe()
+        stderr_read, stderr_write = os.pipe()
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            connection.connect(self.socket_path)
+            connection.sendmsg(
+                [json.dumps(request).encode('utf-8') + b'\n'],
+                [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', [stdout_write, stderr_write]))]
+            )
+            connection_file = connection.makefile('rb')
+            line = connection_file.readline()
+            if not line:
+                raise OSError("the warm worker did not start '%s'" % cmd[0])
+        except OSError:
+            connection.close()
+            for fd in (stdout_read, stderr_read):
+                os.close(fd)
+            raise
+        finally:
+            os.close(stdout_write)
+            os.close(stderr_write)
+
+        pid = json.loads(line.decode('utf-8'))['pid']
+        return WarmProcess(
+            connection, connection_file, pid, os.fdopen(stdout_read, 'rb', 0), os.fdopen(stderr_read, 'rb', 0)
+        )
+
+    def stop(self):
+        os.close(self._runner_fd)
+        os.waitpid(self.pid, 0)
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+
+def is_warm_worker_enabled():
+    return os.environ.get(WARM_PYTHON_HOOKS, '').lower() in ('1', 'true', 'yes')
+
+
+def get_preload():
+    extra = [module.strip() for module in os.environ.get(WARM_PYTHON_PRELOAD, '').split(',') if module.strip()]
+    return list(DEFAULT_PRELOAD) + extra
+
+
+def start_warm_worker():
+    """ Starts the worker when enabled, returns it or None """
+    global _worker
+    if not is_warm_worker_enabled():
+        return None
+    _worker = WarmWorker(WORKER_SOCKET_PATH % os.getpid(), get_preload())
+    _worker.start()
+    return _worker
+
+
+def stop_warm_worker():
+    global _worker
+    if _worker is not None:
+        _worker.stop()
+        _worker = None
+
+
+def get_warm_worker():
+    """ The worker started by this process, None if Python scripts start their own interpreter """
+    return _worker
@@ -5,5 +5,10 @@ set -e
 echo "[Boot script] Installing dependecies"
 fridge -i
 
-echo "[Boot script] All ok running cron in foreground"
-crond -f -d 8
\ No newline at end of file
+if [ -n "$USE_CROND" ]; then
+    echo "[Boot script] All ok running cron in foreground"
+    exec crond -f -d 8
+fi
+
+echo "[Boot script] All ok running scheduler in foreground"
+exec fridge --daemon
@@ -0,0 +1,39 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+from sidefridge.storage import STORE_SOCKET
+from sidefridge.store_server import StoreServer
+
+ROOT = os.path.realpath(os.path.join(os.path.dirname(__file__), '..'))
+
+WRAPPER = 'import sys; from {module} import {function}; sys.exit({function}())'
+
+
+def entry_point(module, function, arguments, env=None, input=None):
+    """ Runs an entry point the way the setuptools wrappers do, returns the CompletedProcess """
+    env = dict(os.environ if env is None else env)
+    env['PYTHONPATH'] = ROOT
+    return subprocess.run(
+        [sys.executable, '-c', WRAPPER.format(module=module, function=function)] + list(arguments),
+        env=env, input=input, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+
+
+def write_script(path, content):
+    with open(str(path), 'w') as f:
+        f.write(content)
+    os.chmod(str(path), 0o755)
+    return str(path)
+
+
+@pytest.fixture
+def store_server(tmp_path, monkeypatch):
+    """ A storage server like the one of a run, store_var and load_var started from the test reach it """
+    server = StoreServer(str(tmp_path / 'store.sock'))
+    server.start()
+    monkeypatch.setenv(STORE_SOCKET, server.socket_path)
+    yield server
+    server.stop()
@@ -0,0 +1,97 @@
+import datetime
+import json
+import sys
+
+import pytest
+
+from sidefridge import main as runner
+from sidefridge import storage
+from sidefridge.checkpoint import CHECKPOINT_FILE, CHECKPOINT_TTL_SECONDS, RUN_CHECKPOINTS
+from sidefridge.coordination import RUN_STATE_DIR
+from sidefridge.history import RUN_HISTORY_PATH
+from sidefridge.leases import RUN_LEASE_DIR
+from sidefridge.scripts import BACKUPS, ScriptsDetector
+
+from tests.conftest import ROOT, WRAPPER, write_script
+
+STORE_VAR = '%s -c "%s"' % (sys.executable, WRAPPER.format(module='sidefridge.storage', function='store_var'))
+LOAD_VAR = '%s -c "%s"' % (sys.executable, WRAPPER.format(module='sidefridge.storage', function='load_var'))
+
+
+@pytest.fixture
+def scripts_dir(tmp_path, monkeypatch):
+    """ Scripts of a run with checkpoints enabled, everything the run keeps is under tmp_path """
+    state_dir = tmp_path / 'state'
+    state_dir.mkdir()
+    monkeypatch.setenv(RUN_CHECKPOINTS, 'true')
+    monkeypatch.setenv(RUN_STATE_DIR, str(state_dir))
+    monkeypatch.setenv(RUN_HISTORY_PATH, str(tmp_path / 'history.db'))
+    monkeypatch.setenv('PYTHONPATH', ROOT)
+    monkeypatch.delenv(RUN_LEASE_DIR, raising=False)
+    monkeypatch.setattr(storage, 'TMP_STORE', str(tmp_path / 'storage_path'))
+
+    path = tmp_path / 'scripts'
+    (path / BACKUPS).mkdir(parents=True)
+    log = tmp_path / 'log'
+    write_script(path / BACKUPS / '10_first.sh', '#!/bin/sh\necho first >> %s\n%s marker 1\n' % (log, STORE_VAR))
+    write_script(path / BACKUPS / '20_second.sh', (
+        '#!/bin/sh\necho "second $(%s marker) $(%s progress none)" >> %s\n%s progress half\n[ ! -e %s ]\n' % (
+            LOAD_VAR, LOAD_VAR, log, STORE_VAR, tmp_path / 'fail'
+        )
+    ))
+    (tmp_path / 'fail').touch()
+    return path
+
+
+def run(scripts_dir):
+    runner.start_run(ScriptsDetector(str(scripts_dir)), fire_time=datetime.datetime.now())
+
+
+def checkpoint_path(scripts_dir):
+    return scripts_dir.parent / 'state' / CHECKPOINT_FILE
+
+
+def log_lines(scripts_dir):
+    return (scripts_dir.parent / 'log').read_text().splitlines()
+
+
+def test_failed_run_is_resumed(scripts_dir):
+    run(scripts_dir)
+    assert log_lines(scripts_dir) == ['first', 'second 1 none']
+    checkpoint = json.loads(checkpoint_path(scripts_dir).read_text())
+    assert list(checkpoint['scripts'][BACKUPS]) == ['10_first.sh']
+    assert checkpoint['store'] == {'marker': '1', 'progress': 'half'}
+
+    (scripts_dir.parent / 'fail').unlink()
+    run(scripts_dir)
+    # the first script is skipped, the second one finds the values of the failed run
+    assert log_lines(scripts_dir) == ['first', 'second 1 none', 'second 1 half']
+    assert not checkpoint_path(scripts_dir).exists()
+
+    run(scripts_dir)
+    assert log_lines(scripts_dir)[3:] == ['first', 'second 1 none']
+
+
+def test_changed_script_is_run_again(scripts_dir):
+    run(scripts_dir)
+    write_script(scripts_dir / BACKUPS / '10_first.sh', '#!/bin/sh\necho first v2 >> %s\n' % (
+        scripts_dir.parent / 'log'
+    ))
+    (scripts_dir.parent / 'fail').unlink()
+    run(scripts_dir)
+    assert log_lines(scripts_dir) == ['first', 'second 1 none', 'first v2', 'second 1 half']
+
+
+def test_expired_checkpoint_is_discarded(scripts_dir, monkeypatch, capsys):
+    monkeypatch.setenv(CHECKPOINT_TTL_SECONDS, '60')
+    run(scripts_dir)
+    checkpoint = json.loads(checkpoint_path(scripts_dir).read_text())
+    checkpoint['created'] -= 120
+    checkpoint_path(scripts_dir).write_text(json.dumps(checkpoint))
+
+    (scripts_dir.parent / 'fail').unlink()
+    capsys.readouterr()
+    run(scripts_dir)
+    assert 'it expired' in capsys.readouterr().out
+    assert log_lines(scripts_dir) == ['first', 'second 1 none', 'first', 'second 1 none']
+    assert not checkpoint_path(scripts_dir).exists()
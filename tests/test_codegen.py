@@ -0,0 +1,242 @@
+import base64
+import json
+import os
+import random
+
+import pytest
+import yaml
+
+from sidefridge.codegen import MANIFEST_FILE, generate_batch, generate_project
+from sidefridge.scripts import BACKUPS, SUPPORTED_DIRECTORIES, ScriptsDetector
+
+from tests.conftest import entry_point, write_script
+
+PROJECT = dict(namespace='ns', project_name='app', container_name='backup', container_scripts_path='/scripts')
+
+
+def make_hooks(tmp_path, scripts):
+    in_dir = tmp_path / 'in'
+    for relative_path, content in scripts.items():
+        (in_dir / os.path.dirname(relative_path)).mkdir(parents=True, exist_ok=True)
+        write_script(in_dir / relative_path, content)
+    out_dir = tmp_path / 'out'
+    out_dir.mkdir()
+    return str(in_dir), str(out_dir)
+
+
+def output_stats(out_dir):
+    return {
+        name: (stat.st_ino, stat.st_mtime_ns)
+        for name, stat in ((name, os.stat(os.path.join(out_dir, name))) for name in os.listdir(out_dir))
+    }
+
+
+def test_second_run_rewrites_nothing(tmp_path):
+    in_dir, out_dir = make_hooks(tmp_path, {
+        'backups/10_dump.sh': '#!/bin/sh\nmongodump\n',
+        'after_backups/10_upload.sh': '#!/bin/sh\nupload\n',
+    })
+    written = generate_project(in_dir=in_dir, out_dir=out_dir, **PROJECT)
+    assert sorted(written) == [
+        'app-accounts.yaml', 'app-config-maps.yaml', 'app-partial_service_account_name_volumes.yaml',
+        'app-partial_volume_mounts.yaml'
+    ]
+    stats = output_stats(out_dir)
+    assert MANIFEST_FILE in stats
+
+    assert generate_project(in_dir=in_dir, out_dir=out_dir, **PROJECT) == []
+    assert output_stats(out_dir) == stats
+
+    result = entry_point('sidefridge.codegen', 'main', ['ns', 'app', 'backup', in_dir, out_dir])
+    assert result.returncode == 0, result.stderr
+    assert b"Updated 0 file(s)" in result.stdout
+    assert output_stats(out_dir) == stats
+
+
+def test_only_outputs_of_changed_inputs_are_rewritten(tmp_path):
+    in_dir, out_dir = make_hooks(tmp_path, {'backups/10_dump.sh': '#!/bin/sh\nmongodump\n'})
+    generate_project(in_dir=in_dir, out_dir=out_dir, **PROJECT)
+
+    write_script(os.path.join(in_dir, 'backups', '10_dump.sh'), '#!/bin/sh\nmongodump --gzip\n')
+    # the volumes only depend on the script names, rendering them again gives the same content
+    assert generate_project(in_dir=in_dir, out_dir=out_dir, **PROJECT) == ['app-config-maps.yaml']
+    with open(os.path.join(out_dir, 'app-config-maps.yaml')) as f:
+        assert 'mongodump --gzip' in f.read()
+
+    # a file edited by hand is rendered again
+    with open(os.path.join(out_dir, 'app-accounts.yaml'), 'a') as f:
+        f.write('edited\n')
+    assert generate_project(in_dir=in_dir, out_dir=out_dir, **PROJECT) == ['app-accounts.yaml']
+    assert generate_project(in_dir=in_dir, out_dir=out_dir, **PROJECT) == []
+
+
+def random_script(size, seed):
+    """ A script whose content does not compress, its size is known in advance """
+    text = random.Random(seed).getrandbits(4 * size).to_bytes(size // 2, 'little').hex()
+    return '#!/bin/sh\n# %s\n' % text[:size - 14]
+
+
+def load_outputs(out_dir):
+    with open(os.path.join(out_dir, 'app-config-maps.yaml')) as f:
+        config_maps = {document['metadata']['name']: document for document in yaml.safe_load_all(f)}
+    with open(os.path.join(out_dir, 'app-partial_service_account_name_volumes.yaml')) as f:
+        volumes = {volume['name']: volume for volume in yaml.safe_load(f)['volumes']}
+    return config_maps, volumes
+
+
+def test_large_hook_is_split_under_one_projected_volume(tmp_path):
+    scripts = {'backups/%d_part.sh' % index: random_script(1500, index) for index in range(10, 15)}
+    in_dir, out_dir = make_hooks(tmp_path, scripts)
+    generate_project(in_dir=in_dir, out_dir=out_dir, max_config_map_size=4096, **PROJECT)
+
+    config_maps, volumes = load_outputs(out_dir)
+    names = ['app-backup-config-backups', 'app-backup-config-backups-2', 'app-backup-config-backups-3']
+    assert [name for name in config_maps if name.startswith('app-backup-config-backups')] == names
+    with open(os.path.join(out_dir, 'app-config-maps.yaml')) as f:
+        assert all(len(document.encode('utf-8')) <= 4096 for document in f.read().split('---\n'))
+
+    # every script is in exactly one ConfigMap, with its content
+    data = {key: value for name in names for key, value in config_maps[name]['data'].items()}
+    assert data == {os.path.basename(path): content for path, content in scripts.items()}
+
+    volume = volumes['app-backup-config-backups-volume']
+    assert 'configMap' not in volume
+    sources = volume['projected']['sources']
+    assert [source['configMap']['name'] for source in sources] == names
+    assert sorted(item['path'] for source in sources for item in source['configMap']['items']) == sorted(data)
+    # hooks which fit keep a plain ConfigMap volume
+    assert 'configMap' in volumes['app-backup-config-after_backups-volume']
+
+
+def test_large_script_is_compressed_and_decompressed_once(tmp_path):
+    big_script = '#!/bin/sh\n' + 'echo "a line which compresses well"\n' * 200
+    in_dir, out_dir = make_hooks(tmp_path, {
+        'backups/10_small.sh': '#!/bin/sh\nexit 0\n',
+        'backups/20_big.sh': big_script,
+    })
+    generate_project(in_dir=in_dir, out_dir=out_dir, compress_threshold=1024, **PROJECT)
+
+    config_map = load_outputs(out_dir)[0]['app-backup-config-backups']
+    assert config_map['data'] == {'10_small.sh': '#!/bin/sh\nexit 0\n'}
+    assert list(config_map['binaryData']) == ['20_big.sh.gz']
+
+    # the ConfigMap as mounted in the container
+    mounted = tmp_path / 'scripts'
+    (mounted / BACKUPS).mkdir(parents=True)
+    write_script(mounted / BACKUPS / '10_small.sh', config_map['data']['10_small.sh'])
+    (mounted / BACKUPS / '20_big.sh.gz').write_bytes(base64.b64decode(config_map['binaryData']['20_big.sh.gz']))
+
+    cache = tmp_path / 'cache'
+    detector = ScriptsDetector(str(mounted), decompress_dir=str(cache))
+    decompressed = str(cache / BACKUPS / '20_big.sh')
+    assert detector.backups == [str(mounted / BACKUPS / '10_small.sh'), decompressed]
+    with open(decompressed) as f:
+        assert f.read() == big_script
+    assert os.access(decompressed, os.X_OK)
+
+    stat = os.stat(decompressed)
+    detector._scan(SUPPORTED_DIRECTORIES)
+    assert (os.stat(decompressed).st_ino, os.stat(decompressed).st_mtime_ns) == (stat.st_ino, stat.st_mtime_ns)
+
+
+def test_script_too_large_for_a_config_map_fails(tmp_path):
+    in_dir, out_dir = make_hooks(tmp_path, {'backups/10_huge.sh': random_script(8192, 0)})
+    result = entry_point(
+        'sidefridge.codegen', 'main', ['ns', 'app', 'backup', in_dir, out_dir, '--max-config-map-size', '4K']
+    )
+    assert result.returncode == 1
+    assert b"Script '10_huge.sh' of 'backups' does not fit in a ConfigMap of 4096 bytes" in result.stdout
+    assert b'Traceback' not in result.stderr
+    assert not os.path.exists(os.path.join(out_dir, 'app-config-maps.yaml'))
+
+
+def run_batch(tmp_path, projects, *arguments):
+    manifest = tmp_path / 'projects.json'
+    manifest.write_text(json.dumps(dict(projects=projects)))
+    return entry_point('sidefridge.codegen', 'main', ['--batch', str(manifest)] + list(arguments))
+
+
+@pytest.mark.parametrize('size', [[1024], 1024.5, 0, -1, True, '0', 'lots'])
+def test_batch_rejects_invalid_sizes(tmp_path, size):
+    in_dir, out_dir = make_hooks(tmp_path, {'backups/10_dump.sh': '#!/bin/sh\nmongodump\n'})
+    project = dict(PROJECT, in_dir=in_dir, out_dir=out_dir, max_config_map_size=size)
+    result = run_batch(tmp_path, [project])
+    assert result.returncode == 1
+    assert b"Project 0 of '%s' has an invalid max_config_map_size" % str(tmp_path / 'projects.json').encode() \
+        in result.stdout
+    assert b'Traceback' not in result.stderr
+    assert os.listdir(out_dir) == []
+
+
+def test_batch_keeps_projects_with_the_same_name(tmp_path):
+    in_dir, out_dir = make_hooks(tmp_path, {'backups/10_dump.sh': '#!/bin/sh\nmongodump\n'})
+    projects = []
+    for name, directory in (('app', 'staging'), ('shop', 'shop'), ('app', 'production')):
+        (tmp_path / directory).mkdir()
+        projects.append(dict(PROJECT, project_name=name, in_dir=in_dir, out_dir=str(tmp_path / directory)))
+
+    results = generate_batch(projects, 2)
+    assert [(name, error) for name, _, _, error in results] == [('app', None), ('shop', None), ('app', None)]
+    for directory in ('staging', 'production'):
+        assert os.path.exists(str(tmp_path / directory / 'app-config-maps.yaml'))
+
+
+def test_batch_rejects_projects_overwriting_each_other(tmp_path):
+    in_dir, out_dir = make_hooks(tmp_path, {'backups/10_dump.sh': '#!/bin/sh\nmongodump\n'})
+    project = dict(PROJECT, in_dir=in_dir, out_dir=out_dir)
+    result = run_batch(tmp_path, [project, dict(project, namespace='other')])
+    assert result.returncode == 1
+    assert b"Projects 0 and 1 of '%s' both write 'app'" % str(tmp_path / 'projects.json').encode() in result.stdout
+    assert os.listdir(out_dir) == []
+
+
+def read_outputs(out_dir):
+    contents = {}
+    for name in os.listdir(out_dir):
+        with open(os.path.join(out_dir, name)) as f:
+            contents[name] = f.read()
+    return contents
+
+
+def test_batch_generates_projects_in_parallel_like_single_mode(tmp_path):
+    in_dir, out_dir = make_hooks(tmp_path, {
+        'backups/10_dump.sh': '#!/bin/sh\nmongodump\n',
+        'after_backups/10_upload.sh': '#!/bin/sh\nupload\n',
+    })
+    projects = []
+    for name in ('app', 'shop', 'blog'):
+        (tmp_path / name).mkdir()
+        # relative directories are relative to the manifest
+        projects.append(dict(PROJECT, project_name=name, in_dir='in', out_dir=name, compress_threshold='1K'))
+
+    result = run_batch(tmp_path, projects, '--jobs', '3', '--max-config-map-size', '4K')
+    assert result.returncode == 0, result.stderr
+    output = result.stdout.decode()
+    assert [line.split("'")[1] for line in output.splitlines() if 'Project' in line] == ['app', 'shop', 'blog']
+    assert 'Generated 3 project(s)' in output and 'with 3 job(s), 0 failed' in output
+
+    for name in ('app', 'shop', 'blog'):
+        single_dir = tmp_path / ('single-' + name)
+        single_dir.mkdir()
+        result = entry_point('sidefridge.codegen', 'main', [
+            'ns', name, 'backup', in_dir, str(single_dir), '--max-config-map-size', '4K', '--compress-threshold', '1K'
+        ])
+        assert result.returncode == 0, result.stderr
+        assert read_outputs(str(tmp_path / name)) == read_outputs(str(single_dir))
+
+
+def test_batch_missing_directory_fails_its_project(tmp_path):
+    in_dir, out_dir = make_hooks(tmp_path, {'backups/10_dump.sh': '#!/bin/sh\nmongodump\n'})
+    missing = str(tmp_path / 'missing')
+    result = run_batch(tmp_path, [
+        dict(PROJECT, in_dir=in_dir, out_dir=out_dir),
+        dict(PROJECT, project_name='shop', in_dir=in_dir, out_dir=missing),
+    ], '--jobs', '2')
+    assert result.returncode == 1
+    output = result.stdout.decode()
+    assert "Project 'shop' failed after" in output
+    assert "The following path '%s' is not a valid directory" % missing in output
+    assert "Generated 2 project(s)" in output and '1 failed' in output
+    assert b'Traceback' not in result.stderr
+    # the other projects are generated anyway
+    assert os.path.exists(os.path.join(out_dir, 'app-config-maps.yaml'))
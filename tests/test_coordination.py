@@ -0,0 +1,68 @@
+import datetime
+import time
+
+from sidefridge.coordination import (
+    MAX_CATCH_UP_RUNS, RUN_STATE_DIR, get_pod_identity, missed_fire_times, schedule_offset,
+    warn_if_state_not_persistent
+)
+from sidefridge.kubectlexec import POD_NAME
+
+NOW = datetime.datetime(2024, 3, 10, 12, 0, 30)
+
+
+def minutes_before(minutes):
+    return datetime.datetime(2024, 3, 10, 12, 0) - datetime.timedelta(minutes=minutes)
+
+
+def test_recent_missed_runs():
+    missed = missed_fire_times('* * * * *', minutes_before(3), NOW)
+    assert missed == [minutes_before(2), minutes_before(1), minutes_before(0)]
+    assert missed_fire_times('* * * * *', minutes_before(0), NOW) == []
+
+
+def test_fire_time_equal_to_now_is_due():
+    assert missed_fire_times('* * * * *', minutes_before(1), minutes_before(0)) == [minutes_before(0)]
+
+
+def test_old_last_fire_time_is_bounded():
+    started = time.monotonic()
+    missed = missed_fire_times('* * * * *', NOW - datetime.timedelta(days=365), NOW)
+    assert time.monotonic() - started < 1
+    assert missed == [minutes_before(minutes) for minutes in reversed(range(MAX_CATCH_UP_RUNS))]
+
+
+def test_state_in_the_default_dir_is_warned_about(monkeypatch, capsys):
+    monkeypatch.delenv(RUN_STATE_DIR, raising=False)
+    warn_if_state_not_persistent(['MISSED_RUN_POLICY', 'RUN_CHECKPOINTS'])
+    output = capsys.readouterr().out
+    assert "WARNING: MISSED_RUN_POLICY, RUN_CHECKPOINTS keep their state in '/tmp'" in output
+
+    warn_if_state_not_persistent([])
+    assert capsys.readouterr().out == ''
+
+
+def test_explicit_state_dir_is_not_warned_about(tmp_path, monkeypatch, capsys):
+    monkeypatch.setenv(RUN_STATE_DIR, str(tmp_path))
+    warn_if_state_not_persistent(['MISSED_RUN_POLICY'])
+    assert capsys.readouterr().out == ''
+
+
+def test_offset_is_stable_per_pod(monkeypatch):
+    monkeypatch.setenv(POD_NAME, 'backup-0')
+    offset = schedule_offset('0 * * * *', get_pod_identity(), 600, NOW)
+    assert 0 <= offset < 600
+    # same pod after a restart, at another time
+    assert schedule_offset('0 * * * *', get_pod_identity(), 600, NOW + datetime.timedelta(days=3)) == offset
+
+    offsets = [schedule_offset('0 * * * *', 'backup-%d' % index, 600, NOW) for index in range(200)]
+    assert len(set(offsets)) > 100
+    # spread evenly, each tenth of the window gets its share of the pods
+    assert all(5 < sum(1 for offset in offsets if tenth * 60 <= offset < (tenth + 1) * 60) < 40 for tenth in range(10))
+
+
+def test_offset_is_capped_to_the_shortest_interval():
+    identities = ['backup-%d' % index for index in range(200)]
+    assert max(schedule_offset('*/5 * * * *', identity, 3600, NOW) for identity in identities) < 300
+    # 1h then 23h between runs
+    assert max(schedule_offset('0 1,2 * * *', identity, 86400, NOW) for identity in identities) < 3600
+    assert schedule_offset('0 * * * *', 'backup-0', 0, NOW) == 0
@@ -0,0 +1,58 @@
+import datetime
+import os
+import signal
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from sidefridge import main as runner
+from sidefridge.daemon import Scheduler
+from sidefridge.scripts import BACKUPS
+from sidefridge.supervision import running_scripts
+
+from tests.conftest import write_script
+
+
+@pytest.fixture
+def signal_handlers():
+    handlers = {signum: signal.getsignal(signum) for signum in (signal.SIGTERM, signal.SIGINT)}
+    yield
+    for signum, handler in handlers.items():
+        signal.signal(signum, handler)
+    running_scripts.stopping = False
+
+
+def test_sigterm_during_a_run_stops_scripts_and_runs_on_error(tmp_path, signal_handlers):
+    marker = tmp_path / 'marker'
+    long_script = write_script(tmp_path / '10_long.sh', '#!/bin/sh\nsleep 30 &\nwait\n')
+    next_script = write_script(tmp_path / '20_next.sh', '#!/bin/sh\necho next >> %s\n' % marker)
+    on_error = write_script(tmp_path / 'on_error.sh', '#!/bin/sh\necho "on_error $1" >> %s\n' % marker)
+    detector = SimpleNamespace(on_error=[on_error], path=str(tmp_path))
+
+    scheduler = Scheduler(
+        '* * * * *', lambda fire_time: runner.run_scripts(detector, [long_script, next_script], BACKUPS),
+        on_stop=running_scripts.stop
+    )
+    scheduler.install_signal_handlers()
+    threading.Timer(1, os.kill, (os.getpid(), signal.SIGTERM)).start()
+
+    started = time.monotonic()
+    scheduler.run_once(datetime.datetime.now())
+
+    assert time.monotonic() - started < 10
+    assert scheduler.stop_event.is_set()
+    lines = marker.read_text().splitlines()
+    assert len(lines) == 1
+    assert lines[0].startswith("on_error Script '%s' was stopped" % long_script)
+
+
+def test_sigterm_while_idle_does_not_stop_scripts(signal_handlers):
+    stopped = []
+    scheduler = Scheduler('* * * * *', lambda fire_time: None, on_stop=lambda: stopped.append(True))
+    scheduler.install_signal_handlers()
+    os.kill(os.getpid(), signal.SIGTERM)
+
+    assert scheduler.stop_event.is_set()
+    assert stopped == []
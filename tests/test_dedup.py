@@ -0,0 +1,112 @@
+import io
+import os
+import random
+import zlib
+
+import pytest
+
+from sidefridge.dedup import CHUNKS_DIRECTORY, ChunkStore, Chunker, DedupError
+
+from tests.conftest import entry_point
+
+SIZES = ['--min-size', '1K', '--avg-size', '4K', '--max-size', '16K']
+
+
+def random_bytes(size, seed=0):
+    return random.Random(seed).getrandbits(8 * size).to_bytes(size, 'little')
+
+
+DATA = random_bytes(512 * 1024)
+
+
+def chunks_of(data):
+    return list(Chunker(1024, 4096, 16384).split(io.BytesIO(data)))
+
+
+def dedup(store_path, arguments, data=None):
+    return entry_point('sidefridge.dedup', 'main', ['-s', str(store_path)] + arguments, input=data)
+
+
+def stored_chunks(store_path):
+    chunks_path = os.path.join(str(store_path), CHUNKS_DIRECTORY)
+    return {name for directory in os.listdir(chunks_path) for name in os.listdir(os.path.join(chunks_path, directory))}
+
+
+def test_boundaries_are_stable_after_an_insertion_at_the_start():
+    chunks = chunks_of(DATA)
+    assert b''.join(chunks) == DATA
+    assert 50 < len(chunks) < 500
+    assert all(len(chunk) <= 16384 for chunk in chunks)
+
+    shifted = chunks_of(b'inserted header' + DATA)
+    # only the chunks around the insertion change
+    assert len(set(chunks) - set(shifted)) <= 2
+    assert shifted[-len(chunks) + 2:] == chunks[2:]
+
+
+def test_store_and_restore_round_trip(tmp_path):
+    result = dedup(tmp_path, ['store', '-n', 'first'] + SIZES, DATA)
+    assert result.returncode == 0, result.stderr
+
+    changed = DATA[:1000] + b'changed' + DATA[1000:]
+    result = dedup(tmp_path, ['store', '-n', 'second'] + SIZES, changed)
+    assert result.returncode == 0, result.stderr
+    second = ChunkStore(str(tmp_path)).load_manifest('second')
+    assert second['size'] == len(changed)
+    assert second['new_bytes'] < 64 * 1024
+
+    for name, data in (('first', DATA), ('second', changed)):
+        result = dedup(tmp_path, ['restore', '-n', name])
+        assert result.returncode == 0, result.stderr
+        assert result.stdout == data
+
+    result = dedup(tmp_path, ['restore', '-n', 'missing'])
+    assert result.returncode == 1
+    assert b"No backup named 'missing'" in result.stderr
+
+
+def test_gc_keep_removes_unreferenced_chunks(tmp_path):
+    store = ChunkStore(str(tmp_path))
+    chunker = Chunker(1024, 4096, 16384)
+    store.store('old', io.BytesIO(random_bytes(64 * 1024, seed=1)), chunker)
+    store.store('shared', io.BytesIO(DATA), chunker)
+    kept = store.store('new', io.BytesIO(DATA + random_bytes(64 * 1024, seed=2)), chunker)
+
+    result = dedup(tmp_path, ['gc', '-k', '1'])
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.startswith(b'removed 2 backup(s)')
+
+    assert [manifest['name'] for manifest in store.manifests()] == ['new']
+    assert stored_chunks(tmp_path) == {digest for digest, _ in kept['chunks']}
+    output = io.BytesIO()
+    store.restore('new', output)
+    assert output.getvalue() == DATA + random_bytes(64 * 1024, seed=2)
+
+    assert dedup(tmp_path, ['gc']).stdout == b'removed 0 backup(s) and 0 chunk(s)\n'
+
+
+@pytest.mark.parametrize('keep', ['-1', 'all'])
+def test_gc_rejects_invalid_keep(tmp_path, keep):
+    store = ChunkStore(str(tmp_path))
+    store.store('backup', io.BytesIO(DATA), Chunker(1024, 4096, 16384))
+
+    result = dedup(tmp_path, ['gc', '--keep', keep])
+    assert result.returncode == 2
+    assert b"argument -k/--keep" in result.stderr
+    assert [manifest['name'] for manifest in store.manifests()] == ['backup']
+
+
+@pytest.mark.parametrize('content', [zlib.compress(b'other data'), b'not compressed'])
+def test_corrupted_chunks_are_detected(tmp_path, content):
+    store = ChunkStore(str(tmp_path))
+    manifest = store.store('backup', io.BytesIO(DATA), Chunker(1024, 4096, 16384))
+    digest = manifest['chunks'][3][0]
+    with open(store.chunk_path(digest), 'wb') as f:
+        f.write(content)
+
+    with pytest.raises(DedupError, match="Chunk '%s' is corrupted" % digest):
+        store.restore('backup', io.BytesIO())
+
+    result = dedup(tmp_path, ['restore', '-n', 'backup'])
+    assert result.returncode == 1
+    assert b'Traceback' not in result.stderr
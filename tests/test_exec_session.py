@@ -0,0 +1,150 @@
+import io
+import os
+import threading
+
+import pytest
+
+from sidefridge import exec_session
+from sidefridge.exec_session import SESSION_LOST_EXIT_CODE, ExecSession, SessionClosed, SessionServer, run_in_session
+from sidefridge.kubectlexec import POD_NAME, SESSION_SOCKET, TARGET_CONTAINER
+
+from tests.conftest import ROOT, entry_point
+
+FAKE_KUBECTL_DIR = os.path.join(ROOT, 'tests', 'bin')
+
+
+@pytest.fixture
+def kubectl_log(tmp_path, monkeypatch):
+    """ kubectl is replaced by tests/bin/kubectl, the returned file lists the sessions it opened """
+    log = tmp_path / 'kubectl.log'
+    monkeypatch.setenv('PATH', FAKE_KUBECTL_DIR + os.pathsep + os.environ['PATH'])
+    monkeypatch.setenv('FAKE_KUBECTL_LOG', str(log))
+    return log
+
+
+@pytest.fixture
+def session_server(tmp_path, kubectl_log):
+    server = SessionServer(str(tmp_path / 'exec.sock'), 'pod', 'container')
+    server.start()
+    yield server
+    server.stop()
+
+
+def sessions_opened(kubectl_log):
+    return len(kubectl_log.read_text().splitlines()) if kubectl_log.exists() else 0
+
+
+def run(server, command):
+    output = io.BytesIO()
+    exit_code = run_in_session(server.socket_path, command, output)
+    return exit_code, output.getvalue()
+
+
+def test_exit_codes_and_merged_output(session_server):
+    assert run(session_server, 'true') == (0, b'')
+    assert run(session_server, 'exit 7') == (7, b'')
+    assert run(session_server, 'echo out; echo err >&2; exit 3') == (3, b'out\nerr\n')
+    assert run(session_server, "printf 'no newline'") == (0, b'no newline')
+
+
+def test_kubectlexec_returns_the_exit_code(session_server):
+    env = dict(os.environ, **{SESSION_SOCKET: session_server.socket_path, POD_NAME: 'pod', TARGET_CONTAINER: 'c'})
+    result = entry_point('sidefridge.kubectlexec', 'main', ['echo', 'hello;', 'exit', '42'], env=env)
+    assert result.returncode == 42
+    assert result.stdout == b'hello\n'
+
+
+@pytest.mark.parametrize('arguments, output', [
+    (['echo', '"two  spaces"'], b'two  spaces\n'),
+    (['echo', "'$HOME'", '`echo', 'x`'], b'$HOME x\n'),
+    (['printf', "'%s\\n'", '"a\\"b"'], b'a"b\n'),
+])
+def test_kubectlexec_quoting_is_the_same_with_and_without_sessions(session_server, arguments, output):
+    env = dict(os.environ, **{POD_NAME: 'pod', TARGET_CONTAINER: 'c'})
+    for call_env in (env, dict(env, **{SESSION_SOCKET: session_server.socket_path})):
+        result = entry_point('sidefridge.kubectlexec', 'main', arguments, env=call_env)
+        assert (result.returncode, result.stdout) == (0, output)
+
+
+def test_kubectlexec_streams_without_a_session(kubectl_log):
+    env = dict(os.environ, **{POD_NAME: 'pod', TARGET_CONTAINER: 'c'})
+    data = bytes(range(256)) * 1024
+    result = entry_point('sidefridge.kubectlexec', 'main', ['--stream', 'cat;', 'exit', '5'], env=env, input=data)
+    assert result.returncode == 5
+    assert result.stdout == data
+    assert kubectl_log.read_text() == 'exec -i pod -c c -- /bin/sh -c cat; exit 5\n'
+
+
+def test_kubectlexec_stream_without_kubectl(tmp_path):
+    env = dict(os.environ, **{POD_NAME: 'pod', TARGET_CONTAINER: 'c', 'PATH': str(tmp_path)})
+    result = entry_point('sidefridge.kubectlexec', 'main', ['--stream', 'cat'], env=env)
+    assert result.returncode == 127
+    assert b'Could not run kubectl' in result.stdout
+    assert b'Traceback' not in result.stderr
+
+
+def test_output_looking_like_a_marker(session_server, monkeypatch):
+    nonces = iter([b'\x00' * 8, b'\x01' * 8])
+    urandom = os.urandom
+    monkeypatch.setattr(exec_session.os, 'urandom', lambda size: next(nonces) if size == 8 else urandom(size))
+
+    assert run(session_server, 'true') == (0, b'')
+    # the marker of the previous command is plain output for this one
+    previous_marker = '\\n__SIDEFRIDGE_%s__ 0\\n' % ('00' * 8)
+    assert run(session_server, "printf '%s'; echo after; exit 4" % previous_marker) == (
+        4, b'\n__SIDEFRIDGE_0000000000000000__ 0\nafter\n'
+    )
+
+
+def test_large_output_ending_with_a_partial_marker(session_server):
+    exit_code, output = run(session_server, "head -c 200000 /dev/zero; printf '\\n__SIDEFRIDGE_'")
+    assert exit_code == 0
+    assert output == b'\0' * 200000 + b'\n__SIDEFRIDGE_'
+
+
+def test_session_lost_mid_command_is_reopened(session_server, kubectl_log):
+    # the command kills the shell of its session
+    exit_code, output = run(session_server, 'echo before; kill -9 $PPID')
+    assert exit_code == SESSION_LOST_EXIT_CODE
+    assert output.startswith(b'before\n')
+    assert b'kubectl exec session ended before the command completed' in output
+
+    assert run(session_server, 'echo again') == (0, b'again\n')
+    assert sessions_opened(kubectl_log) == 2
+
+
+def test_dead_session_fails_cleanly(kubectl_log):
+    session = ExecSession('pod', 'container')
+    session.process.kill()
+    session.process.wait()
+    with pytest.raises(SessionClosed):
+        session.run('true', lambda data: None)
+    assert not session.alive
+    session.close()
+
+
+def test_sessions_are_reused_across_calls(session_server, kubectl_log):
+    for index in range(5):
+        assert run(session_server, 'echo %d' % index) == (0, b'%d\n' % index)
+    assert sessions_opened(kubectl_log) == 1
+
+
+def test_concurrent_calls_open_extra_sessions(session_server, kubectl_log):
+    barrier = threading.Barrier(3)
+    results = []
+
+    def call():
+        barrier.wait()
+        results.append(run(session_server, 'sleep 0.5; echo done'))
+
+    threads = [threading.Thread(target=call) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results == [(0, b'done\n')] * 3
+    assert sessions_opened(kubectl_log) == 3
+    # once idle, the sessions serve the next calls
+    assert run(session_server, 'echo reused') == (0, b'reused\n')
+    assert sessions_opened(kubectl_log) == 3
@@ -0,0 +1,183 @@
+import os
+import sqlite3
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from sidefridge.history import RunHistory, SECONDS_PER_DAY, percentile, slope_per_day
+from sidefridge.metrics import RunMetrics
+
+from tests.conftest import entry_point
+
+
+def make_metrics(started, durations, success=True, exit_code=0):
+    """ RunMetrics of a completed run with one hook, durations maps script names to wall seconds """
+    metrics = RunMetrics()
+    hook = metrics.hook('backup')
+    for script, wall_seconds in sorted(durations.items()):
+        usage = SimpleNamespace(ru_utime=0.5, ru_stime=0.25, ru_maxrss=2048)
+        hook.record(script, exit_code, wall_seconds, usage, 10, 0)
+    metrics.finish(success)
+    metrics.started = started
+    return metrics
+
+
+@pytest.fixture
+def history(tmp_path):
+    history = RunHistory(str(tmp_path / 'history.db'))
+    yield history
+    history.close()
+
+
+def test_schema_uses_wal(history):
+    assert history.connection.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+    tables = {row[0] for row in history.connection.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    assert {'runs', 'hooks', 'scripts', 'artifacts'} <= tables
+
+
+def test_record(history):
+    now = time.time()
+    history.record(make_metrics(now - 60, {'dump.sh': 3.0, 'upload.sh': 1.0}), {'dump': 100})
+    failed_id = history.record(make_metrics(now, {'dump.sh': 4.0}, success=False, exit_code=2))
+
+    runs = history.last_runs(10)
+    assert [run[0] for run in runs] == [failed_id, failed_id - 1]
+    assert runs[0][3:] == (0, 1, 1)
+    assert runs[1][3:] == (1, 2, 0)
+
+    assert history.connection.execute(
+        'SELECT hook, failed_scripts FROM hooks WHERE run_id = ?', (failed_id,)
+    ).fetchall() == [('backup', 1)]
+    assert history.connection.execute(
+        'SELECT script, user_cpu_seconds, max_rss_bytes, stdout_bytes FROM scripts WHERE run_id = ?', (failed_id,)
+    ).fetchall() == [('dump.sh', 0.5, 2048 * 1024, 10)]
+    assert history.connection.execute('SELECT name, size_bytes FROM artifacts').fetchall() == [('dump', 100)]
+    assert len(history.last_runs(1)) == 1
+
+
+def count_rows(history, table):
+    return history.connection.execute('SELECT COUNT(*) FROM %s' % table).fetchone()[0]
+
+
+def test_prune_cascades(history):
+    now = time.time()
+    history.record(make_metrics(now - 10 * SECONDS_PER_DAY, {'dump.sh': 3.0}), {'dump': 100})
+    history.record(make_metrics(now, {'dump.sh': 3.0}), {'dump': 200})
+
+    assert history.prune(5) == 1
+    assert len(history.last_runs(10)) == 1
+    for table in ('hooks', 'scripts', 'artifacts'):
+        assert count_rows(history, table) == 1
+    assert history.prune(5) == 0
+
+
+def test_record_prunes_with_retention(history):
+    now = time.time()
+    history.record(make_metrics(now - 10 * SECONDS_PER_DAY, {'dump.sh': 3.0}))
+    history.record(make_metrics(now, {'dump.sh': 3.0}), retention_days=5)
+    assert len(history.last_runs(10)) == 1
+    assert count_rows(history, 'scripts') == 1
+
+
+def test_percentile():
+    values = [1, 2, 3, 4, 5, 6, 7, 8, 9, 10]
+    assert percentile(values, 0.5) == 5
+    assert percentile(values, 0.95) == 10
+    assert percentile(values, 0.0) == 1
+    assert percentile(values, 1.0) == 10
+    assert percentile([7], 0.95) == 7
+
+
+def test_slope_per_day():
+    assert slope_per_day([(0, 1.0), (SECONDS_PER_DAY, 3.0), (2 * SECONDS_PER_DAY, 5.0)]) == pytest.approx(2.0)
+    assert slope_per_day([(0, 5.0), (SECONDS_PER_DAY, 4.0)]) == pytest.approx(-1.0)
+    assert slope_per_day([(0, 1.0)]) == 0.0
+    assert slope_per_day([]) == 0.0
+    assert slope_per_day([(10, 1.0), (10, 3.0)]) == 0.0
+
+
+def test_script_percentiles_and_growth(history):
+    now = time.time()
+    for day in range(3):
+        started = now - (2 - day) * SECONDS_PER_DAY
+        history.record(make_metrics(started, {'dump.sh': 1.0 + day, 'upload.sh': 2.0}), {'dump': 100 + 200 * day})
+
+    assert history.script_percentiles(30) == [
+        ('backup', 'dump.sh', 3, 2.0, 3.0),
+        ('backup', 'upload.sh', 3, 2.0, 2.0),
+    ]
+    growth = history.growth(30)
+    assert [row[:3] for row in growth] == [('size', 'dump', 3), ('duration', 'backup/dump.sh', 3),
+                                          ('duration', 'backup/upload.sh', 3)]
+    assert growth[0][3:] == (100, pytest.approx(200.0))
+    assert growth[1][3:] == (1.0, pytest.approx(1.0))
+    assert growth[2][4] == pytest.approx(0.0)
+
+
+def run_history(*arguments, env=None):
+    return entry_point('sidefridge.history', 'main', list(arguments), env=env)
+
+
+@pytest.fixture
+def database(tmp_path):
+    path = str(tmp_path / 'history.db')
+    history = RunHistory(path)
+    now = time.time()
+    history.record(make_metrics(now - SECONDS_PER_DAY, {'dump.sh': 1.0}), {'dump': 100})
+    history.record(make_metrics(now, {'dump.sh': 3.0}, success=False, exit_code=1), {'dump': 500})
+    history.record(make_metrics(now - 200 * SECONDS_PER_DAY, {'dump.sh': 1.0}))
+    history.close()
+    return path
+
+
+def test_cli_runs(database):
+    result = run_history('--db', database)
+    assert result.returncode == 0, result.stderr
+    lines = result.stdout.decode().splitlines()
+    assert lines[0].split() == ['run', 'started', 'duration', 'result', 'scripts', 'failed']
+    assert [line.split()[0] for line in lines[1:]] == ['2', '1', '3']
+    assert lines[1].split()[4:] == ['failed', '1', '1']
+    assert lines[2].split()[4:] == ['ok', '1', '0']
+
+    result = run_history('--db', database, 'runs', '-n', '1')
+    assert len(result.stdout.decode().splitlines()) == 2
+
+
+def test_cli_percentiles(database):
+    result = run_history('--db', database, 'percentiles', '--days', '30')
+    assert result.returncode == 0, result.stderr
+    lines = result.stdout.decode().splitlines()
+    assert lines[0].split() == ['script', 'runs', 'p50', 'p95']
+    assert lines[1:] == ['%-40s %6d %8.1fs %8.1fs' % ('backup/dump.sh', 2, 1.0, 3.0)]
+
+
+def test_cli_growth(database):
+    result = run_history('--db', database, 'growth', '-n', '1')
+    assert result.returncode == 0, result.stderr
+    lines = result.stdout.decode().splitlines()
+    assert lines[0].split() == ['kind', 'name', 'samples', 'first', 'per', 'day']
+    assert len(lines) == 2
+    assert lines[1].split()[:4] == ['size', 'dump', '2', '100.0']
+    assert float(lines[1].split()[4]) == pytest.approx(400.0, rel=1e-3)
+
+
+def test_cli_prune(database):
+    result = run_history('--db', database, 'prune', '--days', '90')
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.decode() == 'removed 1 run(s)\n'
+
+    result = run_history('--db', database, 'prune', env=dict(os.environ, RUN_HISTORY_RETENTION_DAYS='0'))
+    assert result.stdout.decode() == 'removed 2 run(s)\n'
+
+    connection = sqlite3.connect(database)
+    assert connection.execute('SELECT COUNT(*) FROM scripts').fetchone()[0] == 0
+    connection.close()
+
+
+def test_cli_missing_database(tmp_path):
+    path = str(tmp_path / 'missing.db')
+    result = run_history('--db', path, 'runs')
+    assert result.returncode == 1
+    assert "No run history found at '%s'" % path in result.stderr.decode()
+    assert not os.path.exists(path)
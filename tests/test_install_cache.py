@@ -0,0 +1,152 @@
+import io
+import json
+import os
+import shutil
+import tarfile
+import warnings
+
+import pytest
+
+from sidefridge.install_cache import (
+    ARCHIVE_SUFFIX, INSTALL_CACHE_DIR, INSTALL_CACHE_PATHS, MARKER_SUFFIX, InstallCache, InstallCacheError,
+    get_install_cache, snapshot
+)
+from sidefridge.scripts import INSTALL_DEPENDENCIES, ScriptsDetector
+
+from tests.conftest import write_script
+
+
+@pytest.fixture
+def cache(tmp_path):
+    (tmp_path / 'cache').mkdir()
+    return InstallCache(str(tmp_path / 'cache'), [str(tmp_path / 'root')])
+
+
+@pytest.mark.parametrize('content', ['{"fingerprint": "abc", "creat', '[]', '{}', ''])
+def test_corrupt_marker_is_a_miss(cache, tmp_path, content, capsys):
+    (tmp_path / 'cache' / ('abc' + MARKER_SUFFIX)).write_text(content)
+    assert cache.restore('abc') is False
+    assert 'Ignoring the unreadable install cache marker' in capsys.readouterr().out
+
+
+def test_missing_marker_is_a_miss(cache):
+    assert cache.restore('abc') is False
+
+
+def write_entry(tmp_path, members):
+    with tarfile.open(str(tmp_path / 'cache' / ('abc' + ARCHIVE_SUFFIX)), 'w:gz') as archive:
+        for member in members:
+            archive.addfile(member, io.BytesIO(b'x' * member.size) if member.isfile() else None)
+    (tmp_path / 'cache' / ('abc' + MARKER_SUFFIX)).write_text(json.dumps(dict(paths=1, created='now', deleted=[])))
+
+
+def device(name):
+    member = tarfile.TarInfo(name)
+    member.type = tarfile.CHRTYPE
+    member.devmajor, member.devminor = 1, 3
+    return member
+
+
+@pytest.mark.parametrize('member', [
+    tarfile.TarInfo('/etc/evil'), tarfile.TarInfo('usr/../../etc/evil'), device('usr/null')
+], ids=['absolute', 'parent', 'device'])
+def test_unexpected_entries_are_refused(cache, tmp_path, member):
+    write_entry(tmp_path, [member])
+    with pytest.raises(InstallCacheError, match="Unexpected entry"):
+        cache.restore('abc')
+
+
+def make_image(root):
+    """ What the base image has under a cached path before the install scripts run """
+    if root.exists():
+        shutil.rmtree(str(root))
+    (root / 'usr' / 'bin').mkdir(parents=True)
+    (root / 'usr' / 'bin' / 'tool').write_text('tool 1\n')
+    (root / 'etc').mkdir()
+    (root / 'etc' / 'old.conf').write_text('old\n')
+    (root / 'opt' / 'legacy').mkdir(parents=True)
+    (root / 'opt' / 'legacy' / 'data').write_text('legacy\n')
+
+
+def install(root):
+    """ What an install script does """
+    (root / 'usr' / 'bin' / 'tool').write_text('tool 2\n')
+    (root / 'usr' / 'bin' / 'new').write_text('#!/bin/sh\n')
+    os.chmod(str(root / 'usr' / 'bin' / 'new'), 0o4755)
+    os.symlink(str(root / 'usr' / 'bin' / 'tool'), str(root / 'usr' / 'bin' / 'tool-link'))
+    (root / 'etc' / 'old.conf').unlink()
+    shutil.rmtree(str(root / 'opt' / 'legacy'))
+
+
+def tree(root):
+    result = {}
+    for directory, directories, files in os.walk(str(root)):
+        for name in directories + files:
+            path = os.path.join(directory, name)
+            relative = os.path.relpath(path, str(root))
+            if os.path.islink(path):
+                result[relative] = 'link to %s' % os.readlink(path)
+            elif os.path.isdir(path):
+                result[relative] = 'directory'
+            else:
+                with open(path) as f:
+                    result[relative] = (oct(os.stat(path).st_mode), f.read())
+    return result
+
+
+def test_save_and_restore_round_trip(cache, tmp_path):
+    root = tmp_path / 'root'
+    make_image(root)
+    before = snapshot(cache.paths)
+    install(root)
+    cache.save('abc', before)
+    installed = tree(root)
+
+    # a new container of the same image
+    make_image(root)
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        assert cache.restore('abc') is True
+    assert tree(root) == installed
+    assert 'etc/old.conf' not in installed and 'opt/legacy' not in installed
+
+    marker = json.loads((tmp_path / 'cache' / ('abc' + MARKER_SUFFIX)).read_text())
+    assert marker['deleted'] == [str(root / 'etc' / 'old.conf'), str(root / 'opt' / 'legacy')]
+
+
+def test_fingerprint_follows_scripts_and_settings(tmp_path, monkeypatch):
+    scripts_path = tmp_path / 'scripts'
+    (scripts_path / INSTALL_DEPENDENCIES).mkdir(parents=True)
+    script = write_script(scripts_path / INSTALL_DEPENDENCIES / '10_apk.sh', '#!/bin/sh\napk add curl\n')
+    (tmp_path / 'cache').mkdir()
+    monkeypatch.setenv(INSTALL_CACHE_DIR, str(tmp_path / 'cache'))
+    monkeypatch.delenv(INSTALL_CACHE_PATHS, raising=False)
+
+    def fingerprint():
+        detector = ScriptsDetector(str(scripts_path))
+        return get_install_cache().fingerprint(detector, detector.install_dependencies)
+
+    first = fingerprint()
+    assert fingerprint() == first
+
+    write_script(script, '#!/bin/sh\napk add curl jq\n')
+    changed_script = fingerprint()
+    assert changed_script != first
+
+    monkeypatch.setenv(INSTALL_CACHE_PATHS, '/usr /opt')
+    assert fingerprint() not in (first, changed_script)
+
+    monkeypatch.setenv(INSTALL_CACHE_DIR, str(tmp_path / 'missing'))
+    with pytest.raises(InstallCacheError, match='not a directory'):
+        get_install_cache()
+
+
+def test_save_replaces_older_entries(cache, tmp_path):
+    root = tmp_path / 'root'
+    make_image(root)
+    cache.save('old', snapshot(cache.paths))
+    before = snapshot(cache.paths)
+    install(root)
+    cache.save('new', before)
+    assert sorted(os.listdir(str(tmp_path / 'cache'))) == ['new' + MARKER_SUFFIX, 'new' + ARCHIVE_SUFFIX]
+    assert cache.restore('old') is False
@@ -0,0 +1,104 @@
+import json
+import os
+import threading
+import time
+
+import pytest
+
+from sidefridge import leases
+from sidefridge.coordination import InvalidCoordinationSettings
+from sidefridge.leases import LEASE_FILE, RUN_LEASE_DIR, RUN_LEASE_SLOTS, LeasePool, get_lease_pool
+
+
+@pytest.fixture(autouse=True)
+def fast_polling(monkeypatch):
+    monkeypatch.setattr(leases, 'POLL_SECONDS', 0.05)
+
+
+def pool(tmp_path, holder, slots=1, ttl=60, wait_seconds=0):
+    return LeasePool(str(tmp_path), slots, holder, ttl, wait_seconds)
+
+
+def write_lease(tmp_path, slot, holder, expires):
+    with open(str(tmp_path / (LEASE_FILE % slot)), 'w') as f:
+        json.dump(dict(holder=holder, token=holder, expires=expires), f)
+
+
+def test_slots_are_enforced(tmp_path):
+    first, second, third = (pool(tmp_path, 'pod-%d' % index, slots=2) for index in range(3))
+    assert first.acquire()
+    assert second.acquire()
+    assert not third.acquire()
+
+    first.release()
+    assert third.acquire()
+    assert {second.slot, third.slot} == {0, 1}
+    second.release()
+    third.release()
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_concurrent_runs_never_exceed_the_slots(tmp_path):
+    running = []
+    peak = []
+    lock = threading.Lock()
+
+    def run(index):
+        lease_pool = pool(tmp_path, 'pod-%d' % index, slots=2, wait_seconds=30)
+        with lease_pool.hold() as acquired:
+            assert acquired
+            with lock:
+                running.append(index)
+                peak.append(len(running))
+            time.sleep(0.1)
+            with lock:
+                running.remove(index)
+
+    threads = [threading.Thread(target=run, args=(index,)) for index in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(peak) == 6
+    assert max(peak) == 2
+
+
+def test_expired_lease_is_taken_over(tmp_path, capsys):
+    write_lease(tmp_path, 0, 'dead-pod', time.time() - 1)
+    lease_pool = pool(tmp_path, 'pod-1')
+    assert lease_pool.acquire()
+    with open(str(tmp_path / (LEASE_FILE % 0))) as f:
+        assert json.load(f)['token'] == lease_pool.token
+    assert 'Taking over run lease 0, dead-pod did not renew it' in capsys.readouterr().out
+    lease_pool.release()
+
+
+def test_live_lease_is_not_taken_over(tmp_path):
+    write_lease(tmp_path, 0, 'live-pod', time.time() + 60)
+    assert not pool(tmp_path, 'pod-1').acquire()
+
+
+def test_held_lease_is_renewed(tmp_path):
+    holder = pool(tmp_path, 'pod-1', ttl=0.3)
+    assert holder.acquire()
+    # renewed every ttl / 3, the lease stays valid long after its first ttl
+    time.sleep(0.6)
+    assert not pool(tmp_path, 'pod-2').acquire()
+    holder.release()
+
+    other = pool(tmp_path, 'pod-2')
+    assert other.acquire()
+    other.release()
+
+
+def test_lease_settings(tmp_path, monkeypatch):
+    monkeypatch.delenv(RUN_LEASE_DIR, raising=False)
+    assert get_lease_pool() is None
+
+    monkeypatch.setenv(RUN_LEASE_DIR, str(tmp_path))
+    monkeypatch.setenv(RUN_LEASE_SLOTS, '3')
+    assert get_lease_pool().slots == 3
+
+    monkeypatch.setenv(RUN_LEASE_SLOTS, '0')
+    with pytest.raises(InvalidCoordinationSettings, match=RUN_LEASE_SLOTS):
+        get_lease_pool()
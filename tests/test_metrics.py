@@ -0,0 +1,142 @@
+import json
+import os
+import signal
+import subprocess
+import sys
+from types import SimpleNamespace
+
+from sidefridge.metrics import METRICS_JSON_PATH, METRICS_TEXTFILE_PATH, RunMetrics, wait_with_usage
+
+
+def test_wait_with_usage_reports_exit_code_and_usage():
+    # 64 MiB kept alive while burning cpu
+    process = subprocess.Popen([sys.executable, '-c', (
+        'import sys, time\n'
+        'data = bytearray(64 * 1024 * 1024)\n'
+        'end = time.process_time() + 0.2\n'
+        'while time.process_time() < end: pass\n'
+        'sys.exit(3)\n'
+    )])
+    returncode, usage = wait_with_usage(process)
+    assert returncode == 3
+    assert process.returncode == 3
+    assert usage.ru_utime + usage.ru_stime >= 0.2
+    # ru_maxrss is in kilobytes
+    assert usage.ru_maxrss * 1024 >= 64 * 1024 * 1024
+
+
+def test_wait_with_usage_reports_signals():
+    process = subprocess.Popen(['sleep', '10'])
+    process.send_signal(signal.SIGTERM)
+    returncode, _ = wait_with_usage(process)
+    assert returncode == process.returncode == -signal.SIGTERM
+
+
+def test_wait_with_usage_prefers_the_process_report():
+    usage = SimpleNamespace(ru_utime=1.0)
+    process = SimpleNamespace(pid=-1, wait_with_usage=lambda: (5, usage))
+    assert wait_with_usage(process) == (5, usage)
+
+
+def make_metrics():
+    metrics = RunMetrics()
+    hook = metrics.hook('backups')
+    hook.record('/scripts/backups/10_dump.sh', 0, 2.5, SimpleNamespace(ru_utime=1.5, ru_stime=0.5, ru_maxrss=2048),
+                100, 0)
+    hook.record('/scripts/backups/20_"odd".sh', 1, 0.5, SimpleNamespace(ru_utime=0.25, ru_stime=0.25, ru_maxrss=1024),
+                10, 20)
+    metrics.finish(False)
+    metrics.started = 1700000000.0
+    metrics.wall_seconds = 3.0
+    metrics.hooks[0].wall_seconds = 2.75
+    return metrics
+
+
+def test_json_lines():
+    lines = [json.loads(line) for line in make_metrics().json_lines().splitlines()]
+    assert [line['type'] for line in lines] == ['script', 'script', 'hook', 'run']
+    assert len({line['run_started'] for line in lines}) == 1
+
+    assert lines[0] == dict(
+        type='script', run_started=lines[0]['run_started'], hook='backups', script='10_dump.sh', exit_code=0,
+        wall_seconds=2.5, user_cpu_seconds=1.5, system_cpu_seconds=0.5, max_rss_bytes=2048 * 1024,
+        stdout_bytes=100, stderr_bytes=0,
+    )
+    hook = lines[2]
+    assert hook['hook'] == 'backups'
+    assert (hook['scripts'], hook['failed_scripts'], hook['wall_seconds']) == (2, 1, 2.75)
+    assert (hook['user_cpu_seconds'], hook['stdout_bytes'], hook['stderr_bytes']) == (1.75, 110, 20)
+    # peak memory is the largest of the scripts, not a sum
+    assert hook['max_rss_bytes'] == 2048 * 1024
+    assert lines[3]['success'] is False and lines[3]['wall_seconds'] == 3.0
+
+
+def test_prometheus_text():
+    text = make_metrics().prometheus_text()
+    assert text.endswith('\n')
+    lines = text.splitlines()
+
+    samples = [line for line in lines if not line.startswith('#')]
+    assert 'sidefridge_script_duration_seconds{hook="backups",script="10_dump.sh"} 2.5' in samples
+    assert 'sidefridge_script_exit_code{hook="backups",script="20_\\"odd\\".sh"} 1' in samples
+    assert 'sidefridge_hook_max_rss_bytes{hook="backups"} %d' % (2048 * 1024) in samples
+    assert 'sidefridge_run_duration_seconds 3.0' in samples
+    assert 'sidefridge_run_success 0' in samples
+    assert 'sidefridge_run_timestamp_seconds 1700000000.000' in samples
+
+    # every metric is announced once, before its samples
+    names = [line.split()[2] for line in lines if line.startswith('# TYPE')]
+    assert len(names) == len(set(names))
+    for name in names:
+        assert '# HELP %s ' % name in text
+        assert lines.index('# TYPE %s gauge' % name) < min(
+            index for index, line in enumerate(lines) if line.startswith((name + '{', name + ' '))
+        )
+
+
+def test_publish_appends_json_and_replaces_the_textfile(tmp_path, monkeypatch):
+    json_path = str(tmp_path / 'metrics.jsonl')
+    textfile_path = str(tmp_path / 'sidefridge.prom')
+    monkeypatch.setenv(METRICS_JSON_PATH, json_path)
+    monkeypatch.setenv(METRICS_TEXTFILE_PATH, textfile_path)
+    with open(textfile_path, 'w') as f:
+        f.write('old\n')
+
+    replaced = []
+    original_replace = os.replace
+
+    def replace(source, destination):
+        # the textfile still has its old content until the complete new one is renamed over it
+        with open(destination) as f:
+            assert f.read() == 'old\n'
+        assert os.path.dirname(source) == os.path.dirname(destination)
+        replaced.append(destination)
+        original_replace(source, destination)
+
+    monkeypatch.setattr(os, 'replace', replace)
+    metrics = make_metrics()
+    metrics.publish()
+    assert replaced == [textfile_path]
+    with open(textfile_path) as f:
+        assert f.read() == metrics.prometheus_text()
+    assert sorted(os.listdir(str(tmp_path))) == ['metrics.jsonl', 'sidefridge.prom']
+
+    monkeypatch.setattr(os, 'replace', original_replace)
+    metrics.publish()
+    with open(json_path) as f:
+        assert f.read() == metrics.json_lines() * 2
+
+
+def test_publish_never_fails_the_run(tmp_path, monkeypatch, capsys):
+    monkeypatch.setenv(METRICS_TEXTFILE_PATH, str(tmp_path / 'missing' / 'sidefridge.prom'))
+    monkeypatch.delenv(METRICS_JSON_PATH, raising=False)
+    make_metrics().publish()
+    assert 'Could not write metrics' in capsys.readouterr().out
+
+
+def test_publish_without_destination_writes_nothing(tmp_path, monkeypatch):
+    monkeypatch.delenv(METRICS_JSON_PATH, raising=False)
+    monkeypatch.delenv(METRICS_TEXTFILE_PATH, raising=False)
+    monkeypatch.chdir(str(tmp_path))
+    make_metrics().publish()
+    assert os.listdir(str(tmp_path)) == []
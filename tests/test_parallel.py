@@ -0,0 +1,61 @@
+import time
+
+import pytest
+
+from sidefridge import main as runner
+from sidefridge.parallel import FAILURE_POLICY_CANCEL, FAILURE_POLICY_WAIT, group_scripts, run_scripts_concurrently
+
+from tests.conftest import write_script
+
+
+def test_groups_run_in_numeric_order():
+    scripts = sorted(['/s/10_b.sh', '/s/9_a.sh', '/s/1_a.sh', '/s/01_b.sh', '/s/zz.sh', '/s/2-c.sh', '/s/2.d.sh'])
+    assert group_scripts(scripts) == [
+        ['/s/01_b.sh', '/s/1_a.sh'],
+        ['/s/2-c.sh', '/s/2.d.sh'],
+        ['/s/9_a.sh'],
+        ['/s/10_b.sh'],
+        ['/s/zz.sh'],
+    ]
+
+
+def test_scripts_without_prefix_form_one_group():
+    assert group_scripts(['/s/a.sh', '/s/b.sh']) == [['/s/a.sh', '/s/b.sh']]
+    assert group_scripts([]) == []
+
+
+def make_scripts(tmp_path, slow_seconds):
+    marker = tmp_path / 'marker'
+    scripts = [
+        write_script(tmp_path / '10_fail.sh', '#!/bin/sh\nsleep 0.2\nexit 3\n'),
+        write_script(tmp_path / '10_slow.sh', '#!/bin/sh\nsleep %s\necho slow >> %s\n' % (slow_seconds, marker)),
+        write_script(tmp_path / '20_later.sh', '#!/bin/sh\necho later >> %s\n' % marker),
+    ]
+    return scripts, marker
+
+
+def test_cancel_policy_terminates_running_scripts(tmp_path):
+    scripts, marker = make_scripts(tmp_path, 30)
+    started = time.monotonic()
+    with pytest.raises(runner.SubprocessErrorDuringExecutionException, match='10_fail.sh'):
+        run_scripts_concurrently(scripts, runner.run_single_script, 4, FAILURE_POLICY_CANCEL)
+    assert time.monotonic() - started < 10
+    assert not marker.exists()
+
+
+def test_wait_policy_lets_running_scripts_finish(tmp_path):
+    scripts, marker = make_scripts(tmp_path, 1)
+    with pytest.raises(runner.SubprocessErrorDuringExecutionException, match='10_fail.sh'):
+        run_scripts_concurrently(scripts, runner.run_single_script, 4, FAILURE_POLICY_WAIT)
+    # the next group is not started
+    assert marker.read_text() == 'slow\n'
+
+
+def test_groups_wait_for_each_other(tmp_path):
+    log = tmp_path / 'log'
+    scripts = [
+        write_script(tmp_path / ('%s.sh' % name), '#!/bin/sh\nsleep %s\necho %s >> %s\n' % (delay, name, log))
+        for name, delay in (('10_a', 0.5), ('10_b', 0.1), ('9_c', 0.3))
+    ]
+    run_scripts_concurrently(sorted(scripts), runner.run_single_script, 4, FAILURE_POLICY_CANCEL)
+    assert log.read_text().split() == ['9_c', '10_b', '10_a']
@@ -0,0 +1,44 @@
+import gzip
+import hashlib
+
+import pytest
+
+from tests.conftest import entry_point
+
+DATA = b''.join(b'line %d of the dump\n' % index for index in range(50000))
+
+
+def pipe(arguments, data=DATA):
+    return entry_point('sidefridge.pipeline', 'main', arguments, input=data)
+
+
+@pytest.mark.parametrize('arguments', [
+    ['-l', '15'],
+    ['-l', '0'],
+    ['-c', 'zstd', '-l', '23'],
+    ['-c', 'none', '-l', '1'],
+    ['-l', 'fast'],
+])
+def test_invalid_levels_are_usage_errors(arguments):
+    result = pipe(arguments)
+    assert result.returncode == 2
+    assert b'usage: fridge pipe' in result.stderr
+    assert b'Traceback' not in result.stderr
+
+
+def test_gzip_round_trip(tmp_path):
+    result = pipe(['-l', '9', '-b', '64K', '-o', str(tmp_path), '-s', '100K'])
+    assert result.returncode == 0, result.stderr
+
+    parts = sorted(path for path in tmp_path.iterdir() if '.part' in path.name)
+    assert len(parts) > 1
+    assert gzip.decompress(b''.join(part.read_bytes() for part in parts)) == DATA
+
+    checksums = (tmp_path / 'backup.gz.sha256').read_text().splitlines()
+    assert checksums == ['%s  %s' % (hashlib.sha256(part.read_bytes()).hexdigest(), part.name) for part in parts]
+
+
+def test_stream_to_stdout():
+    result = pipe(['-b', '64K', '-t', '4'])
+    assert result.returncode == 0, result.stderr
+    assert gzip.decompress(result.stdout) == DATA
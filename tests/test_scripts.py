@@ -0,0 +1,47 @@
+import ctypes
+import ctypes.util
+
+from sidefridge.scripts import BACKUPS, InotifyWatcher, PollingWatcher, ScriptsDetector
+
+from tests.conftest import write_script
+
+
+def make_scripts_dir(tmp_path):
+    (tmp_path / BACKUPS).mkdir()
+    write_script(tmp_path / BACKUPS / '10_dump.sh', '#!/bin/sh\nexit 0\n')
+    return str(tmp_path)
+
+
+def test_inotify_on_musl(tmp_path, monkeypatch):
+    # musl has no ldconfig cache for find_library and no libc.so.6, only the symbols of the process are found
+    cdll = ctypes.CDLL
+
+    def musl_cdll(name, *args, **kwargs):
+        if name is not None:
+            raise OSError("%s: cannot open shared object file" % name)
+        return cdll(name, *args, **kwargs)
+
+    monkeypatch.setattr(ctypes.util, 'find_library', lambda name: None)
+    monkeypatch.setattr(ctypes, 'CDLL', musl_cdll)
+    detector = ScriptsDetector(make_scripts_dir(tmp_path))
+    detector.watch()
+    assert isinstance(detector._watcher, InotifyWatcher)
+
+    write_script(tmp_path / BACKUPS / '20_files.sh', '#!/bin/sh\nexit 0\n')
+    assert detector.refresh() == {BACKUPS}
+    assert [script.rsplit('/', 1)[1] for script in detector.backups] == ['10_dump.sh', '20_files.sh']
+    assert detector.refresh() == set()
+
+
+def test_polling_fallback_logs_a_warning(tmp_path, monkeypatch, capsys):
+    def missing_library(*args, **kwargs):
+        raise OSError("no C library")
+
+    monkeypatch.setattr(ctypes, 'CDLL', missing_library)
+    detector = ScriptsDetector(make_scripts_dir(tmp_path))
+    detector.watch()
+    assert isinstance(detector._watcher, PollingWatcher)
+    assert 'WARNING: inotify is not available (no C library)' in capsys.readouterr().out
+
+    write_script(tmp_path / BACKUPS / '20_files.sh', '#!/bin/sh\nexit 0\n')
+    assert detector.refresh() == {BACKUPS}
@@ -0,0 +1,78 @@
+"""
+Cold start of the entry points scripts start in loops, benchmarks/startup.py prints a detailed report.
+STARTUP_BUDGET_MS overrides the budget on slow machines.
+"""
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+import pytest
+
+from tests.conftest import ROOT, entry_point
+
+STARTUP_BUDGET_MS = "STARTUP_BUDGET_MS"
+
+# milliseconds an entry point may take on top of starting the interpreter
+DEFAULT_BUDGET_MS = 30
+RUNS = 7
+
+# runs an entry point, then prints the modules it loaded
+LIST_MODULES = '''import sys
+from {module} import {function}
+try:
+    {function}()
+except SystemExit:
+    pass
+import json
+sys.stderr.write(json.dumps(sorted(sys.modules)))
+'''
+
+RUNNER_MODULES = {
+    'croniter', 'socketserver', 'sqlite3', 'concurrent.futures', 'subprocess', 'sidefridge.store_server',
+    'sidefridge.coordination', 'sidefridge.throttling', 'sidefridge.supervision', 'sidefridge.checkpoint',
+    'sidefridge.warm', 'sidefridge.metrics', 'sidefridge.history', 'sidefridge.exec_session', 'sidefridge.scripts',
+}
+
+ENTRY_POINTS = [
+    ('sidefridge.storage', 'store_var', ['key', 'value'], {'uuid', 'argparse', 'shlex', 'sidefridge.main'}),
+    ('sidefridge.storage', 'load_var', ['key'], {'uuid', 'argparse', 'shlex', 'sidefridge.main'}),
+    ('sidefridge.main', 'main', ['--help'], RUNNER_MODULES),
+]
+
+
+def imported_modules(module, function, arguments):
+    """ Modules loaded once the entry point returned """
+    result = subprocess.run(
+        [sys.executable, '-c', LIST_MODULES.format(module=module, function=function)] + arguments,
+        env=dict(os.environ, PYTHONPATH=ROOT), stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+        universal_newlines=True
+    )
+    return set(json.loads(result.stderr.splitlines()[-1]))
+
+
+def median_ms(module, function, arguments):
+    timings = []
+    for _ in range(RUNS):
+        start = time.perf_counter()
+        result = entry_point(module, function, arguments)
+        timings.append((time.perf_counter() - start) * 1000)
+        assert result.returncode == 0, result.stderr
+    return statistics.median(timings)
+
+
+@pytest.mark.parametrize('module,function,arguments,forbidden', ENTRY_POINTS)
+def test_entry_points_import_only_what_they_use(store_server, module, function, arguments, forbidden):
+    assert imported_modules(module, function, arguments) & forbidden == set()
+
+
+@pytest.mark.parametrize('module,function,arguments,forbidden', ENTRY_POINTS)
+def test_cold_start_within_budget(store_server, module, function, arguments, forbidden):
+    budget = float(os.environ.get(STARTUP_BUDGET_MS) or DEFAULT_BUDGET_MS)
+    baseline = median_ms('builtins', 'print', [])
+    elapsed = median_ms(module, function, arguments)
+    assert elapsed - baseline <= budget, "%s %s took %.1f ms over the interpreter start, budget %.0f ms" % (
+        function, ' '.join(arguments), elapsed - baseline, budget
+    )
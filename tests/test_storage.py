@@ -0,0 +1,249 @@
+import json
+import multiprocessing
+import os
+import socket
+import subprocess
+import sys
+import threading
+
+import pytest
+
+from sidefridge import storage
+from sidefridge.storage import (
+    LOAD_VAR_OPTIONS, STORE_SOCKET, STORE_VAR_OPTIONS, LogStore, StoreClient, StorageError, build_load_var_parser,
+    build_store_var_parser, clear_storage, get_store, load_value, load_values, parse_arguments, store_value
+)
+
+from tests.conftest import ROOT, WRAPPER, entry_point
+
+
+def parse_load_var(argv):
+    return parse_arguments(
+        argv, LOAD_VAR_OPTIONS, (('key', None), ('default', '')), ('export', 'null'), build_load_var_parser
+    )
+
+
+def parse_store_var(argv):
+    return parse_arguments(
+        argv, STORE_VAR_OPTIONS, (('key', None), ('value', None)), ('append', 'incr', 'delete', 'stdin'),
+        build_store_var_parser
+    )
+
+
+def test_short_null_flag_is_not_a_negative_number():
+    arguments = parse_load_var(['-0'])
+    assert arguments.null is True
+    assert arguments.key is None
+
+    arguments = parse_store_var(['--stdin', '-0'])
+    assert arguments.stdin is True
+    assert arguments.null is True
+    assert arguments.key is None
+
+
+def test_negative_numbers_are_positionals():
+    arguments = parse_store_var(['--incr', 'counter', '-5'])
+    assert arguments.incr is True
+    assert (arguments.key, arguments.value) == ('counter', '-5')
+
+    arguments = parse_store_var(['--', '-0', 'zero'])
+    assert (arguments.key, arguments.value, arguments.null) == ('-0', 'zero', False)
+
+
+def test_null_separated_round_trip(store_server):
+    result = entry_point('sidefridge.storage', 'store_var', ['--stdin', '-0'], input=b'a\0one\0b\0two\nlines\0')
+    assert result.returncode == 0, result.stderr
+
+    result = entry_point('sidefridge.storage', 'load_var', ['-0'])
+    assert result.returncode == 0, result.stderr
+    assert result.stdout == b'a\0one\0b\0two\nlines\0'
+
+
+def run_threads(count, target):
+    barrier = threading.Barrier(count)
+
+    def call():
+        barrier.wait()
+        target()
+
+    threads = [threading.Thread(target=call) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def test_concurrent_writers_on_the_same_key(store_server):
+    def write():
+        client = StoreClient(store_server.socket_path)
+        try:
+            for index in range(100):
+                client.request('incr', key='counter')
+                client.request('append', key='log', value='x')
+                client.request('set', key='last', value='value %d' % index)
+        finally:
+            client.close()
+
+    run_threads(8, write)
+    assert load_value('counter') == '800'
+    assert load_value('log') == 'x' * 800
+    assert load_value('last') == 'value 99'
+
+
+def start_store_var(arguments):
+    return subprocess.Popen(
+        [sys.executable, '-c', WRAPPER.format(module='sidefridge.storage', function='store_var')] + arguments,
+        env=dict(os.environ, PYTHONPATH=ROOT), stdout=subprocess.PIPE
+    )
+
+
+def test_incr_and_append_from_concurrent_processes(store_server):
+    processes = [start_store_var(['--incr', 'n']) for _ in range(10)]
+    processes += [start_store_var(['--append', 'names', 'p%d,' % index]) for index in range(10)]
+    outputs = [process.communicate()[0] for process in processes]
+    assert [process.returncode for process in processes] == [0] * 20
+
+    # every increment saw a different value
+    assert sorted(int(output) for output in outputs[:10]) == list(range(1, 11))
+    assert sorted(load_value('names').split(',')[:-1]) == sorted('p%d' % index for index in range(10))
+
+
+def test_server_errors_are_reported(store_server):
+    store_value('text', 'abc')
+    client = StoreClient(store_server.socket_path)
+    try:
+        with pytest.raises(StorageError, match="'text' is not an integer"):
+            client.request('incr', key='text')
+        # the connection is still usable after an error
+        assert client.request('get', key='text') == 'abc'
+    finally:
+        client.close()
+
+
+@pytest.mark.parametrize('request_line, error', [
+    (b'[]', 'A request must be a JSON object, got list'),
+    (b'"get"', 'A request must be a JSON object, got str'),
+    (b'{"op": "get", "key": ["a"]}', 'unhashable'),
+    (b'not json', 'Expecting value'),
+])
+def test_server_answers_malformed_requests(store_server, request_line, error):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.connect(store_server.socket_path)
+        stream = connection.makefile('rwb')
+        for line in (request_line, b'{"op": "set", "key": "k", "value": "v"}'):
+            stream.write(line + b'\n')
+            stream.flush()
+        response = json.loads(stream.readline())
+        assert response['ok'] is False and error in response['error']
+        # the handler keeps serving the connection
+        assert json.loads(stream.readline()) == dict(ok=True, value='v')
+        stream.close()
+
+
+@pytest.fixture
+def file_storage(tmp_path, monkeypatch):
+    """ No storage server, values go to the file store recorded in a private TMP_STORE """
+    monkeypatch.setattr(storage, 'TMP_STORE', str(tmp_path / 'storage_path'))
+    monkeypatch.setenv(STORE_SOCKET, str(tmp_path / 'missing.sock'))
+    yield
+    clear_storage()
+
+
+def test_fallback_to_the_file_store(file_storage):
+    store = get_store()
+    assert isinstance(store, LogStore)
+    store.close()
+
+    store_value('key', 'value')
+    assert load_value('key') == 'value'
+    assert load_value('missing', 'default') == 'default'
+
+    def increment():
+        for _ in range(50):
+            storage._request('incr', key='counter')
+
+    run_threads(4, increment)
+    assert load_values() == {'key': 'value', 'counter': '200'}
+
+
+def log_store(tmp_path, **kwargs):
+    return LogStore(str(tmp_path / 'store'), **kwargs)
+
+
+def read_records(tmp_path):
+    return [json.loads(line) for line in (tmp_path / 'store').read_bytes().splitlines()]
+
+
+def test_log_store_compaction(tmp_path):
+    store = log_store(tmp_path, compact_threshold=4096)
+    for index in range(200):
+        store.request('set', key='key %d' % (index % 3), value='value %d' % index)
+    inode = os.stat(str(tmp_path / 'store')).st_ino
+
+    # another process holding the log open sees the compacted one
+    reader = log_store(tmp_path)
+    assert reader.request('items') == {'key 0': 'value 198', 'key 1': 'value 199', 'key 2': 'value 197'}
+
+    assert len(read_records(tmp_path)) < 200
+    store.request('set', key='key 0', value='x' * 4096)
+    records = read_records(tmp_path)
+    assert sorted(record['k'] for record in records) == ['key 0', 'key 1', 'key 2']
+    assert os.stat(str(tmp_path / 'store')).st_ino != inode
+    assert reader.request('get', key='key 0') == 'x' * 4096
+    store.close()
+    reader.close()
+
+
+def increment_in_process(store_path):
+    store = LogStore(store_path)
+    try:
+        for _ in range(100):
+            store.request('incr', key='counter')
+    finally:
+        store.close()
+
+
+def test_log_store_locking_across_processes(tmp_path):
+    context = multiprocessing.get_context('fork')
+    processes = [context.Process(target=increment_in_process, args=(str(tmp_path / 'store'),)) for _ in range(4)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    assert [process.exitcode for process in processes] == [0] * 4
+
+    store = log_store(tmp_path)
+    assert store.request('get', key='counter') == '400'
+    store.close()
+
+
+def test_log_store_delete_tombstones(tmp_path):
+    store = log_store(tmp_path)
+    store.request('update', values={'a': '1', 'b': '2'})
+    assert store.request('delete', key='a') == '1'
+    assert read_records(tmp_path)[-1] == {'k': 'a', 'd': True}
+    store.close()
+
+    store = log_store(tmp_path)
+    assert store.request('items') == {'b': '2'}
+    assert store.request('get', key='a', default='gone') == 'gone'
+    store.close()
+
+
+def test_log_store_recovers_from_a_truncated_record(tmp_path):
+    store = log_store(tmp_path)
+    store.request('set', key='a', value='1')
+    store.close()
+    # a writer crashed in the middle of its record
+    with open(str(tmp_path / 'store'), 'ab') as f:
+        f.write(b'{"k": "b", "v": "tor')
+
+    store = log_store(tmp_path)
+    assert store.request('items') == {'a': '1'}
+    store.request('set', key='c', value='3')
+    store.close()
+
+    assert read_records(tmp_path) == [{'k': 'a', 'v': '1'}, {'k': 'c', 'v': '3'}]
+    store = log_store(tmp_path)
+    assert store.request('items') == {'a': '1', 'c': '3'}
+    store.close()
@@ -0,0 +1,92 @@
+import io
+import subprocess
+import threading
+import time
+
+from sidefridge.streaming import StreamRelay, relay_output
+from sidefridge.throttling import TokenBucket
+
+
+def relay(chunks, prefix=None):
+    target = io.StringIO()
+    stream_relay = StreamRelay(target, prefix)
+    for chunk in chunks:
+        stream_relay.feed(chunk)
+    stream_relay.close()
+    return target.getvalue(), stream_relay.bytes_read
+
+
+def test_multibyte_character_split_across_chunks():
+    data = 'caffè ☕\n'.encode('utf-8')
+    split = data.index('☕'.encode('utf-8')) + 1
+    assert relay([data[:split], data[split:split + 1], data[split + 1:]]) == ('caffè ☕\n', len(data))
+    # a sequence left incomplete when the stream ends is replaced
+    assert relay([b'abc\xe2\x98']) == ('abc�', 5)
+
+
+def test_prefix_of_partial_lines():
+    assert relay([b'hel', b'lo\nwor', b'ld\n'], prefix='[p] ')[0] == '[p] hello\n[p] world\n'
+    assert relay([b'one\n', b'\n', b'two'], prefix='[p] ')[0] == '[p] one\n[p] \n[p] two'
+    # a line is prefixed once, when its first character arrives
+    assert relay([b'a\n', b'', b'b', b'c'], prefix='[p] ')[0] == '[p] a\n[p] bc'
+    assert relay([b'a\nb'])[0] == 'a\nb'
+
+
+def run(command, **kwargs):
+    process = subprocess.Popen(['sh', '-c', command], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout, stderr = io.StringIO(), io.StringIO()
+    counts = relay_output(process, stdout=stdout, stderr=stderr, **kwargs)
+    process.wait()
+    return counts, stdout.getvalue(), stderr.getvalue()
+
+
+def test_relay_output_prefixes_both_streams():
+    counts, stdout, stderr = run("echo out; printf 'err\\nlast' >&2; printf 'no newline'", prefix='[10_dump.sh] ')
+    assert stdout == '[10_dump.sh] out\n[10_dump.sh] no newline'
+    assert stderr == '[10_dump.sh] err\n[10_dump.sh] last'
+    assert counts == (14, 8)
+
+
+class RecordingBucket(object):
+    def __init__(self):
+        self.consumed = []
+
+    def consume(self, amount):
+        self.consumed.append(amount)
+
+
+def test_relay_output_consumes_the_bandwidth():
+    bucket = RecordingBucket()
+    counts, stdout, _ = run('head -c 300000 /dev/zero; echo err >&2', bandwidth=bucket, chunk_size=4096)
+    assert counts == (300000, 4)
+    assert len(stdout) == 300000
+    assert sum(bucket.consumed) == 300004
+    assert max(bucket.consumed) <= 4096
+
+
+def test_relay_output_is_held_back_by_the_bandwidth():
+    # the bucket starts with one second worth of data, the rest waits for tokens
+    start = time.monotonic()
+    counts, _, _ = run('head -c 100000 /dev/zero', bandwidth=TokenBucket(50000))
+    assert counts == (100000, 0)
+    assert time.monotonic() - start >= 0.9
+
+
+def test_abandoned_relay_returns_while_the_pipes_are_open():
+    process = subprocess.Popen(['sh', '-c', 'echo before; exec sleep 30'], stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE)
+    abandon = threading.Event()
+    timer = threading.Timer(0.3, abandon.set)
+    timer.start()
+    stdout, stderr = io.StringIO(), io.StringIO()
+    try:
+        start = time.monotonic()
+        assert relay_output(process, stdout=stdout, stderr=stderr, abandon=abandon) == (7, 0)
+        assert time.monotonic() - start < 5
+        assert stdout.getvalue() == 'before\n'
+        assert process.stdout.closed and process.stderr.closed
+        assert process.poll() is None
+    finally:
+        timer.cancel()
+        process.kill()
+        process.wait()
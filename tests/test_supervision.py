@@ -0,0 +1,103 @@
+import time
+
+import pytest
+
+from sidefridge import main as runner
+from sidefridge.scripts import BACKUPS
+from sidefridge.supervision import (
+    HEADER_SIZE, HOOK_TIMEOUT_SECONDS, RETRY_BACKOFF_MAX_SECONDS, SCRIPT_RETRIES, SCRIPT_TIMEOUT_SECONDS,
+    TIMEOUT_GRACE_SECONDS, Supervisor, read_directives
+)
+
+from tests.conftest import write_script
+
+
+def is_running(pid):
+    """ Killed processes reparented to a PID 1 which does not reap them stay as zombies """
+    try:
+        with open('/proc/%d/stat' % pid) as f:
+            return f.read().rsplit(')', 1)[1].split()[0] != 'Z'
+    except FileNotFoundError:
+        return False
+
+
+def run(script):
+    runner.run_single_script(script, supervisor=Supervisor(BACKUPS))
+
+
+def test_script_timeout(tmp_path, capsys):
+    script = write_script(tmp_path / '10_slow.sh', '#!/bin/sh\n# fridge: timeout=1\nsleep 30\n')
+    started = time.monotonic()
+    with pytest.raises(runner.SubprocessErrorDuringExecutionException, match="'%s' timed out after 1s" % script):
+        run(script)
+    assert time.monotonic() - started < 5
+    assert 'SIGKILL' not in capsys.readouterr().out
+
+
+def test_sigterm_is_escalated_to_sigkill_on_the_process_group(tmp_path, monkeypatch, capsys):
+    monkeypatch.setenv(TIMEOUT_GRACE_SECONDS, '0.5')
+    pid_file = tmp_path / 'pids'
+    # the child inherits the ignored SIGTERM
+    script = write_script(tmp_path / '10_stubborn.sh', (
+        "#!/bin/sh\n# fridge: timeout=0.5\ntrap '' TERM\nsleep 30 &\necho $$ $! > %s\nwait\n" % pid_file
+    ))
+    started = time.monotonic()
+    with pytest.raises(runner.SubprocessErrorDuringExecutionException, match='timed out'):
+        run(script)
+    assert time.monotonic() - started < 5
+
+    output = capsys.readouterr().out
+    assert 'timed out after 0s, sending SIGTERM' in output
+    assert 'did not stop within 0s, sending SIGKILL' in output
+    assert not any(is_running(int(pid)) for pid in pid_file.read_text().split())
+
+
+def test_hook_timeout_stops_the_following_scripts(tmp_path, monkeypatch):
+    monkeypatch.setenv(HOOK_TIMEOUT_SECONDS, '1')
+    supervisor = Supervisor(BACKUPS)
+    runner.run_single_script(write_script(tmp_path / '10_a.sh', '#!/bin/sh\nsleep 2\n'), skip_error=True,
+                             supervisor=supervisor)
+    with pytest.raises(runner.SubprocessErrorDuringExecutionException, match="Hook 'backups' timed out before"):
+        runner.run_single_script(write_script(tmp_path / '20_b.sh', '#!/bin/sh\nexit 0\n'), supervisor=supervisor)
+
+
+def test_directives_override_the_environment(tmp_path, monkeypatch, capsys):
+    monkeypatch.setenv(SCRIPT_TIMEOUT_SECONDS, '60')
+    monkeypatch.setenv(SCRIPT_RETRIES, '1')
+    plain = write_script(tmp_path / 'plain.sh', '#!/bin/sh\n')
+    custom = write_script(tmp_path / 'custom.sh', '#!/bin/sh\n#fridge: timeout=600 retries=3 backoff=0.5 x=1 warm\n')
+    invalid = write_script(tmp_path / 'invalid.sh', '#!/bin/sh\n# fridge: timeout=soon retries=2\n')
+    late = write_script(tmp_path / 'late.sh', '#!/bin/sh\n' + '#\n' * HEADER_SIZE + '# fridge: timeout=1\n')
+
+    supervisor = Supervisor(BACKUPS)
+    assert supervisor.settings(plain) == (60, 1, 5)
+    assert supervisor.settings(custom) == (600, 3, 0.5)
+    assert read_directives(custom) == dict(timeout=600, retries=3, backoff=0.5, warm=True)
+    assert supervisor.settings(invalid) == (60, 2, 5)
+    assert "Ignoring invalid 'timeout=soon'" in capsys.readouterr().out
+    assert supervisor.settings(late) == (60, 1, 5)
+
+
+def test_failed_script_is_retried(tmp_path, capsys):
+    attempts = tmp_path / 'attempts'
+    script = write_script(tmp_path / '10_flaky.sh', (
+        '#!/bin/sh\n# fridge: retries=2 backoff=0.1\necho x >> %s\n[ $(wc -l < %s) -ge 2 ]\n' % (attempts, attempts)
+    ))
+    run(script)
+    assert attempts.read_text() == 'x\nx\n'
+    assert 'retry 1 of 2' in capsys.readouterr().out
+
+    attempts.unlink()
+    failing = write_script(tmp_path / '10_failing.sh', '#!/bin/sh\n# fridge: retries=2 backoff=0.1\nexit 3\n')
+    with pytest.raises(runner.SubprocessErrorDuringExecutionException, match="finished with exit code '3'"):
+        run(failing)
+    assert 'retry 2 of 2' in capsys.readouterr().out
+
+
+def test_backoff_bounds(monkeypatch):
+    monkeypatch.setenv(RETRY_BACKOFF_MAX_SECONDS, '8')
+    supervisor = Supervisor(BACKUPS)
+    for attempt in range(10):
+        delay = min(2 ** attempt, 8)
+        for _ in range(50):
+            assert delay / 2 <= supervisor.backoff_delay(1, attempt) <= delay
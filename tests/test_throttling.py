@@ -0,0 +1,207 @@
+import datetime
+import errno
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+from sidefridge import throttling
+from sidefridge.throttling import (
+    POLICY_SETTINGS, THROTTLE_CONFIG, THROTTLE_NICE, InvalidThrottleSettings, ThrottlePolicy, TokenBucket,
+    get_policy, load_policy, load_settings, parse_cpu_max, parse_io_max, prepare_cgroup
+)
+
+from tests.conftest import ROOT
+
+
+@pytest.fixture(autouse=True)
+def environment(monkeypatch):
+    """ Settings only come from the test """
+    for env_name in list(POLICY_SETTINGS.values()) + [THROTTLE_CONFIG]:
+        monkeypatch.delenv(env_name, raising=False)
+
+
+def write_config(tmp_path, config):
+    (tmp_path / 'throttling.json').write_text(json.dumps(config))
+    return str(tmp_path)
+
+
+@pytest.mark.parametrize('config, message', [
+    ([{'nice': 10}], 'must contain an object'),
+    ('nice', 'must contain an object'),
+    ({'default': [10]}, "Section 'default'"),
+    ({'backups': 'idle'}, "Section 'backups'"),
+    ({'backups': {'nice': 'low'}}, "Invalid throttling of 'backups'"),
+])
+def test_invalid_configurations(tmp_path, config, message):
+    with pytest.raises(InvalidThrottleSettings, match=message):
+        load_policy(write_config(tmp_path, config), 'backups')
+
+
+@pytest.mark.parametrize('value, expected', [
+    ('50%', '50000 100000'),
+    ('250%', '250000 100000'),
+    ('50000 100000', '50000 100000'),
+    ('50000', '50000'),
+    ('max', 'max'),
+    ('max 100000', 'max 100000'),
+])
+def test_parse_cpu_max(value, expected):
+    assert parse_cpu_max(value) == expected
+
+
+@pytest.mark.parametrize('value', ['', 'half', 'max max', '100000 max', '1 2 3', 'x%'])
+def test_parse_invalid_cpu_max(value):
+    with pytest.raises(InvalidThrottleSettings, match='invalid cpu_max'):
+        parse_cpu_max(value)
+
+
+@pytest.fixture
+def cgroup_root(tmp_path, monkeypatch):
+    """
+    A cgroup v2 namespace root holding the processes of the pod. Like the kernel, enabling controllers in a cgroup
+    with processes fails with EBUSY and writing a pid to cgroup.procs moves it.
+    """
+    root = tmp_path / 'cgroup'
+    root.mkdir()
+    (root / 'cgroup.controllers').write_text('cpu io memory pids\n')
+    (root / 'cgroup.procs').write_text('1\n42\n')
+    write = throttling._write
+
+    def fake_write(path, value):
+        directory, name = os.path.split(path)
+        procs = os.path.join(directory, 'cgroup.procs')
+        if name == 'cgroup.subtree_control' and os.path.exists(procs) and open(procs).read().strip():
+            raise OSError(errno.EBUSY, os.strerror(errno.EBUSY))
+        if name == 'cgroup.procs':
+            for cgroup in root.glob('**/cgroup.procs'):
+                cgroup.write_text(''.join('%s\n' % pid for pid in cgroup.read_text().split() if pid != value))
+            with open(path, 'a') as f:
+                f.write(value + '\n')
+            return
+        write(path, value)
+
+    monkeypatch.setattr(throttling, '_write', fake_write)
+    return root
+
+
+def test_runner_is_moved_out_of_the_root_cgroup(cgroup_root):
+    path = prepare_cgroup(str(cgroup_root), 'backups', '50000 100000', ['8:0 rbps=1048576'])
+    assert path == str(cgroup_root / 'sidefridge' / 'backups')
+    assert (cgroup_root / 'cgroup.procs').read_text() == ''
+    assert (cgroup_root / 'sidefridge' / 'runner' / 'cgroup.procs').read_text() == '1\n42\n'
+    assert (cgroup_root / 'cgroup.subtree_control').read_text() == '+cpu +io'
+    assert (cgroup_root / 'sidefridge' / 'cgroup.subtree_control').read_text() == '+cpu +io'
+    assert (cgroup_root / 'sidefridge' / 'backups' / 'cpu.max').read_text() == '50000 100000'
+    assert (cgroup_root / 'sidefridge' / 'backups' / 'io.max').read_text() == '8:0 rbps=1048576'
+
+    # once the runner left the root, other hooks only add their cgroup
+    assert prepare_cgroup(str(cgroup_root), 'after_backups', 'max', None).endswith('after_backups')
+
+
+def test_limits_which_cannot_be_applied_are_fatal(tmp_path, cgroup_root, monkeypatch):
+    with pytest.raises(InvalidThrottleSettings, match='cgroup v2 is not mounted'):
+        prepare_cgroup(str(tmp_path), 'backups', '50%', None)
+
+    def read_only(path, value):
+        raise OSError(errno.EROFS, os.strerror(errno.EROFS))
+
+    monkeypatch.setattr(throttling, '_write', read_only)
+    with pytest.raises(InvalidThrottleSettings, match='Read-only file system'):
+        prepare_cgroup(str(cgroup_root), 'backups', '50%', None)
+
+
+def test_parse_io_max():
+    assert parse_io_max('8:0 rbps=20971520 wbps=max; 8:16  riops=100 ;') == [
+        '8:0 rbps=20971520 wbps=max', '8:16 riops=100'
+    ]
+    for value in ('sda rbps=1', '8:0', '8:0 speed=1', '8:0 rbps=fast'):
+        with pytest.raises(InvalidThrottleSettings, match='invalid io_max'):
+            parse_io_max(value)
+
+
+def test_hook_section_overrides_default_and_environment(tmp_path, monkeypatch):
+    monkeypatch.setenv(THROTTLE_NICE, '5')
+    assert load_settings(str(tmp_path), 'backups') == {'nice': '5'}
+
+    scripts_path = write_config(tmp_path, {
+        'default': {'nice': 10, 'ionice': 'best-effort:7'},
+        'backups': {'ionice': 'idle', 'bandwidth': '20M'},
+    })
+    assert load_settings(scripts_path, 'backups') == {'nice': 10, 'ionice': 'idle', 'bandwidth': '20M'}
+    assert load_settings(scripts_path, 'after_backups') == {'nice': 10, 'ionice': 'best-effort:7'}
+
+    other = tmp_path / 'other.json'
+    other.write_text(json.dumps({'backups': {'nice': 19}}))
+    monkeypatch.setenv(THROTTLE_CONFIG, str(other))
+    assert load_settings(scripts_path, 'backups') == {'nice': 19}
+
+
+@pytest.mark.parametrize('hours, applying, not_applying', [
+    ('8-20', [8, 12, 19], [0, 7, 20, 23]),
+    ('22-6', [22, 23, 0, 5], [6, 12, 21]),
+])
+def test_active_hours(tmp_path, hours, applying, not_applying):
+    scripts_path = write_config(tmp_path, {'backups': {'nice': 10, 'hours': hours}})
+    for hour in applying:
+        assert get_policy(scripts_path, 'backups', datetime.datetime(2024, 1, 1, hour, 30)).nice == 10
+    for hour in not_applying:
+        assert get_policy(scripts_path, 'backups', datetime.datetime(2024, 1, 1, hour, 30)) is None
+
+
+def test_token_bucket_limits_the_rate(monkeypatch):
+    clock = [100.0]
+    sleeps = []
+
+    def sleep(seconds):
+        sleeps.append(seconds)
+        clock[0] += seconds
+
+    monkeypatch.setattr(throttling.time, 'monotonic', lambda: clock[0])
+    monkeypatch.setattr(throttling.time, 'sleep', sleep)
+    bucket = TokenBucket(1000)
+    # a second worth of data goes through at once
+    bucket.consume(1000)
+    assert sleeps == []
+    bucket.consume(500)
+    assert sleeps == [0.5]
+    # time spent elsewhere refills the bucket
+    clock[0] += 0.25
+    bucket.consume(250)
+    assert sleeps == [0.5]
+    bucket.consume(2000)
+    assert sleeps == [0.5, 2.0]
+
+
+def test_command_goes_through_the_launcher():
+    assert ThrottlePolicy(bandwidth='1M').command(['/s/10_dump.sh']) == ['/s/10_dump.sh']
+    policy = ThrottlePolicy(nice=10, ionice='idle', cpu_affinity='0-1')
+    assert policy.command(['/s/10_dump.sh', 'arg']) == [
+        sys.executable, '-m', 'sidefridge.throttling', '--nice', '10', '--ionice', 'idle', '--cpu-affinity', '0-1',
+        '--', '/s/10_dump.sh', 'arg'
+    ]
+
+
+def test_launcher_applies_nice_and_affinity():
+    cpu = min(os.sched_getaffinity(0))
+    nice = min(os.getpriority(os.PRIO_PROCESS, 0) + 5, 19)
+    policy = ThrottlePolicy(nice=nice, cpu_affinity=str(cpu))
+    report = 'import os; print(os.getpriority(os.PRIO_PROCESS, 0), sorted(os.sched_getaffinity(0)))'
+    result = subprocess.run(
+        policy.command([sys.executable, '-c', report]), env=dict(os.environ, PYTHONPATH=ROOT),
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.decode() == '%d [%d]\n' % (nice, cpu)
+    assert result.stderr == b''
+
+
+def test_launcher_reports_a_missing_command():
+    result = subprocess.run(
+        [sys.executable, '-m', 'sidefridge.throttling', '--nice', '1', '--', '/missing/command'],
+        env=dict(os.environ, PYTHONPATH=ROOT), stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+    assert result.returncode == 126
+    assert b"could not run '/missing/command'" in result.stderr
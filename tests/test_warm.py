@@ -0,0 +1,117 @@
+import os
+import signal
+import subprocess
+import sys
+
+import pytest
+
+from sidefridge import main as runner
+from sidefridge import warm
+from sidefridge.warm import WarmProcess, WarmWorker, is_warm_script
+
+from tests.conftest import write_script
+
+
+@pytest.fixture
+def warm_worker(tmp_path, monkeypatch):
+    """ The worker of the runner, forked from the test process """
+    worker = WarmWorker(str(tmp_path / 'warm.sock'), ['json'])
+    worker.start()
+    monkeypatch.setattr(warm, '_worker', worker)
+    yield worker
+    worker.stop()
+
+
+def python_script(path, body):
+    return write_script(path, '#!%s\n%s' % (sys.executable, body))
+
+
+def run(script, *arguments):
+    process = runner.start_script([script] + list(arguments))
+    stdout, stderr = process.stdout.read(), process.stderr.read()
+    exit_code = process.wait_with_usage()[0] if isinstance(process, WarmProcess) else process.wait()
+    return process, exit_code, stdout, stderr
+
+
+@pytest.mark.parametrize('body, exit_code, stderr', [
+    ('pass\n', 0, b''),
+    ('import sys\nsys.exit(3)\n', 3, b''),
+    ('import sys\nsys.exit("failed")\n', 1, b'failed\n'),
+    ('raise ValueError("broken")\n', 1, b'ValueError: broken\n'),
+])
+def test_exit_codes(tmp_path, warm_worker, body, exit_code, stderr):
+    process, code, _, error_output = run(python_script(tmp_path / 'script.py', body))
+    assert isinstance(process, WarmProcess)
+    assert code == exit_code
+    assert error_output.endswith(stderr)
+
+
+def test_output_routing_and_arguments(tmp_path, warm_worker):
+    script = python_script(tmp_path / 'script.py', (
+        'import os, sys\nprint("out", sys.argv[1:])\nsys.stderr.write("err\\n")\n'
+        'print(os.getsid(0) == os.getpid(), os.getcwd())\n'
+    ))
+    process, code, stdout, stderr = run(script, 'a', 'b')
+    assert isinstance(process, WarmProcess)
+    assert code == 0
+    # each script leads a session of its own, signals to its group do not reach the worker
+    assert stdout.decode().splitlines() == ["out ['a', 'b']", 'True %s' % os.getcwd()]
+    assert stderr == b'err\n'
+
+    with pytest.raises(runner.SubprocessErrorDuringExecutionException, match="exit code '1'"):
+        runner.run_single_script(python_script(tmp_path / 'failing.py', 'raise SystemExit(1)\n'))
+
+
+def test_cold_and_shell_scripts_start_an_interpreter(tmp_path, warm_worker, capsys):
+    cold = python_script(tmp_path / 'cold.py', '# fridge: cold\nprint("cold")\n')
+    warm_shell = write_script(tmp_path / 'warm.sh', '#!/bin/sh\n# fridge: warm\necho warm shell\n')
+    shell = write_script(tmp_path / 'plain.sh', '#!/bin/sh\necho shell\n')
+    assert not is_warm_script(cold)
+    assert not is_warm_script(shell)
+    capsys.readouterr()
+    assert not is_warm_script(warm_shell)
+    assert "Ignoring '# fridge: warm' of '%s'" % warm_shell in capsys.readouterr().out
+
+    for script, output in ((cold, b'cold\n'), (shell, b'shell\n'), (warm_shell, b'warm shell\n')):
+        process, code, stdout, _ = run(script)
+        assert isinstance(process, subprocess.Popen)
+        assert (code, stdout) == (0, output)
+
+
+@pytest.mark.parametrize('shebang', ['#!/usr/bin/env python3', '#!/usr/bin/python3.11 -u', '#!/usr/bin/env -S python'])
+def test_warm_directive_of_python_scripts(tmp_path, warm_worker, shebang):
+    script = write_script(tmp_path / 'dump', '%s\n# fridge: warm\nprint("warm")\n' % shebang)
+    assert is_warm_script(script)
+    assert not is_warm_script(write_script(tmp_path / 'plain', '%s\nprint("cold")\n' % shebang))
+
+    process, code, stdout, _ = run(script)
+    assert isinstance(process, WarmProcess)
+    assert (code, stdout) == (0, b'warm\n')
+
+
+def test_fallback_when_the_worker_died(tmp_path, warm_worker, capsys):
+    os.kill(warm_worker.pid, signal.SIGKILL)
+    # left for stop() to reap, like a worker which died during a run
+    os.waitid(os.P_PID, warm_worker.pid, os.WEXITED | os.WNOWAIT)
+
+    script = python_script(tmp_path / 'script.py', 'print("still runs")\n')
+    process, code, stdout, _ = run(script)
+    assert isinstance(process, subprocess.Popen)
+    assert (code, stdout) == (0, b'still runs\n')
+    assert "Warm worker could not run '%s', starting a new interpreter" % script in capsys.readouterr().out
+
+
+def test_module_state_does_not_leak(tmp_path, warm_worker, monkeypatch):
+    monkeypatch.setenv('RUN_VALUE', 'original')
+    first = python_script(tmp_path / 'first.py', (
+        'import json, os, sys\njson.leaked = True\nsys.modules["leaked_module"] = json\n'
+        'os.environ["RUN_VALUE"] = "changed"\nsys.path.append("/leaked")\n'
+    ))
+    second = python_script(tmp_path / 'second.py', (
+        'import json, os, sys\nprint(hasattr(json, "leaked"), "leaked_module" in sys.modules, '
+        'os.environ["RUN_VALUE"], "/leaked" in sys.path)\n'
+    ))
+    assert run(first)[1] == 0
+    process, code, stdout, _ = run(second)
+    assert isinstance(process, WarmProcess)
+    assert (code, stdout) == (0, b'False False original False\n')